@@ -1,8 +1,49 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
 from .models import Provider, AccountAccess
 
 
+def get_estimated_count(model, using):
+    "Row count estimate from the database statistics or None if not available."
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+    elif connection.vendor == 'mysql':
+        sql = (
+            'SELECT table_rows FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = %s'
+        )
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    "Paginator which uses the database estimate to count large unfiltered tables."
+
+    #: tables with fewer estimated rows are counted exactly
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        if query is not None and not query.where:
+            estimate = get_estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.estimate_threshold:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
 class ProviderAdmin(admin.ModelAdmin):
     "Admin customization for OAuth providers."
 
@@ -10,10 +51,32 @@ class ProviderAdmin(admin.ModelAdmin):
 
 
 class AccountAccessAdmin(admin.ModelAdmin):
-    "Admin customization for accounts."
+    """
+    Admin customization for accounts.
+
+    Built for large tables: related rows are joined, the token is deferred,
+    counts are estimated, searches match the indexed identifier exactly and
+    the date filters use indexed columns.
+    """
 
-    list_display = ('__str__', 'provider', 'user', 'created', 'modified', )
+    list_display = ('identifier', 'provider', 'user', 'created', 'modified', )
     list_filter = ('provider', 'created', 'modified', )
+    list_select_related = ('provider', 'user', )
+    search_fields = ('identifier', )
+    raw_id_fields = ('user', )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # The tokens are not shown in the list
+        return super(AccountAccessAdmin, self).get_queryset(request).defer('access_token')
+
+    def get_search_results(self, request, queryset, search_term):
+        "Exact match on the identifier so the unique index is used."
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(identifier=search_term), False
 
 
 admin.site.register(Provider, ProviderAdmin)
@@ -0,0 +1,319 @@
+"""
+asyncio OAuth 1.0 and 2.0 clients.
+
+Requires Python 3.5+ and aiohttp. This module is not imported by the rest of
+the package so it is safe to install on older versions of Python.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from functools import partial
+
+import aiohttp
+from oauthlib.oauth1 import Client as OAuth1Signer
+from requests.exceptions import ConnectionError as RequestConnectionError
+from requests.exceptions import HTTPError, RequestException, Timeout
+
+from django.utils.encoding import force_text
+
+from .breaker import CircuitOpen
+from .clients import OAuthClient, OAuth2Client, IDEMPOTENT_METHODS, RETRY_STATUS_CODES, SERVER_ERROR_CODES
+from .compat import urlencode
+from .conf import get_provider_option
+
+
+logger = logging.getLogger('allaccess.clients')
+
+
+_sessions = {}
+
+
+def get_session(provider):
+    "Return the pooled aiohttp session for the provider on the running event loop."
+    loop = asyncio.get_event_loop()
+    key = (os.getpid(), id(loop), provider.name)
+    session = _sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=get_provider_option(provider, 'pool_maxsize'),
+            force_close=not get_provider_option(provider, 'keep_alive'),
+        )
+        session = _sessions[key] = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+async def close_sessions():
+    "Close the pooled aiohttp sessions for the running event loop."
+    loop_id = id(asyncio.get_event_loop())
+    for key in [k for k in _sessions if k[1] == loop_id]:
+        await _sessions.pop(key).close()
+
+
+class Response(object):
+    "Completed provider response with the parts of the requests API used by the clients."
+
+    def __init__(self, url, status_code, headers, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise HTTPError('{0} Error for url: {1}'.format(self.status_code, self.url), response=self)
+
+
+class AsyncClientMixin(object):
+    """
+    Coroutine versions of the client methods which make provider requests.
+
+    Errors from aiohttp are raised as the matching requests exceptions so they
+    can be handled in the same way as the synchronous clients. Calls to the
+    state store and the circuit breaker, which may use the session or cache,
+    run in the default executor of the event loop.
+    """
+
+    async def run_sync(self, func, *args):
+        "Run a blocking call in the default executor so it does not block the event loop."
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, partial(func, *args))
+
+    async def run_inline(self, func, *args):
+        "Run a call which does no I/O on the event loop."
+        return func(*args)
+
+    async def get_profile_info(self, raw_token, profile_info_params={}):
+        "Fetch user profile information."
+        try:
+            response = await self.request('get', self.provider.profile_url, token=raw_token, params=profile_info_params)
+            response.raise_for_status()
+        except RequestException as e:
+            logger.error('Unable to fetch user profile: {0}'.format(e))
+            return None
+        else:
+            return response.json() or response.text
+
+    async def refresh_access_token(self, raw_token=None):
+        "Fetch a new access token with the refresh token. Only supported by OAuth 2.0."
+        return None
+
+    async def get_redirect_url(self, request, callback, parameters=None):
+        "Build authentication redirect url."
+        args = await self.get_redirect_args(request, callback=callback)
+        additional = parameters or {}
+        args.update(additional)
+        params = urlencode(args)
+        return '{0}?{1}'.format(self.provider.authorization_url, params)
+
+    async def request(self, method, url, **kwargs):
+        "Build remote url request."
+        timeout = kwargs.pop('timeout', None)
+        retries = 0
+        if method.lower() in IDEMPOTENT_METHODS:
+            retries = get_provider_option(self.provider, 'retries')
+        breaker = self.breaker
+        # The breaker only uses the cache when it is enabled
+        run_breaker = self.run_sync if breaker.enabled else self.run_inline
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            if not await run_breaker(breaker.allow_request):
+                raise CircuitOpen('Circuit breaker is open for {0}.'.format(self.provider.name))
+            request_timeout = self.get_timeout(timeout)
+            start = time.time()
+            try:
+                response = await self.send(method, url, request_timeout, **kwargs)
+            except (RequestConnectionError, Timeout) as e:
+                await run_breaker(breaker.record_failure)
+                if last or not await self.wait_for_retry(attempt):
+                    raise
+                logger.warning('Retrying request to {0}: {1}'.format(url, e))
+            else:
+                if response.status_code in SERVER_ERROR_CODES:
+                    await run_breaker(breaker.record_failure)
+                else:
+                    await run_breaker(breaker.record_success, time.time() - start)
+                if last or response.status_code not in RETRY_STATUS_CODES \
+                        or not await self.wait_for_retry(attempt):
+                    return response
+                logger.warning('Retrying request to {0}: {1}'.format(url, response.status_code))
+
+    async def send(self, method, url, timeout, **kwargs):
+        "Send a single request on the pooled session and read the response."
+        connect, read = timeout
+        # Unlike the read timeout the total timeout also limits a response which is read slowly
+        total = None if self.deadline is None else max(self.deadline - time.time(), 0)
+        timeout = aiohttp.ClientTimeout(total=total, sock_connect=connect, sock_read=read)
+        try:
+            async with self.http_session.request(method.upper(), url, timeout=timeout, **kwargs) as response:
+                content = await response.read()
+                return Response(str(response.url), response.status, response.headers, content, response.charset)
+        except asyncio.TimeoutError as e:
+            raise Timeout('Request to {0} timed out.'.format(url)) from e
+        except aiohttp.ClientError as e:
+            raise RequestConnectionError(e) from e
+
+    async def wait_for_retry(self, attempt):
+        "Sleep before the next retry. Returns False if there is no time left to retry."
+        delay = self.get_retry_delay(attempt)
+        if delay is None:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    @property
+    def http_session(self):
+        "Pooled aiohttp session shared by all clients for this provider."
+        return get_session(self.provider)
+
+
+class AsyncOAuthClient(AsyncClientMixin, OAuthClient):
+
+    async def get_access_token(self, request, callback=None):
+        "Fetch access token from callback request."
+        raw_token = await self.run_sync(self.state_store.get, request, self.session_key)
+        verifier = request.GET.get('oauth_verifier', None)
+        if raw_token is not None and verifier is not None:
+            data = {'oauth_verifier': verifier}
+            callback = request.build_absolute_uri(callback or request.path)
+            callback = force_text(callback)
+            try:
+                response = await self.request('post', self.provider.access_token_url,
+                                              token=raw_token, data=data, oauth_callback=callback)
+                response.raise_for_status()
+            except RequestException as e:
+                logger.error('Unable to fetch access token: {0}'.format(e))
+                return None
+            else:
+                return response.text
+        return None
+
+    async def get_request_token(self, request, callback):
+        "Fetch the OAuth request token. Only required for OAuth 1.0."
+        callback = force_text(request.build_absolute_uri(callback))
+        try:
+            response = await self.request(
+                'post', self.provider.request_token_url, oauth_callback=callback)
+            response.raise_for_status()
+        except RequestException as e:
+            logger.error('Unable to fetch request token: {0}'.format(e))
+            return None
+        else:
+            return response.text
+
+    async def get_redirect_args(self, request, callback):
+        "Get request parameters for redirect url."
+        callback = force_text(request.build_absolute_uri(callback))
+        raw_token = await self.get_request_token(request, callback)
+        token, secret = self.parse_raw_token(raw_token)
+        if token is not None and secret is not None:
+            await self.run_sync(self.state_store.set, request, self.session_key, raw_token)
+        return {
+            'oauth_token': token,
+            'oauth_callback': callback,
+        }
+
+    async def request(self, method, url, **kwargs):
+        "Build remote url request. Signs the request with oauthlib."
+        token = self.get_token(kwargs.pop('token', None))
+        callback = kwargs.pop('oauth_callback', None)
+        data = kwargs.pop('data', None) or {}
+        verifier = data.pop('oauth_verifier', None)
+        signer = OAuth1Signer(
+            self.provider.consumer_key,
+            client_secret=self.provider.consumer_secret,
+            resource_owner_key=token.access_token,
+            resource_owner_secret=token.secret,
+            verifier=verifier,
+            callback_uri=callback,
+        )
+        params = kwargs.pop('params', None)
+        if params:
+            url = '{0}{1}{2}'.format(url, '&' if '?' in url else '?', urlencode(params))
+        headers = dict(kwargs.pop('headers', None) or {})
+        body = None
+        if data:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        url, headers, body = signer.sign(url, http_method=method.upper(), body=body, headers=headers)
+        return await super(AsyncOAuthClient, self).request(method, url, data=body, headers=headers, **kwargs)
+
+
+class AsyncOAuth2Client(AsyncClientMixin, OAuth2Client):
+
+    async def get_access_token(self, request, callback=None):
+        "Fetch access token from callback request."
+        callback = request.build_absolute_uri(callback or request.path)
+        if not await self.run_sync(self.check_application_state, request, callback):
+            logger.error('Application state check failed.')
+            return None
+        if 'code' in request.GET:
+            args = {
+                'client_id': self.provider.consumer_key,
+                'redirect_uri': callback,
+                'client_secret': self.provider.consumer_secret,
+                'code': request.GET['code'],
+                'grant_type': 'authorization_code',
+            }
+        else:
+            logger.error('No code returned by the provider')
+            return None
+        try:
+            response = await self.request('post', self.provider.access_token_url, data=args)
+            response.raise_for_status()
+        except RequestException as e:
+            logger.error('Unable to fetch access token: {0}'.format(e))
+            return None
+        else:
+            return response.text
+
+    async def get_redirect_args(self, request, callback):
+        "Get request parameters for redirect url."
+        return await self.run_sync(super(AsyncOAuth2Client, self).get_redirect_args, request, callback)
+
+    async def refresh_access_token(self, raw_token=None):
+        "Fetch a new access token with the refresh token (default: from the client token)."
+        token = self.get_token(raw_token)
+        if token.refresh_token is None:
+            logger.error('No refresh token for {0}.'.format(self.provider.name))
+            return None
+        args = {
+            'client_id': self.provider.consumer_key,
+            'client_secret': self.provider.consumer_secret,
+            'refresh_token': token.refresh_token,
+            'grant_type': 'refresh_token',
+        }
+        try:
+            response = await self.request('post', self.provider.access_token_url, data=args, token='')
+            response.raise_for_status()
+        except RequestException as e:
+            logger.error('Unable to refresh access token: {0}'.format(e))
+            return None
+        else:
+            return self.update_refreshed_token(raw_token, token, response.text)
+
+    async def request(self, method, url, **kwargs):
+        "Build remote url request. Constructs necessary auth."
+        token = self.get_token(kwargs.pop('token', None)).access_token
+        if token is not None:
+            params = kwargs.get('params', {})
+            params['access_token'] = token
+            kwargs['params'] = params
+        return await super(AsyncOAuth2Client, self).request(method, url, **kwargs)
+
+
+def get_async_client(provider, token=''):
+    "Return the asyncio API client for the given provider."
+    cls = AsyncOAuth2Client
+    if provider.request_token_url:
+        cls = AsyncOAuthClient
+    return cls(provider, token)
@@ -6,3 +6,10 @@ except ImportError:
 
 class AllAccessConfig(AppConfig):
     name = 'allaccess'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from .models import invalidate_user_cache
+        # Cached users are deferred subclasses of the user model on Django 1.8 and 1.9
+        post_save.connect(invalidate_user_cache, dispatch_uid='allaccess-user-cache')
+        post_delete.connect(invalidate_user_cache, dispatch_uid='allaccess-user-cache')
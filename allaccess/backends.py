@@ -1,24 +1,77 @@
 from __future__ import unicode_literals
 
+from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 from django.db.models import Q
 
+from .bloom import identity_filter
+from .cache import identity_cache, user_cache
 from .models import Provider, AccountAccess
 
 
 class AuthorizedServiceBackend(ModelBackend):
     "Authentication backend for users registered with remote OAuth provider."
 
-    def authenticate(self, provider=None, identifier=None):
+    def authenticate(self, provider=None, identifier=None, access=None):
         "Fetch user for a given provider by id."
+        if access is not None:
+            # Access record was already resolved by the caller
+            if not self.access_matches(access, provider, identifier):
+                return None
+            return access.user
+        provider_id = self.get_provider_id(provider)
+        if provider_id is not None:
+            user_id = identity_cache.get(provider_id, identifier)
+            if user_id is not None:
+                user = self.get_user(user_id)
+                if user is not None:
+                    return user
+            if not identity_filter.might_contain(provider_id, identifier):
+                # Definitely no access record for a new user
+                return None
         provider_q = Q(provider__name=provider)
         if isinstance(provider, Provider):
             provider_q = Q(provider=provider)
         try:
             access = AccountAccess.objects.filter(
                 provider_q, identifier=identifier
-            ).select_related('user')[0]
+            ).select_related('user').only('provider', 'user')[0]
         except IndexError:
             return None
         else:
+            identity_cache.set(access.provider_id, identifier, access.user_id)
+            if access.user is not None:
+                user_cache.set(get_user_model(), access.user)
             return access.user
+
+    def access_matches(self, access, provider=None, identifier=None):
+        "Check the given provider and identifier belong to the access record."
+        if identifier is not None and access.identifier != identifier:
+            return False
+        if isinstance(provider, Provider):
+            return access.provider_id == provider.pk
+        if provider is not None:
+            return access.provider.name == provider
+        return True
+
+    def get_user(self, user_id):
+        "Fetch the user by primary key from the user cache when it is enabled."
+        if user_cache.shared is None:
+            return super(AuthorizedServiceBackend, self).get_user(user_id)
+        user = user_cache.get(get_user_model(), user_id)
+        if user is None:
+            return None
+        # Inactive users are rejected on Django 1.10+
+        can_authenticate = getattr(self, 'user_can_authenticate', lambda user: True)
+        return user if can_authenticate(user) else None
+
+    def get_provider_id(self, provider):
+        "Primary key of the provider or provider name when the identity cache or filter is enabled."
+        if isinstance(provider, Provider):
+            return provider.pk
+        if identity_cache.shared is None and identity_filter.shared is None:
+            return None
+        try:
+            return Provider.objects.get_cached(provider).pk
+        except Provider.DoesNotExist:
+            return None
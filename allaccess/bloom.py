@@ -0,0 +1,239 @@
+"Probabilistic filter of known provider and identifier pairs."
+from __future__ import unicode_literals
+
+import hashlib
+import math
+import struct
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import get_random_string
+from django.utils.encoding import force_bytes, force_text
+
+from .compat import on_commit
+
+
+class BloomFilter(object):
+    "Fixed size Bloom filter of text keys."
+
+    def __init__(self, capacity, error_rate, bits=None):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8) if bits is None else bytearray(bits)
+
+    def get_positions(self, key):
+        digest = hashlib.sha256(force_bytes(key)).digest()
+        first, second = struct.unpack('>QQ', digest[:16])
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.get_positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self.get_positions(key))
+
+
+class IdentityFilter(object):
+    """
+    Bloom filter of the provider and identifier pairs which have an access record.
+
+    A miss means there is no access record for the pair, so the lookup can be
+    skipped. On first use a single process builds the filter from the database
+    with the executor and shares it as a snapshot in the cache named by
+    ``ALLACCESS_IDENTITY_FILTER``. Until then nothing is skipped. New pairs are
+    appended to a log in the cache once their transaction commits and each process
+    applies the log before trusting a miss. Anything missing from the cache starts
+    a new generation which is built again rather than risk a false miss.
+    """
+
+    prefix = 'allaccess-identity-filter'
+    #: applied log entries between saving snapshots
+    snapshot_interval = 500
+    #: seconds to keep log entries
+    log_timeout = 24 * 60 * 60
+    #: seconds before another process may build the filter if the build did not finish
+    build_timeout = 10 * 60
+
+    def __init__(self):
+        self._filter = None
+        self._epoch = None
+        self._position = 0
+        self._snapshot_position = 0
+        self._lock = threading.RLock()
+
+    @property
+    def shared(self):
+        "Django cache for the filter or None if disabled."
+        alias = getattr(settings, 'ALLACCESS_IDENTITY_FILTER', None)
+        if alias is None:
+            return None
+        return caches[alias]
+
+    @property
+    def capacity(self):
+        return getattr(settings, 'ALLACCESS_IDENTITY_FILTER_CAPACITY', 100000)
+
+    @property
+    def error_rate(self):
+        return getattr(settings, 'ALLACCESS_IDENTITY_FILTER_ERROR_RATE', 0.01)
+
+    def get_key(self, provider_id, identifier):
+        return '{0}:{1}'.format(provider_id, force_text(identifier))
+
+    def get_cache_key(self, *parts):
+        return '-'.join((self.prefix, ) + tuple('{0}'.format(p) for p in parts))
+
+    def get_epoch(self, shared):
+        "Current filter generation, starting a new one if it was lost."
+        epoch = shared.get(self.get_cache_key('epoch'))
+        if epoch is None:
+            shared.add(self.get_cache_key('epoch'), get_random_string(12), None)
+            epoch = shared.get(self.get_cache_key('epoch'))
+            shared.add(self.get_cache_key(epoch, 'count'), 0, None)
+        return epoch
+
+    def might_contain(self, provider_id, identifier):
+        "Return False only if there is definitely no access record for the pair."
+        shared = self.shared
+        if shared is None:
+            return True
+        key = self.get_key(provider_id, identifier)
+        with self._lock:
+            if self._filter is not None and key in self._filter:
+                return True
+            # Apply pairs added by other processes before trusting a miss
+            bloom = self.sync(shared)
+        if bloom is None:
+            # Nothing can be skipped until one process has built and shared the filter
+            self.request_build(shared)
+            return True
+        return key in bloom
+
+    def add(self, provider_id, identifier):
+        "Record a pair once the current transaction commits."
+        if self.shared is None:
+            return
+        key = self.get_key(provider_id, identifier)
+        with self._lock:
+            if self._filter is not None and key in self._filter:
+                return
+        # Logged after commit so a concurrent build either sees the row or the entry
+        on_commit(lambda: self.log(key))
+
+    def log(self, key):
+        shared = self.shared
+        if shared is None:
+            return
+        epoch = self.get_epoch(shared)
+        try:
+            count = shared.incr(self.get_cache_key(epoch, 'count'))
+        except ValueError:
+            # Counter was lost so start a new generation
+            shared.delete(self.get_cache_key('epoch'))
+            return
+        shared.set(self.get_cache_key(epoch, 'log', count), key, self.log_timeout)
+        with self._lock:
+            if self._filter is not None and self._epoch == epoch:
+                self._filter.add(key)
+
+    def sync(self, shared):
+        "Bring the local filter up to date with the shared log. Returns None if there is no usable filter."
+        epoch = self.get_epoch(shared)
+        count = shared.get(self.get_cache_key(epoch, 'count'))
+        if count is None:
+            # Entries logged since the snapshot were lost with the counter
+            return self.discard(shared, epoch)
+        if self._filter is None or self._epoch != epoch:
+            if not self.load(shared, epoch):
+                return None
+        if count < self._position or (count > self._position and not self.replay(shared, epoch, count)):
+            return self.discard(shared, epoch)
+        return self._filter
+
+    def replay(self, shared, epoch, count):
+        "Apply log entries up to count. Returns False if any have been lost."
+        numbers = range(self._position + 1, count + 1)
+        keys = [self.get_cache_key(epoch, 'log', n) for n in numbers]
+        entries = shared.get_many(keys)
+        if len(entries) != len(keys):
+            return False
+        for key in keys:
+            self._filter.add(entries[key])
+        self._position = count
+        if self._position - self._snapshot_position >= self.snapshot_interval:
+            self.save(shared, epoch)
+        return True
+
+    def load(self, shared, epoch):
+        "Load the shared snapshot. Returns False if there is none for the current settings."
+        snapshot = shared.get(self.get_cache_key(epoch, 'snapshot'))
+        if snapshot is None or snapshot['capacity'] != self.capacity or \
+                snapshot['error_rate'] != self.error_rate:
+            return False
+        self._filter = BloomFilter(self.capacity, self.error_rate, bits=snapshot['bits'])
+        self._epoch = epoch
+        self._position = self._snapshot_position = snapshot['position']
+        return True
+
+    def discard(self, shared, epoch):
+        "Start a new generation when the log for the current one is incomplete."
+        self._filter = None
+        if shared.get(self.get_cache_key('epoch')) == epoch:
+            shared.delete(self.get_cache_key('epoch'))
+        return None
+
+    def request_build(self, shared):
+        "Build the filter in a single process with the configured executor."
+        from .tasks import get_executor
+        epoch = self.get_epoch(shared)
+        if shared.add(self.get_cache_key(epoch, 'building'), True, self.build_timeout):
+            get_executor().submit('allaccess.bloom.build_identity_filter', epoch)
+
+    def build(self, epoch):
+        "Build the filter from all access records and share it."
+        from .models import AccountAccess
+        shared = self.shared
+        if shared is None:
+            return
+        try:
+            # Entries logged before this point are for rows which are already committed
+            position = shared.get(self.get_cache_key(epoch, 'count'))
+            if position is None or shared.get(self.get_cache_key('epoch')) != epoch:
+                return
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            pairs = AccountAccess.objects.order_by().values_list('provider_id', 'identifier')
+            for provider_id, identifier in pairs.iterator():
+                bloom.add(self.get_key(provider_id, identifier))
+            with self._lock:
+                self._filter = bloom
+                self._epoch = epoch
+                self._position = position
+                self.save(shared, epoch)
+        finally:
+            shared.delete(self.get_cache_key(epoch, 'building'))
+
+    def save(self, shared, epoch):
+        snapshot = {
+            'capacity': self.capacity, 'error_rate': self.error_rate,
+            'position': self._position, 'bits': bytes(self._filter.bits),
+        }
+        shared.set(self.get_cache_key(epoch, 'snapshot'), snapshot, None)
+        self._snapshot_position = self._position
+
+    def reset(self):
+        "Discard the filter in every process. Use after adding records without signals."
+        with self._lock:
+            self._filter = None
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self.get_cache_key('epoch'))
+
+
+identity_filter = IdentityFilter()
+
+
+def build_identity_filter(epoch):
+    "Task which builds and shares the identity filter."
+    identity_filter.build(epoch)
@@ -0,0 +1,131 @@
+"Circuit breaker to stop sending requests to providers which are down."
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from requests.exceptions import RequestException
+
+from .conf import get_provider_option
+
+
+logger = logging.getLogger('allaccess.breaker')
+
+
+class CircuitOpen(RequestException):
+    "Request was not sent because the circuit breaker for the provider is open."
+
+
+class CircuitBreaker(object):
+    """
+    Failure tracking for a provider shared through the Django cache.
+
+    The breaker opens when the ratio of failed (or slow) requests in the current
+    window passes the threshold. While open no requests are sent. Once the reset
+    timeout has passed a single probe request is allowed through and its result
+    either closes the breaker or opens it again. Results of requests which were
+    sent before the breaker opened are ignored while it is open.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        #: this instance holds the half-open probe
+        self.probe = False
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'ALLACCESS_BREAKER_CACHE', 'default')]
+
+    @property
+    def enabled(self):
+        return self.get_option('enabled')
+
+    def get_option(self, name):
+        return get_provider_option(self.provider, 'breaker_{0}'.format(name))
+
+    def get_key(self, *parts):
+        return 'allaccess-breaker-{0}-{1}'.format(
+            self.provider.name, '-'.join('{0}'.format(p) for p in parts))
+
+    def get_opened(self):
+        "Return the time the breaker was opened or None if it is closed."
+        if not self.enabled:
+            return None
+        return self.cache.get(self.get_key('opened'))
+
+    def is_open(self):
+        "Check if requests are blocked without using up the half-open probe."
+        opened = self.get_opened()
+        return opened is not None and time.time() - opened < self.get_option('reset_timeout')
+
+    def allow_request(self):
+        "Check if a request can be sent to the provider."
+        opened = self.get_opened()
+        if opened is None:
+            return True
+        reset_timeout = self.get_option('reset_timeout')
+        if time.time() - opened < reset_timeout:
+            return False
+        # Half-open so let a single probe through
+        if self.cache.add(self.get_key('probe'), 1, reset_timeout):
+            self.probe = True
+            return True
+        return False
+
+    def record_success(self, elapsed):
+        "Record a completed request and how long it took."
+        if not self.enabled:
+            return
+        if elapsed > self.get_option('slow_call'):
+            return self.record_failure()
+        if self.get_opened() is not None:
+            if not self.probe:
+                # Sent before the breaker opened
+                return
+            self.close()
+        self.count('requests')
+
+    def record_failure(self):
+        "Record a failed request and open the breaker if needed."
+        if not self.enabled:
+            return
+        if self.get_opened() is not None:
+            if self.probe:
+                # Probe failed
+                self.open()
+            return
+        requests = self.count('requests')
+        failures = self.count('failures')
+        if requests >= self.get_option('min_requests') and \
+                failures >= requests * self.get_option('failure_ratio'):
+            self.open()
+
+    def count(self, name):
+        "Increment the counter for the current window."
+        window = self.get_option('window')
+        key = self.get_key(name, int(time.time() // window))
+        self.cache.add(key, 0, window * 2)
+        try:
+            return self.cache.incr(key)
+        except ValueError:  # pragma: no cover
+            # Expired between the add and incr
+            return 0
+
+    def open(self):
+        logger.warning('Circuit breaker opened for {0}.'.format(self.provider.name))
+        self.probe = False
+        self.cache.set(self.get_key('opened'), time.time(), None)
+        self.cache.delete(self.get_key('probe'))
+
+    def close(self):
+        logger.info('Circuit breaker closed for {0}.'.format(self.provider.name))
+        self.probe = False
+        # Start a new count so the failures from before the breaker opened are dropped
+        window = int(time.time() // self.get_option('window'))
+        self.cache.delete_many([
+            self.get_key('opened'), self.get_key('probe'),
+            self.get_key('requests', window), self.get_key('failures', window),
+        ])
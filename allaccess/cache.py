@@ -0,0 +1,307 @@
+"Process and shared caches for provider configuration, account identities and users."
+from __future__ import unicode_literals
+
+import hashlib
+import threading
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.utils.encoding import force_bytes
+
+from .compat import deferred_class_factory
+
+
+class ProviderCache(object):
+    """
+    Two-tier cache of providers by name.
+
+    The first tier holds the decrypted providers in the current process. The
+    optional second tier holds the encrypted column values in a shared Django
+    cache. Entries are tied to a version number which is bumped whenever a
+    provider is saved or deleted so that all processes converge. Unknown names
+    are not cached since they come from the URL.
+    """
+
+    version_key = 'allaccess-provider-version'
+
+    def __init__(self):
+        self._local = {}
+        self._local_version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        "Shared Django cache for the second tier or None if disabled."
+        alias = getattr(settings, 'ALLACCESS_PROVIDER_CACHE', None)
+        if alias is None:
+            return None
+        return caches[alias]
+
+    @property
+    def timeout(self):
+        "Seconds to keep providers in the process cache."
+        return getattr(settings, 'ALLACCESS_PROVIDER_CACHE_TIMEOUT', 60)
+
+    def get_version(self):
+        "Current version of the provider configuration."
+        shared = self.shared
+        if shared is None:
+            return self._local_version
+        version = shared.get(self.version_key)
+        if version is None:
+            # Start from a new number so entries from before an eviction are not reused
+            version = int(time.time() * 1000)
+            shared.add(self.version_key, version, None)
+            version = shared.get(self.version_key, version)
+        return version
+
+    def get(self, model, name):
+        "Fetch the provider from the cache, loading it if needed."
+        version = self.get_version()
+        entry = self._local.get(name)
+        if entry is not None:
+            cached_version, expires, provider = entry
+            if cached_version == version and expires > time.time():
+                return provider
+        provider = self.load(model, name, version)
+        if provider is not None:
+            now = time.time()
+            with self._lock:
+                # Drop expired entries for providers which are no longer used
+                for key, (_, expires, _) in list(self._local.items()):
+                    if expires <= now:
+                        del self._local[key]
+                self._local[name] = (version, now + self.timeout, provider)
+        return provider
+
+    def load(self, model, name, version):
+        "Load the provider from the shared cache or the database."
+        shared = self.shared
+        key = '{0}-{1}-{2}'.format(self.version_key, version, name)
+        if shared is not None:
+            values = shared.get(key)
+            if values is not None:
+                return self.from_cache(model, values)
+        try:
+            provider = model._default_manager.get(name=name)
+        except model.DoesNotExist:
+            return None
+        if shared is not None:
+            shared.set(key, self.to_cache(model, provider), self.timeout)
+        return provider
+
+    def to_cache(self, model, provider):
+        "Convert the provider into its database representation."
+        return {
+            f.attname: f.get_db_prep_value(getattr(provider, f.attname), connection)
+            for f in model._meta.concrete_fields
+        }
+
+    def from_cache(self, model, values):
+        "Rebuild the provider from its database representation."
+        fields = model._meta.concrete_fields
+        names = [f.attname for f in fields]
+        row = []
+        for f in fields:
+            value = values[f.attname]
+            if hasattr(f, 'from_db_value'):
+                value = f.from_db_value(value, None, connection, {})
+            row.append(value)
+        return model.from_db(None, names, row)
+
+    def invalidate(self):
+        "Expire all cached providers in every process."
+        with self._lock:
+            self._local_version += 1
+            self._local.clear()
+        shared = self.shared
+        if shared is not None:
+            try:
+                shared.incr(self.version_key)
+            except ValueError:
+                shared.add(self.version_key, int(time.time() * 1000), None)
+
+
+provider_cache = ProviderCache()
+
+
+class IdentityCache(object):
+    """
+    Read-through cache of user ids by provider and identifier.
+
+    Entries are stored in the Django cache named by ``ALLACCESS_IDENTITY_CACHE``
+    and removed when the access record is saved or deleted. Only access
+    records with a user are cached. Hits and misses are counted per process.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        "Django cache for the identities or None if disabled."
+        alias = getattr(settings, 'ALLACCESS_IDENTITY_CACHE', None)
+        if alias is None:
+            return None
+        return caches[alias]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'ALLACCESS_IDENTITY_CACHE_TIMEOUT', 300)
+
+    def get_key(self, provider_id, identifier):
+        digest = hashlib.md5(force_bytes(identifier)).hexdigest()
+        return 'allaccess-identity-{0}-{1}'.format(provider_id, digest)
+
+    def get(self, provider_id, identifier):
+        "Return the cached user id or None."
+        shared = self.shared
+        if shared is None:
+            return None
+        user_id = shared.get(self.get_key(provider_id, identifier))
+        with self._lock:
+            if user_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return user_id
+
+    def set(self, provider_id, identifier, user_id):
+        shared = self.shared
+        if shared is not None and user_id is not None:
+            shared.set(self.get_key(provider_id, identifier), user_id, self.timeout)
+
+    def invalidate(self, provider_id, identifier):
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self.get_key(provider_id, identifier))
+
+    def stats(self):
+        "Hit and miss counts for this process."
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+identity_cache = IdentityCache()
+
+
+def _cached_session_auth_hash(user, session_hash):
+    "Session hash of a cached user unless its password was set after loading."
+    if 'password' in user.__dict__:
+        return type(user).get_session_auth_hash(user)
+    return session_hash
+
+
+class UserCache(object):
+    """
+    Cache of users by primary key for ``AuthorizedServiceBackend.get_user``.
+
+    Users are stored in the Django cache named by ``ALLACCESS_USER_CACHE``
+    and removed when they are saved or deleted. ``ALLACCESS_USER_CACHE_FIELDS``
+    limits the fields which are loaded and cached. The password hash is never
+    cached, only the session hash which Django derives from it.
+    """
+
+    session_hash_key = '_session_auth_hash'
+
+    @property
+    def shared(self):
+        "Django cache for the users or None if disabled."
+        alias = getattr(settings, 'ALLACCESS_USER_CACHE', None)
+        if alias is None:
+            return None
+        return caches[alias]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'ALLACCESS_USER_CACHE_TIMEOUT', 60)
+
+    @property
+    def fields(self):
+        return getattr(settings, 'ALLACCESS_USER_CACHE_FIELDS', None)
+
+    def get_key(self, user_id):
+        return 'allaccess-user-{0}'.format(user_id)
+
+    def get(self, model, user_id):
+        "Fetch the user from the cache, loading it if needed. Returns None if it does not exist."
+        shared = self.shared
+        key = self.get_key(user_id)
+        values = shared.get(key)
+        if values is not None:
+            return self.from_cache(model, values)
+        queryset = model._default_manager.all()
+        if self.fields:
+            fields = list(self.fields)
+            if self.get_password_field(model) is not None:
+                # Needed for the session hash
+                fields.append('password')
+            queryset = queryset.only(*fields)
+        try:
+            user = queryset.get(pk=user_id)
+        except model.DoesNotExist:
+            return None
+        self.set(model, user)
+        return user
+
+    def set(self, model, user):
+        "Store a user which was already loaded."
+        shared = self.shared
+        if shared is not None:
+            shared.set(self.get_key(user.pk), self.to_cache(model, user), self.timeout)
+
+    def get_password_field(self, model):
+        "Password field of the user model or None if it does not have one."
+        for f in model._meta.concrete_fields:
+            if f.attname == 'password':
+                return f
+        return None
+
+    def to_cache(self, model, user):
+        "Loaded field values of the user limited to the configured fields without the password."
+        deferred = user.get_deferred_fields()
+        names = None
+        if self.fields:
+            names = set(model._meta.get_field(name).attname for name in self.fields)
+            names.add(model._meta.pk.attname)
+        values = {
+            f.attname: getattr(user, f.attname)
+            for f in model._meta.concrete_fields
+            if f.attname not in deferred and (names is None or f.attname in names)
+        }
+        values.pop('password', None)
+        if 'password' not in deferred and self.get_password_field(model) is not None and \
+                hasattr(user, 'get_session_auth_hash'):
+            values[self.session_hash_key] = user.get_session_auth_hash()
+        return values
+
+    def from_cache(self, model, values):
+        "Rebuild the user from its cached field values."
+        fields = [f for f in model._meta.concrete_fields if f.attname in values]
+        names = [f.attname for f in fields]
+        if deferred_class_factory is not None and len(fields) != len(model._meta.concrete_fields):
+            skip = set(f.attname for f in model._meta.concrete_fields) - set(names)
+            model = deferred_class_factory(model, skip)
+        user = model.from_db(None, names, [values[name] for name in names])
+        session_hash = values.get(self.session_hash_key)
+        if session_hash is not None:
+            # Checked by Django for each request without loading the password
+            user.get_session_auth_hash = partial(_cached_session_auth_hash, user, session_hash)
+        return user
+
+    def invalidate(self, user_id):
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self.get_key(user_id))
+
+
+user_cache = UserCache()
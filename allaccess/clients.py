@@ -2,30 +2,127 @@ from __future__ import unicode_literals
 
 import json
 import logging
-
+import os
+import random
+import re
+import threading
+import time
+from datetime import timedelta
+
+from django.utils import timezone
 from django.utils.crypto import constant_time_compare, get_random_string
 from django.utils.encoding import force_text
+from django.utils.six.moves.http_cookiejar import DefaultCookiePolicy
 
-from requests.api import request
+from requests import Session
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
-from requests.exceptions import RequestException
+from requests.exceptions import ConnectionError as RequestConnectionError
+from requests.exceptions import RequestException, Timeout
 
+from .breaker import CircuitBreaker, CircuitOpen
 from .compat import urlencode, parse_qs
+from .conf import get_provider_option
+from .state import get_state_store
 
 
 logger = logging.getLogger('allaccess.clients')
 
 
+# Requests which are safe to retry and the responses which should be retried
+IDEMPOTENT_METHODS = ('get', 'head', 'options')
+RETRY_STATUS_CODES = (502, 503, 504)
+SERVER_ERROR_CODES = tuple(range(500, 600))
+# Token response values which are not copied into the profile
+TOKEN_FIELDS = ('access_token', 'refresh_token', 'id_token', 'oauth_token', 'oauth_token_secret')
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(provider):
+    "Return the pooled HTTP session for the provider in this process."
+    key = (os.getpid(), provider.name)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = build_session(provider)
+    return session
+
+
+class RejectCookiePolicy(DefaultCookiePolicy):
+    "Cookie policy which never stores cookies."
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+def build_session(provider):
+    "Create a new HTTP session with a connection pool sized for the provider."
+    session = Session()
+    # The session is shared by every user so cookies from one response must not be sent for another
+    session.cookies.set_policy(RejectCookiePolicy())
+    adapter = HTTPAdapter(
+        pool_connections=get_provider_option(provider, 'pool_connections'),
+        pool_maxsize=get_provider_option(provider, 'pool_maxsize'),
+        pool_block=get_provider_option(provider, 'pool_block'),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not get_provider_option(provider, 'keep_alive'):
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def close_sessions():
+    "Close all pooled HTTP sessions and their connections."
+    with _sessions_lock:
+        while _sessions:
+            _, session = _sessions.popitem()
+            session.close()
+
+
+class Token(object):
+    "Token response parsed into its parts."
+    __slots__ = ('raw', 'access_token', 'secret', 'refresh_token', 'expires_at', 'scopes')
+
+    def __init__(self, raw, access_token=None, secret=None, refresh_token=None, expires_at=None, scopes=()):
+        self.raw = raw
+        self.access_token = access_token
+        self.secret = secret
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.scopes = scopes
+
+    def __repr__(self):
+        return '<Token expires_at={0!r} scopes={1!r}>'.format(self.expires_at, self.scopes)
+
+    @property
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at <= timezone.now()
+
+
 class BaseOAuthClient(object):
 
     def __init__(self, provider, token=''):
         self.provider = provider
         self.token = token
+        #: time.time() by which all requests must complete or None for no limit
+        self.deadline = None
+        self._parsed_token = None
+        self._signer = None
 
     def get_access_token(self, request, callback=None):
         "Fetch access token from callback request."
         raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
 
+    def get_callback_key(self, request):
+        "Values which identify duplicate callbacks for the same authorization or None."
+        return None
+
     def get_profile_info(self, raw_token, profile_info_params={}):
         "Fetch user profile information."
         try:
@@ -37,6 +134,30 @@ class BaseOAuthClient(object):
         else:
             return response.json() or response.text
 
+    def get_token_profile(self, raw_token):
+        """
+        Profile information from the token response or None if it does not include the user.
+
+        Requires the ``token_identifier`` option for the provider. The identifier
+        is returned as ``id`` along with the other non-secret values in the response.
+        """
+        path = get_provider_option(self.provider, 'token_identifier')
+        if not path or not raw_token:
+            return None
+        token_data = self.get_token_data(raw_token)
+        identifier = token_data
+        for key in path.split('.'):
+            identifier = identifier.get(key, None) if isinstance(identifier, dict) else None
+        if identifier is None:
+            return None
+        profile = {k: v for k, v in token_data.items() if k not in TOKEN_FIELDS}
+        profile['id'] = identifier
+        return profile
+
+    def get_token_data(self, raw_token):
+        "Load the raw token response into a dictionary."
+        raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
+
     def get_redirect_args(self, request, callback):
         "Get request parameters for redirect url."
         raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
@@ -53,9 +174,102 @@ class BaseOAuthClient(object):
         "Parse token and secret from raw token response."
         raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
 
+    def parse_token(self, raw_token):
+        "Parse the raw token response into a Token."
+        token, secret = self.parse_raw_token(raw_token)
+        return Token(raw_token, token, secret)
+
+    def refresh_access_token(self, raw_token=None):
+        "Fetch a new access token with the refresh token. Only supported by OAuth 2.0."
+        return None
+
+    def get_token(self, raw_token=None):
+        "Return the parsed Token for the raw token (default: the client token), parsing each only once."
+        raw_token = self.token if raw_token is None else raw_token
+        parsed = self._parsed_token
+        if parsed is None or parsed.raw != raw_token:
+            parsed = self._parsed_token = self.parse_token(raw_token)
+        return parsed
+
     def request(self, method, url, **kwargs):
         "Build remote url request."
-        return request(method, url, **kwargs)
+        timeout = kwargs.pop('timeout', None)
+        retries = 0
+        if method.lower() in IDEMPOTENT_METHODS:
+            retries = get_provider_option(self.provider, 'retries')
+        breaker = self.breaker
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            if not breaker.allow_request():
+                raise CircuitOpen('Circuit breaker is open for {0}.'.format(self.provider.name))
+            request_timeout = self.get_timeout(timeout)
+            start = time.time()
+            try:
+                response = self.http_session.request(method, url, timeout=request_timeout, **kwargs)
+            except (RequestConnectionError, Timeout) as e:
+                breaker.record_failure()
+                if last or not self.wait_for_retry(attempt):
+                    raise
+                logger.warning('Retrying request to {0}: {1}'.format(url, e))
+            else:
+                if response.status_code in SERVER_ERROR_CODES:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success(time.time() - start)
+                if last or response.status_code not in RETRY_STATUS_CODES \
+                        or not self.wait_for_retry(attempt):
+                    return response
+                # Release the connection back to the pool
+                response.close()
+                logger.warning('Retrying request to {0}: {1}'.format(url, response.status_code))
+
+    def get_timeout(self, timeout=None):
+        "Return the (connect, read) timeout for the next request limited by the deadline."
+        if timeout is None:
+            timeout = (
+                get_provider_option(self.provider, 'connect_timeout'),
+                get_provider_option(self.provider, 'read_timeout'),
+            )
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        if self.deadline is None:
+            return timeout
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise Timeout('Deadline exceeded before request to the provider.')
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+
+    def get_retry_delay(self, attempt):
+        "Seconds to wait before the next retry or None if there is no time left to retry."
+        backoff = get_provider_option(self.provider, 'retry_backoff')
+        # Full jitter to spread out the retries from concurrent requests
+        delay = random.uniform(0, backoff * 2 ** attempt)
+        if self.deadline is not None and time.time() + delay >= self.deadline:
+            return None
+        return delay
+
+    def wait_for_retry(self, attempt):
+        "Sleep before the next retry. Returns False if there is no time left to retry."
+        delay = self.get_retry_delay(attempt)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    @property
+    def breaker(self):
+        "Circuit breaker tracking the health of the provider."
+        return CircuitBreaker(self.provider)
+
+    @property
+    def state_store(self):
+        "Storage for the flow state between the redirect and the callback."
+        return get_state_store()
+
+    @property
+    def http_session(self):
+        "Pooled HTTP session shared by all clients for this provider."
+        return get_session(self.provider)
 
     @property
     def session_key(self):
@@ -64,9 +278,17 @@ class BaseOAuthClient(object):
 
 class OAuthClient(BaseOAuthClient):
 
+    def get_callback_key(self, request):
+        "Stored request token and returned verifier."
+        raw_token = self.state_store.get(request, self.session_key)
+        verifier = request.GET.get('oauth_verifier', None)
+        if raw_token is None or verifier is None:
+            return None
+        return (raw_token, verifier)
+
     def get_access_token(self, request, callback=None):
         "Fetch access token from callback request."
-        raw_token = request.session.get(self.session_key, None)
+        raw_token = self.state_store.get(request, self.session_key)
         verifier = request.GET.get('oauth_verifier', None)
         if raw_token is not None and verifier is not None:
             data = {'oauth_verifier': verifier}
@@ -102,12 +324,16 @@ class OAuthClient(BaseOAuthClient):
         raw_token = self.get_request_token(request, callback)
         token, secret = self.parse_raw_token(raw_token)
         if token is not None and secret is not None:
-            request.session[self.session_key] = raw_token
+            self.state_store.set(request, self.session_key, raw_token)
         return {
             'oauth_token': token,
             'oauth_callback': callback,
         }
 
+    def get_token_data(self, raw_token):
+        "Parse the raw token response as a query string."
+        return {k: v[0] for k, v in parse_qs(raw_token).items()}
+
     def parse_raw_token(self, raw_token):
         "Parse token and secret from raw token response."
         if raw_token is None:
@@ -119,20 +345,33 @@ class OAuthClient(BaseOAuthClient):
 
     def request(self, method, url, **kwargs):
         "Build remote url request. Constructs necessary auth."
-        user_token = kwargs.pop('token', self.token)
-        token, secret = self.parse_raw_token(user_token)
+        token = self.get_token(kwargs.pop('token', None))
         callback = kwargs.pop('oauth_callback', None)
         verifier = kwargs.get('data', {}).pop('oauth_verifier', None)
+        kwargs['auth'] = self.get_signer(token, verifier=verifier, callback=callback)
+        return super(OAuthClient, self).request(method, url, **kwargs)
+
+    def get_signer(self, token, verifier=None, callback=None):
+        "Return the OAuth1 auth for the token. Signers for API requests are reused."
+        key = (
+            self.provider.consumer_key, self.provider.consumer_secret,
+            token.access_token, token.secret,
+        )
+        if verifier is None and callback is None:
+            cached = self._signer
+            if cached is not None and cached[0] == key:
+                return cached[1]
         oauth = OAuth1(
-            resource_owner_key=token,
-            resource_owner_secret=secret,
+            resource_owner_key=token.access_token,
+            resource_owner_secret=token.secret,
             client_key=self.provider.consumer_key,
             client_secret=self.provider.consumer_secret,
             verifier=verifier,
             callback_uri=callback,
         )
-        kwargs['auth'] = oauth
-        return super(OAuthClient, self).request(method, url, **kwargs)
+        if verifier is None and callback is None:
+            self._signer = (key, oauth)
+        return oauth
 
     @property
     def session_key(self):
@@ -143,7 +382,7 @@ class OAuth2Client(BaseOAuthClient):
 
     def check_application_state(self, request, callback):
         "Check optional state parameter."
-        stored = request.session.get(self.session_key, None)
+        stored = self.state_store.get(request, self.session_key)
         returned = request.GET.get('state', None)
         check = False
         if stored is not None:
@@ -152,9 +391,17 @@ class OAuth2Client(BaseOAuthClient):
             else:
                 logger.error('No state parameter returned by the provider.')
         else:
-            logger.error('No state stored in the sesssion.')
+            logger.error('No state stored for the request.')
         return check
 
+    def get_callback_key(self, request):
+        "Stored state, returned state and code."
+        stored = self.state_store.get(request, self.session_key)
+        code = request.GET.get('code', None)
+        if stored is None or code is None:
+            return None
+        return (stored, request.GET.get('state', ''), code)
+
     def get_access_token(self, request, callback=None):
         "Fetch access token from callback request."
         callback = request.build_absolute_uri(callback or request.path)
@@ -181,6 +428,40 @@ class OAuth2Client(BaseOAuthClient):
         else:
             return response.text
 
+    def refresh_access_token(self, raw_token=None):
+        "Fetch a new access token with the refresh token (default: from the client token)."
+        token = self.get_token(raw_token)
+        if token.refresh_token is None:
+            logger.error('No refresh token for {0}.'.format(self.provider.name))
+            return None
+        args = {
+            'client_id': self.provider.consumer_key,
+            'client_secret': self.provider.consumer_secret,
+            'refresh_token': token.refresh_token,
+            'grant_type': 'refresh_token',
+        }
+        try:
+            response = self.request('post', self.provider.access_token_url, data=args, token='')
+            response.raise_for_status()
+        except RequestException as e:
+            logger.error('Unable to refresh access token: {0}'.format(e))
+            return None
+        else:
+            return self.update_refreshed_token(raw_token, token, response.text)
+
+    def update_refreshed_token(self, raw_token, token, refreshed):
+        "Keep the refresh token if the provider did not return a new one."
+        if self.get_token(refreshed).access_token is None:
+            logger.error('No access token in the refresh response.')
+            return None
+        if self.get_token(refreshed).refresh_token is None:
+            token_data = self.get_token_data(refreshed)
+            token_data['refresh_token'] = token.refresh_token
+            refreshed = json.dumps(token_data)
+        if raw_token is None:
+            self.token = refreshed
+        return refreshed
+
     def get_application_state(self, request, callback):
         "Generate state optional parameter."
         return get_random_string(32)
@@ -196,27 +477,46 @@ class OAuth2Client(BaseOAuthClient):
         state = self.get_application_state(request, callback)
         if state is not None:
             args['state'] = state
-            request.session[self.session_key] = state
+            self.state_store.set(request, self.session_key, state)
         return args
 
+    def get_token_data(self, raw_token):
+        "Load the raw token response as json first then parse as query string."
+        try:
+            token_data = json.loads(raw_token)
+        except ValueError:
+            return {k: v[0] for k, v in parse_qs(raw_token).items()}
+        return token_data if isinstance(token_data, dict) else {}
+
     def parse_raw_token(self, raw_token):
         "Parse token and secret from raw token response."
         if raw_token is None:
             return (None, None)
-        # Load as json first then parse as query string
-        try:
-            token_data = json.loads(raw_token)
-        except ValueError:
-            qs = parse_qs(raw_token)
-            token = qs.get('access_token', [None])[0]
-        else:
-            token = token_data.get('access_token', None)
+        token = self.get_token_data(raw_token).get('access_token', None)
         return (token, None)
 
+    def parse_token(self, raw_token):
+        "Parse the raw token response into a Token including the refresh token, expiry and scopes."
+        token = super(OAuth2Client, self).parse_token(raw_token)
+        if raw_token:
+            token_data = self.get_token_data(raw_token)
+            token.refresh_token = token_data.get('refresh_token', None)
+            try:
+                expires_in = int(token_data.get('expires_in', token_data.get('expires')))
+            except (TypeError, ValueError):
+                pass
+            else:
+                token.expires_at = timezone.now() + timedelta(seconds=expires_in)
+            scope = token_data.get('scope', None)
+            if isinstance(scope, list):
+                token.scopes = tuple(scope)
+            elif scope:
+                token.scopes = tuple(s for s in re.split(r'[\s,]+', scope) if s)
+        return token
+
     def request(self, method, url, **kwargs):
         "Build remote url request. Constructs necessary auth."
-        user_token = kwargs.pop('token', self.token)
-        token, _ = self.parse_raw_token(user_token)
+        token = self.get_token(kwargs.pop('token', None)).access_token
         if token is not None:
             params = kwargs.get('params', {})
             params['access_token'] = token
@@ -233,4 +533,7 @@ def get_client(provider, token=''):
     cls = OAuth2Client
     if provider.request_token_url:
         cls = OAuthClient
+    elif get_provider_option(provider, 'oidc_issuer'):
+        from .oidc import OIDCClient
+        cls = OIDCClient
     return cls(provider, token)
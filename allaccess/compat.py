@@ -20,3 +20,18 @@ try:  # pragma: no cover
     from unittest.mock import patch, Mock
 except ImportError:
     from mock import patch, Mock
+
+
+try:
+    from django.db.transaction import on_commit
+except ImportError:  # pragma: no cover
+    # Django 1.8
+    def on_commit(func, using=None):
+        func()
+
+
+try:  # pragma: no cover
+    from django.db.models.query_utils import deferred_class_factory
+except ImportError:
+    # Django 1.10+ builds deferred instances without a dynamic class
+    deferred_class_factory = None
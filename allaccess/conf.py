@@ -0,0 +1,54 @@
+"Default options and per-provider overrides."
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+
+DEFAULT_OPTIONS = {
+    # Connection pooling for outbound provider requests
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    'pool_block': False,
+    'keep_alive': True,
+    # Timeouts (in seconds) and retries for provider requests
+    'connect_timeout': 5,
+    'read_timeout': 10,
+    'retries': 2,
+    'retry_backoff': 0.5,
+    'callback_deadline': 30,
+    # Circuit breaker for providers which are failing or slow
+    'breaker_enabled': False,
+    'breaker_failure_ratio': 0.5,
+    'breaker_min_requests': 20,
+    'breaker_window': 60,
+    'breaker_reset_timeout': 30,
+    'breaker_slow_call': 10,
+    # Duplicate callbacks wait for the first token exchange instead of repeating it
+    'single_flight': False,
+    'single_flight_timeout': 30,
+    # Dotted path to the user's identifier in the token response
+    'token_identifier': None,
+    # Login before the profile is fetched and send profile_enriched from the executor
+    'defer_profile': False,
+    # OpenID Connect id_token verification
+    'oidc_issuer': None,
+    'oidc_leeway': 60,
+    'oidc_cache_timeout': 3600,
+    'oidc_refresh_interval': 60,
+}
+
+
+def get_provider_option(provider, name):
+    """
+    Return the configured option for the given provider.
+
+    Options are read from the ``ALLACCESS_PROVIDER_OPTIONS`` setting which maps
+    provider names to a dictionary of options. The ``default`` key applies to
+    all providers which do not override the option.
+    """
+    options = getattr(settings, 'ALLACCESS_PROVIDER_OPTIONS', {})
+    provider_name = getattr(provider, 'name', provider)
+    for key in (provider_name, 'default'):
+        if name in options.get(key, {}):
+            return options[key][name]
+    return DEFAULT_OPTIONS[name]
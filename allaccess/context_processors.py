@@ -1,9 +1,11 @@
 "Helpers to add provider and account access information to the template context."
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.utils.functional import SimpleLazyObject
 
-from .compat import APPENGINE 
+from .breaker import CircuitBreaker
+from .compat import APPENGINE
 from .models import Provider
 
 
@@ -13,6 +15,11 @@ def _get_enabled():
     return [p for p in providers if p.enabled()]
 
 
+def _get_available(providers):
+    """Wrapped function for filtering providers with an open circuit breaker."""
+    return [p for p in providers if not CircuitBreaker(p).is_open()]
+
+
 def available_providers(request):
     "Adds the list of enabled providers to the context."
     if APPENGINE:
@@ -24,4 +31,7 @@ def available_providers(request):
         qs = SimpleLazyObject(lambda: _get_enabled())
     else:
         qs = Provider.objects.filter(consumer_secret__isnull=False, consumer_key__isnull=False)
+    if getattr(settings, 'ALLACCESS_HIDE_UNAVAILABLE_PROVIDERS', False):
+        # Drop providers with an open circuit breaker when the list is used
+        qs = SimpleLazyObject(lambda providers=qs: _get_available(providers))
     return {'allaccess_providers': qs}
@@ -1,38 +1,107 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import base64
 import binascii
+import hashlib
 import hmac
+import os
+from collections import OrderedDict
 
+from django.apps import apps
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.db import models
+from django.dispatch import receiver
 from django.utils.crypto import constant_time_compare
 from django.utils.encoding import force_bytes, force_text
+from django.utils.functional import SimpleLazyObject, empty
 
 try:
     import Crypto.Cipher.AES
 except ImportError:  # pragma: no cover
     raise ImportError('PyCrypto is required to use django-all-access.')
 
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # pragma: no cover
+    AESGCM = None
+
 
 class SignatureException(Exception):
     pass
 
 
-class SignedAESEncryption(object):
+class BaseEncryption(object):
+    "Common handling of the keyring, stored prefix and the encoding of binary values."
+    prefix = None
+    #: text encoding of binary values, hex or base64 (default: hex)
+    encoding = 'hex'
+    #: prefix suffix which identifies each encoding
+    encodings = {'hex': b'', 'base64': b'64'}
+    #: the libraries needed to encrypt and decrypt values are installed
+    available = True
+
+    def __init__(self, *args, **kwargs):
+        encoding = kwargs.get('encoding') or self.encoding
+        if encoding not in self.encodings:
+            raise ImproperlyConfigured('Unknown encoding {0}.'.format(encoding))
+        self.encoding = encoding
+        self.prefix = self.prefix + self.encodings[encoding]
+        #: keys derived from each secret by key id, starting with the current key
+        self.keys = OrderedDict()
+        for secret in self.get_secrets():
+            key = self.get_key(secret)
+            self.keys[self.get_key_id(key)] = key
+        self.key_id, self.key = next(iter(self.keys.items()))
+
+    def get_secrets(self):
+        "Secrets for the keyring. The first is used for new values."
+        return getattr(settings, 'ALLACCESS_SECRET_KEYS', None) or [settings.SECRET_KEY]
+
+    def get_key(self, secret=None):
+        raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
+
+    def get_key_id(self, key):
+        return force_bytes(hashlib.sha256(key).hexdigest()[:8])
+
+    def is_encrypted(self, value):
+        return value.startswith(self.prefix + b'$')
+
+    def is_current(self, value):
+        "Check if the value is encrypted in this format with the current key."
+        raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
+
+    def encode(self, value):
+        if self.encoding == 'base64':
+            return base64.urlsafe_b64encode(value).rstrip(b'=')
+        return binascii.b2a_hex(value)
+
+    def decode(self, value):
+        if self.encoding == 'base64':
+            return base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4))
+        return binascii.a2b_hex(value)
+
+
+class SignedAESEncryption(BaseEncryption):
     cipher_class = Crypto.Cipher.AES
     prefix = b'$AES'
     #: enable hmac signature of cypher text with the same key (default: True)
     sign = True
 
     def __init__(self, *args, **kwargs):
-        self.cipher = self.cipher_class.new(self.get_key())
+        super(SignedAESEncryption, self).__init__(*args, **kwargs)
+        self.ciphers = {key_id: self.cipher_class.new(key) for key_id, key in self.keys.items()}
+        self.cipher = self.ciphers[self.key_id]
 
-    def get_key(self):
-        return force_bytes(settings.SECRET_KEY.zfill(32))[:32]
+    def get_key(self, secret=None):
+        secret = settings.SECRET_KEY if secret is None else secret
+        return force_bytes(secret.zfill(32))[:32]
 
-    def get_signature(self, value):
-        return force_bytes(hmac.new(self.get_key(), value).hexdigest())
+    def get_signature(self, value, key=None):
+        return self.encode(hmac.new(key or self.key, value).digest())
 
     def get_padding(self, value):
         # We always want at least 2 chars of padding (including zero byte),
@@ -53,28 +122,42 @@ class SignedAESEncryption(object):
             parts.insert(2, None)
         return parts
 
-    def is_encrypted(self, value):
-        return value.startswith(self.prefix)
-
     def is_signed(self, value):
         #: value consists of 3 or 4 $ separated parts, check for mac in 2nd
         _, prefix, mac, cypher_text = self.split_value(value)
         return mac is not None
 
+    def is_current(self, value):
+        if not self.is_encrypted(value):
+            return False
+        _, prefix, mac, cypher_text = self.split_value(value)
+        if not self.sign:
+            return True
+        return mac is not None and constant_time_compare(self.get_signature(cypher_text), mac)
+
+    def get_signing_key_id(self, mac, cypher_text):
+        "Find the key in the keyring which signed the cypher text."
+        for key_id, key in self.keys.items():
+            if constant_time_compare(self.get_signature(cypher_text, key), mac):
+                return key_id
+        return None
+
     def decrypt(self, cypher_text):
         _, prefix, mac, cypher_text = self.split_value(cypher_text)
-        if self.sign and mac and \
-                not constant_time_compare(self.get_signature(cypher_text), mac):
-            raise SignatureException(
-                'EncryptedField cannot be decrypted. '
-                'Did settings.SECRET_KEY change?'
-            )
-        cypher_text = binascii.a2b_hex(cypher_text)
-        return self.cipher.decrypt(cypher_text).split(b'\x00')[0]
+        key_id = self.key_id
+        if self.sign and mac:
+            key_id = self.get_signing_key_id(mac, cypher_text)
+            if key_id is None:
+                raise SignatureException(
+                    'EncryptedField cannot be decrypted. '
+                    'Did settings.SECRET_KEY change?'
+                )
+        cypher_text = self.decode(cypher_text)
+        return self.ciphers[key_id].decrypt(cypher_text).split(b'\x00')[0]
 
     def encrypt(self, clear_text):
         clear_text = self.add_padding(clear_text)
-        cypher_text = binascii.b2a_hex(self.cipher.encrypt(clear_text))
+        cypher_text = self.encode(self.cipher.encrypt(clear_text))
         parts = [self.prefix]
         if self.sign:
             parts.append(self.get_signature(cypher_text))
@@ -82,32 +165,203 @@ class SignedAESEncryption(object):
         return b'$'.join(parts)
 
 
+class AESGCMEncryption(BaseEncryption):
+    """
+    Authenticated AES-GCM encryption using the cryptography library.
+
+    Values are stored as the prefix and the id of the key followed by the
+    encoded nonce, cypher text and authentication tag.
+    """
+    prefix = b'$GCM'
+    nonce_size = 12
+    available = AESGCM is not None
+
+    def __init__(self, *args, **kwargs):
+        super(AESGCMEncryption, self).__init__(*args, **kwargs)
+        # Without cryptography the values are still recognized but cannot be read or written
+        self.ciphers = {key_id: AESGCM(key) for key_id, key in self.keys.items()} if self.available else {}
+        self.cipher = self.ciphers.get(self.key_id)
+
+    def check_available(self):
+        if not self.available:
+            raise ImproperlyConfigured('cryptography is required for AES-GCM encrypted values.')
+
+    def get_key(self, secret=None):
+        secret = settings.SECRET_KEY if secret is None else secret
+        return hmac.new(
+            force_bytes(secret), b'allaccess.fields.AESGCMEncryption', hashlib.sha256
+        ).digest()
+
+    def split_value(self, value):
+        #: split value from database into _, prefix, key_id, cypher_text
+        parts = value.split(b'$')
+        if len(parts) == 3:
+            # Saved before key ids were added
+            parts.insert(2, None)
+        return parts
+
+    def is_current(self, value):
+        if not self.is_encrypted(value):
+            return False
+        _, prefix, key_id, cypher_text = self.split_value(value)
+        return key_id == self.key_id
+
+    def decrypt(self, cypher_text):
+        self.check_available()
+        _, prefix, key_id, cypher_text = self.split_value(cypher_text)
+        cypher_text = self.decode(cypher_text)
+        nonce, cypher_text = cypher_text[:self.nonce_size], cypher_text[self.nonce_size:]
+        key_ids = [key_id] if key_id is not None else list(self.ciphers)
+        for key_id in key_ids:
+            if key_id in self.ciphers:
+                try:
+                    return self.ciphers[key_id].decrypt(nonce, cypher_text, self.prefix)
+                except InvalidTag:
+                    pass
+        raise SignatureException(
+            'EncryptedField cannot be decrypted. '
+            'Did settings.SECRET_KEY change?'
+        )
+
+    def encrypt(self, clear_text):
+        self.check_available()
+        nonce = os.urandom(self.nonce_size)
+        cypher_text = self.encode(nonce + self.cipher.encrypt(nonce, clear_text, self.prefix))
+        return b'$'.join([self.prefix, self.key_id, cypher_text])
+
+
+class LazyDecryptedText(SimpleLazyObject):
+    "Text value which is only decrypted when it is first used."
+
+    def __init__(self, cipher, cypher_text):
+        self.__dict__['cypher_text'] = cypher_text
+        super(LazyDecryptedText, self).__init__(lambda: force_text(cipher.decrypt(cypher_text)))
+
+    def __getattr__(self, name):
+        # The ORM probes values for these hooks when saving. Text never has
+        # them so answer without decrypting.
+        if name in ('resolve_expression', 'prepare_database_save'):
+            raise AttributeError(name)
+        return super(LazyDecryptedText, self).__getattr__(name)
+
+    @property
+    def is_decrypted(self):
+        return self._wrapped is not empty
+
+    @property
+    def decrypted(self):
+        "Decrypted text. force_text returns the lazy object itself on Django 1.8."
+        if self._wrapped is empty:
+            self._setup()
+        return self._wrapped
+
+
+def decrypted_text(value):
+    "Return an encrypted field value as text, decrypting it first if it is lazy."
+    if isinstance(value, LazyDecryptedText):
+        return value.decrypted
+    return force_text(value)
+
+
 class EncryptedField(models.TextField):
     """
     This code is based on http://www.djangosnippets.org/snippets/1095/
     and django-fields https://github.com/svetlyak40wt/django-fields
     """
-    encryption_class = SignedAESEncryption
+    #: formats which can be used to save values by the name used in ALLACCESS_ENCRYPTION_FORMAT
+    encryption_formats = {'aes': SignedAESEncryption, 'gcm': AESGCMEncryption}
+    #: additional formats which can be read from the database
+    decryption_classes = (SignedAESEncryption, AESGCMEncryption)
 
     def __init__(self, *args, **kwargs):
-        self.cipher = self.encryption_class()
+        #: defer decryption until the value is used (default: False)
+        self.lazy = kwargs.pop('lazy', False)
+        #: text encoding of the stored cypher text, hex or base64 (default: ALLACCESS_ENCRYPTION_ENCODING)
+        self._encoding = kwargs.pop('encoding', None)
+        self.setup_ciphers()
         super(EncryptedField, self).__init__(*args, **kwargs)
 
+    @property
+    def encoding(self):
+        "Encoding used when saving values (default: hex)."
+        return self._encoding or getattr(settings, 'ALLACCESS_ENCRYPTION_ENCODING', 'hex')
+
+    @property
+    def encryption_class(self):
+        "Format used when saving values (default: aes)."
+        name = getattr(settings, 'ALLACCESS_ENCRYPTION_FORMAT', 'aes')
+        if name not in self.encryption_formats:
+            raise ImproperlyConfigured('Unknown ALLACCESS_ENCRYPTION_FORMAT {0}.'.format(name))
+        cls = self.encryption_formats[name]
+        if not cls.available:
+            raise ImproperlyConfigured(
+                'cryptography is required for ALLACCESS_ENCRYPTION_FORMAT {0}.'.format(name))
+        return cls
+
+    def setup_ciphers(self):
+        "Build the ciphers for saving and reading values from the current keyring."
+        encryption_class = self.encryption_class
+        self.cipher = encryption_class(encoding=self.encoding)
+        self.ciphers = [self.cipher]
+        classes = (encryption_class, ) + tuple(c for c in self.decryption_classes if c is not encryption_class)
+        for cls in classes:
+            for encoding in cls.encodings:
+                if cls is not encryption_class or encoding != self.encoding:
+                    self.ciphers.append(cls(encoding=encoding))
+
+    def get_cipher(self, value):
+        "Return the cipher which encrypted the value or None if it is not encrypted."
+        for cipher in self.ciphers:
+            if cipher.is_encrypted(value):
+                return cipher
+        return None
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(EncryptedField, self).deconstruct()
+        if self.lazy:
+            kwargs['lazy'] = True
+        if self._encoding is not None:
+            kwargs['encoding'] = self._encoding
+        return name, path, args, kwargs
+
     def from_db_value(self, value, expression, connection, context):
         if value is None:
             return value
         value = force_bytes(value)
-        if self.cipher.is_encrypted(value):
-            return force_text(self.cipher.decrypt(value))
+        cipher = self.get_cipher(value)
+        if cipher is not None:
+            if self.lazy:
+                return LazyDecryptedText(cipher, value)
+            return force_text(cipher.decrypt(value))
         return force_text(value)
 
+    def value_to_string(self, obj):
+        "Decrypted text for serialization."
+        value = self.value_from_object(obj)
+        return None if value is None else decrypted_text(value)
+
     def get_db_prep_value(self, value, connection=None, prepared=False):
+        if isinstance(value, LazyDecryptedText) and not value.is_decrypted:
+            if self.cipher.is_current(value.cypher_text):
+                # Unchanged value from the database can be saved as is
+                return force_text(value.cypher_text)
         if self.null:
             # Normalize empty values to None
             value = value or None
         if value is None:
             return None
         value = force_bytes(value)
-        if not self.cipher.is_encrypted(value):
+        if self.get_cipher(value) is None:
             value = self.cipher.encrypt(value)
         return force_text(value)
+
+
+@receiver(setting_changed)
+def reset_ciphers(setting, **kwargs):
+    "Rebuild the field ciphers when the keys are changed (i.e. in tests)."
+    if setting in (
+            'SECRET_KEY', 'ALLACCESS_SECRET_KEYS', 'ALLACCESS_ENCRYPTION_FORMAT', 'ALLACCESS_ENCRYPTION_ENCODING'):
+        for model in apps.get_models():
+            for field in model._meta.fields:
+                if isinstance(field, EncryptedField):
+                    field.setup_ciphers()
@@ -0,0 +1,88 @@
+"Coalescing of duplicate callbacks for the same authorization response."
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.encoding import force_bytes, force_text
+
+from .conf import get_provider_option
+from .fields import decrypted_text
+from .models import AccountAccess
+
+
+logger = logging.getLogger('allaccess.flight')
+
+
+class SingleFlight(object):
+    """
+    Run a call once for concurrent requests with the same key.
+
+    The first request takes a lock in the Django cache and stores its result.
+    Duplicate requests, such as a double-clicked or retried callback, wait for
+    that result instead of sending the same code to the provider again. Results
+    are encrypted with the access token cipher while they are in the cache.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, provider, *parts):
+        self.provider = provider
+        digest = hashlib.sha256(force_bytes('\n'.join(force_text(p) for p in parts))).hexdigest()
+        self.key = 'allaccess-flight-{0}-{1}'.format(provider.name, digest)
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'ALLACCESS_FLIGHT_CACHE', 'default')]
+
+    @property
+    def timeout(self):
+        "Seconds to hold the lock, wait for the result and keep the result."
+        return get_provider_option(self.provider, 'single_flight_timeout')
+
+    @property
+    def field(self):
+        return AccountAccess._meta.get_field('access_token')
+
+    def run(self, func, deadline=None):
+        "Return the result of the call from this request or the one already running."
+        # Do not wait past the deadline for the callback requests
+        wait_until = time.time() + self.timeout
+        if deadline is not None:
+            wait_until = min(wait_until, deadline)
+        while True:
+            if self.cache.add(self.key + '-lock', 1, self.timeout):
+                return self.lead(func)
+            entry = self.cache.get(self.key + '-result')
+            if entry is not None:
+                logger.info('Reusing token exchange for duplicate {0} callback.'.format(self.provider.name))
+                return self.decode(entry[0])
+            remaining = wait_until - time.time()
+            if remaining <= 0:
+                logger.warning('Timed out waiting for duplicate {0} callback.'.format(self.provider.name))
+                return func()
+            time.sleep(min(self.poll_interval, remaining))
+
+    def lead(self, func):
+        "Make the call and store the result for the waiting requests."
+        try:
+            result = func()
+        except Exception:
+            # Let a waiting request try again
+            self.cache.delete(self.key + '-lock')
+            raise
+        self.cache.set(self.key + '-result', (self.encode(result), ), self.timeout)
+        return result
+
+    def encode(self, value):
+        if value is None:
+            return None
+        return self.field.get_db_prep_value(value)
+
+    def decode(self, value):
+        if value is None:
+            return None
+        return decrypted_text(self.field.from_db_value(value, None, None, None))
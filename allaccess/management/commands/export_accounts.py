@@ -0,0 +1,56 @@
+"Stream access records to a JSON Lines or CSV file."
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...transfer import export_records, get_format, open_file, write_csv, write_jsonl
+
+
+class OutputStream(object):
+    "File-like wrapper which writes to the command output without adding line endings."
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, data):
+        self.out.write(data, ending='')
+
+
+class Command(BaseCommand):
+    help = 'Export AccountAccess records to JSON Lines or CSV in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default=None,
+            help='File to write. Defaults to standard output.')
+        parser.add_argument(
+            '--format', choices=['jsonl', 'csv'], default=None,
+            help='Output format. Defaults to the file extension or jsonl.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000, dest='chunk_size',
+            help='Number of records fetched in each query.')
+        parser.add_argument(
+            '--provider', action='append', dest='providers', default=None,
+            help='Only export records for the named provider. Can be repeated.')
+        parser.add_argument(
+            '--users', action='store_true', default=False,
+            help='Export the username rather than the id of the user.')
+        parser.add_argument(
+            '--decrypt', action='store_true', default=False,
+            help='Export the access tokens as plain text.')
+        parser.add_argument(
+            '--database', default=None,
+            help='Database to export from.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        writer = write_csv if (options['format'] or get_format(path)) == 'csv' else write_jsonl
+        records = export_records(
+            providers=options['providers'], users=options['users'], decrypt=options['decrypt'],
+            chunk_size=options['chunk_size'], using=options['database'])
+        if path is None:
+            writer(OutputStream(self.stdout), records)
+            return
+        with open_file(path, 'w') as stream:
+            count = writer(stream, records)
+        self.stdout.write('Exported {0} records.'.format(count))
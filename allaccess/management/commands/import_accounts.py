@@ -0,0 +1,72 @@
+"Load access records from a file or the tables of another authentication library."
+from __future__ import unicode_literals
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...transfer import (
+    Importer, get_format, open_file, read_allauth, read_csv, read_jsonl, read_social_auth)
+
+
+class Command(BaseCommand):
+    help = 'Import AccountAccess records from JSON Lines, CSV, python-social-auth or django-allauth in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default=None,
+            help='File to read. Use - for standard input.')
+        parser.add_argument(
+            '--format', choices=['jsonl', 'csv'], default=None,
+            help='Input format. Defaults to the file extension or jsonl.')
+        parser.add_argument(
+            '--source', choices=['file', 'social_auth', 'allauth'], default='file',
+            help='Read from a file or from the tables of python-social-auth or django-allauth.')
+        parser.add_argument(
+            '--table', default='social_auth_usersocialauth',
+            help='Table name for the python-social-auth source.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000, dest='chunk_size',
+            help='Number of records loaded in each transaction.')
+        parser.add_argument(
+            '--update', action='store_true', default=False,
+            help='Update the tokens of existing records rather than skipping them.')
+        parser.add_argument(
+            '--users', action='store_true', default=False,
+            help='Match users by username rather than id.')
+        parser.add_argument(
+            '--create-users', action='store_true', default=False, dest='create_users',
+            help='Create users for unknown usernames. Implies --users.')
+        parser.add_argument(
+            '--provider-map', action='append', dest='provider_map', default=[],
+            help='Load records for one provider name as another, i.e. google-oauth2=google. Can be repeated.')
+        parser.add_argument(
+            '--database', default=None,
+            help='Database to import into and read the source tables from.')
+
+    def handle(self, *args, **options):
+        try:
+            provider_map = dict(item.split('=', 1) for item in options['provider_map'])
+        except ValueError:
+            raise CommandError('Provider maps must be given as source=name.')
+        importer = Importer(
+            chunk_size=options['chunk_size'], update=options['update'],
+            users=options['users'] or options['create_users'], create_users=options['create_users'],
+            provider_map=provider_map, using=options['database'])
+        source = options['source']
+        if source == 'social_auth':
+            stats = importer.run(read_social_auth(
+                chunk_size=options['chunk_size'], using=importer.using, table=options['table']))
+        elif source == 'allauth':
+            stats = importer.run(read_allauth(chunk_size=options['chunk_size'], using=importer.using))
+        else:
+            path = options['path']
+            if path is None:
+                raise CommandError('A file or - is required to import from a file.')
+            reader = read_csv if (options['format'] or get_format(path)) == 'csv' else read_jsonl
+            if path == '-':
+                stats = importer.run(reader(sys.stdin))
+            else:
+                with open_file(path) as stream:
+                    stats = importer.run(reader(stream))
+        self.stdout.write('Created {created} records, updated {updated}, skipped {skipped}.'.format(**stats))
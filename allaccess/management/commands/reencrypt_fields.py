@@ -0,0 +1,124 @@
+"Re-encrypt stored values with the current key and format."
+from __future__ import unicode_literals
+
+import json
+import os
+from multiprocessing import Pool
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections, models, transaction
+from django.utils.encoding import force_bytes
+
+from ...fields import EncryptedField, decrypted_text
+
+
+def get_encrypted_fields(model):
+    "Return the encrypted fields for the model."
+    return [f for f in model._meta.concrete_fields if isinstance(f, EncryptedField)]
+
+
+def get_label(model):
+    return '{0}.{1}'.format(model._meta.app_label, model._meta.object_name)
+
+
+def reencrypt_chunk(args):
+    "Re-encrypt all outdated values for the model in the range of primary keys."
+    label, start, end = args
+    model = apps.get_model(label)
+    fields = get_encrypted_fields(model)
+    aliases = ['raw_{0}'.format(f.attname) for f in fields]
+    select = dict(zip(aliases, [f.column for f in fields]))
+    manager = model._base_manager
+    updates = dict((f.attname, []) for f in fields)
+    pks = set()
+    with transaction.atomic(using=manager.db):
+        # Rows are locked until the UPDATE so values saved in the meantime are not overwritten
+        rows = manager.filter(pk__gte=start, pk__lt=end).select_for_update().extra(
+            select=select).values_list('pk', *aliases)
+        for row in rows:
+            for field, value in zip(fields, row[1:]):
+                if value is None or field.cipher.is_current(force_bytes(value)):
+                    continue
+                clear_text = decrypted_text(field.from_db_value(value, None, None, {}))
+                value = field.get_db_prep_value(clear_text)
+                updates[field.attname].append(models.When(pk=row[0], then=models.Value(value)))
+                pks.add(row[0])
+        if pks:
+            # Single UPDATE for the chunk with a CASE per changed column
+            changed = dict(
+                (name, models.Case(*whens, default=models.F(name), output_field=models.TextField()))
+                for name, whens in updates.items() if whens
+            )
+            manager.filter(pk__in=pks).update(**changed)
+    return label, end, len(pks)
+
+
+class Command(BaseCommand):
+    help = 'Re-encrypt Provider and AccountAccess values with the current key and format.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000, dest='chunk_size',
+            help='Number of primary keys in each chunk.')
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Number of worker processes.')
+        parser.add_argument(
+            '--state-file', default=None, dest='state_file',
+            help='File used to record progress so an interrupted run can be resumed.')
+
+    def handle(self, *args, **options):
+        self.state_file = options['state_file']
+        self.state = self.load_state()
+        chunk_size = options['chunk_size']
+        processes = options['processes']
+        pool = None
+        if processes > 1:
+            # Each worker opens its own database connection
+            connections.close_all()
+            pool = Pool(processes, initializer=django.setup)
+        try:
+            for model in apps.get_app_config('allaccess').get_models():
+                if not get_encrypted_fields(model):
+                    continue
+                label = get_label(model)
+                chunks = self.get_chunks(model, chunk_size)
+                if pool is None:
+                    results = map(reencrypt_chunk, chunks)
+                else:
+                    # Results are returned in order so the progress only moves past completed chunks
+                    results = pool.imap(reencrypt_chunk, chunks)
+                total = 0
+                for _, end, count in results:
+                    total += count
+                    self.state[label] = end
+                    self.save_state()
+                self.stdout.write('{0}: re-encrypted {1} rows.'.format(label, total))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def get_chunks(self, model, chunk_size):
+        "Split the table into ranges of primary keys starting from the last completed chunk."
+        bounds = model._base_manager.aggregate(low=models.Min('pk'), high=models.Max('pk'))
+        if bounds['high'] is None:
+            return []
+        start = max(bounds['low'], self.state.get(get_label(model), bounds['low']))
+        return [
+            (get_label(model), low, low + chunk_size)
+            for low in range(start, bounds['high'] + 1, chunk_size)
+        ]
+
+    def load_state(self):
+        if self.state_file and os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                return json.load(f)
+        return {}
+
+    def save_state(self):
+        if self.state_file:
+            with open(self.state_file, 'w') as f:
+                json.dump(self.state, f)
@@ -0,0 +1,104 @@
+"Refresh OAuth 2.0 access tokens before they expire."
+from __future__ import unicode_literals
+
+import threading
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from ...clients import get_client
+from ...fields import decrypted_text
+from ...models import AccountAccess, Provider
+
+
+class Command(BaseCommand):
+    help = 'Refresh access tokens which expire within the window using the refresh token grant.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window', type=int, default=600,
+            help='Refresh tokens which expire within this many seconds.')
+        parser.add_argument(
+            '--max-expired', type=int, default=3600, dest='max_expired',
+            help='Skip tokens which expired more than this many seconds ago.')
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help='Number of concurrent refresh requests for each provider.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000, dest='chunk_size',
+            help='Number of tokens read at a time.')
+        parser.add_argument(
+            '--provider', action='append', dest='providers', default=None,
+            help='Only refresh tokens for the named provider. Can be repeated.')
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        providers = self.get_providers(options['providers'])
+        if not providers:
+            self.stdout.write('Refreshed 0 tokens, 0 failed.')
+            return
+        now = timezone.now()
+        field = AccountAccess._meta.get_field('access_token')
+        column = connections[AccountAccess.objects.db].ops.quote_name(field.column)
+        # Tokens which could not be refreshed drop out once they are past the lower bound
+        accesses = AccountAccess.objects.filter(
+            provider__in=providers,
+            expires_at__lte=now + timedelta(seconds=options['window']),
+            expires_at__gte=now - timedelta(seconds=options['max_expired']),
+        ).extra(select={'raw_token': column}).order_by('pk').values_list('pk', 'provider', 'raw_token')
+        limits = dict((pk, threading.BoundedSemaphore(concurrency)) for pk in providers)
+
+        def refresh(task):
+            provider, pk, stored, raw_token = task
+            with limits[provider.pk]:
+                client = get_client(provider, raw_token)
+                refreshed = client.refresh_access_token()
+            expires_at = client.get_token().expires_at if refreshed else None
+            return pk, stored, refreshed, expires_at
+
+        refreshed = failed = changed = 0
+        pool = ThreadPool(concurrency * len(providers))
+        try:
+            last = None
+            while True:
+                chunk = accesses if last is None else accesses.filter(pk__gt=last)
+                rows = list(chunk[:options['chunk_size']])
+                if not rows:
+                    break
+                last = rows[-1][0]
+                # Tokens are read and saved here. Only the provider requests run in the threads.
+                tasks = [
+                    (providers[provider], pk, stored, decrypted_text(field.from_db_value(stored, None, None, {})))
+                    for pk, provider, stored in rows if stored
+                ]
+                for pk, stored, token, expires_at in pool.imap_unordered(refresh, tasks):
+                    if token is None:
+                        failed += 1
+                        continue
+                    # Only replace the token which was refreshed. A login may have saved a newer one.
+                    updated = AccountAccess.objects.filter(pk=pk).extra(
+                        where=['{0} = %s'.format(column)], params=[stored]
+                    ).update(access_token=token, expires_at=expires_at, modified=timezone.now())
+                    if updated:
+                        refreshed += 1
+                    else:
+                        changed += 1
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write('Refreshed {0} tokens, {1} failed.'.format(refreshed, failed))
+        if changed:
+            self.stdout.write('Skipped {0} tokens which were changed while refreshing.'.format(changed))
+
+    def get_providers(self, names=None):
+        "Enabled OAuth 2.0 providers by primary key."
+        providers = Provider.objects.all()
+        if names:
+            providers = providers.filter(name__in=names)
+        return dict(
+            (p.pk, p) for p in providers
+            if p.enabled() and not p.request_token_url
+        )
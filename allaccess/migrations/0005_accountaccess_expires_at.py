@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allaccess', '0004_compact_access_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountaccess',
+            name='expires_at',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+        ),
+    ]
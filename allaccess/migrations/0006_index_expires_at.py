@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allaccess', '0005_accountaccess_expires_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accountaccess',
+            name='expires_at',
+            field=models.DateTimeField(default=None, null=True, blank=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+INDEXED_FIELDS = ('created', 'modified')
+
+# PostgreSQL builds the index without blocking writes to the table
+CONCURRENT_INDEX = 'CREATE INDEX CONCURRENTLY %(name)s ON %(table)s (%(columns)s)%(extra)s'
+
+
+def create_indexes(apps, schema_editor):
+    "Add the indexes without locking the table on PostgreSQL."
+    AccountAccess = apps.get_model('allaccess', 'AccountAccess')
+    sql = None
+    if schema_editor.connection.vendor == 'postgresql':
+        sql = CONCURRENT_INDEX
+    for name in INDEXED_FIELDS:
+        field = AccountAccess._meta.get_field(name)
+        schema_editor.execute(schema_editor._create_index_sql(AccountAccess, [field], sql=sql))
+
+
+def drop_indexes(apps, schema_editor):
+    "Remove the indexes added by create_indexes."
+    AccountAccess = apps.get_model('allaccess', 'AccountAccess')
+    for name in INDEXED_FIELDS:
+        field = AccountAccess._meta.get_field(name)
+        index_name = schema_editor._create_index_name(AccountAccess, [field.column])
+        schema_editor.execute(schema_editor._delete_constraint_sql(
+            schema_editor.sql_delete_index, AccountAccess, index_name))
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('allaccess', '0006_index_expires_at'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_indexes, drop_indexes),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='accountaccess',
+                    name='created',
+                    field=models.DateTimeField(auto_now_add=True, db_index=True),
+                ),
+                migrations.AlterField(
+                    model_name='accountaccess',
+                    name='modified',
+                    field=models.DateTimeField(auto_now=True, db_index=True),
+                ),
+            ],
+        ),
+    ]
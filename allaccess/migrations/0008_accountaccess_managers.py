@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import allaccess.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allaccess', '0007_index_created_modified'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='accountaccess',
+            managers=[
+                ('objects_with_tokens', allaccess.models.AccountAccessTokenManager()),
+            ],
+        ),
+    ]
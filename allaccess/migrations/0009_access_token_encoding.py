@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import allaccess.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allaccess', '0008_accountaccess_managers'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accountaccess',
+            name='access_token',
+            field=allaccess.fields.EncryptedField(default=None, null=True, blank=True, lazy=True),
+        ),
+    ]
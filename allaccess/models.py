@@ -1,11 +1,17 @@
 from __future__ import unicode_literals
 
 from django.conf import settings
-from django.db import models
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
+from .bloom import identity_filter
+from .cache import identity_cache, provider_cache, user_cache
 from .clients import get_client
-from .fields import EncryptedField
+from .fields import EncryptedField, LazyDecryptedText, decrypted_text
 
 
 class ProviderManager(models.Manager):
@@ -14,6 +20,13 @@ class ProviderManager(models.Manager):
     def get_by_natural_key(self, name):
         return self.get(name=name)
 
+    def get_cached(self, name):
+        "Fetch the provider by name from the provider cache."
+        provider = provider_cache.get(self.model, name)
+        if provider is None:
+            raise self.model.DoesNotExist('Unknown provider {0}.'.format(name))
+        return provider
+
 
 @python_2_unicode_compatible
 class Provider(models.Model):
@@ -45,13 +58,141 @@ class Provider(models.Model):
     enabled.boolean = True
 
 
+@receiver(post_save, sender=Provider)
+@receiver(post_delete, sender=Provider)
+def invalidate_provider_cache(sender, **kwargs):
+    "Expire cached providers when any provider changes."
+    provider_cache.invalidate()
+
+
+class AccountAccessQuerySet(models.QuerySet):
+    "Access records which only load the encrypted token when asked to."
+
+    def with_tokens(self):
+        "Load the encrypted access token with the records."
+        clone = self._clone()
+        names, defer = clone.query.deferred_loading
+        if defer:
+            names = frozenset(names) - {'access_token'}
+        else:
+            # Fields were selected with only()
+            names = frozenset(names) | {'access_token'}
+        clone.query.deferred_loading = (names, defer)
+        return clone
+
+
 class AccountAccessManager(models.Manager):
     "Additional manager for AccountAccess models."
 
+    def get_queryset(self):
+        # Most lookups only need the identity so the token is deferred
+        return AccountAccessQuerySet(self.model, using=self._db).defer('access_token')
+
+    def with_tokens(self):
+        "Access records with their encrypted access tokens."
+        return self.get_queryset().with_tokens()
+
     def get_by_natural_key(self, identifier, provider):
         provider = Provider.objects.get_by_natural_key(provider)
         return self.get(identifier=identifier, provider=provider)
 
+    def upsert(self, provider, identifier, access_token, expires_at=None):
+        """
+        Create or update the access token for the provider/identifier pair.
+
+        Returns the access record with its user selected and whether it was
+        created. Backends which support it use a single INSERT ... ON CONFLICT
+        statement so concurrent callbacks for the same account do not race.
+        ``post_save`` is sent with ``created=True`` for new records.
+        """
+        connection = connections[self.db]
+        now = timezone.now()
+        sql = self._get_upsert_sql(connection)
+        created = False
+        if sql is not None:
+            opts = self.model._meta
+            values = [
+                opts.get_field(name).get_db_prep_value(value, connection)
+                for name, value in (
+                    ('identifier', identifier), ('provider', provider.pk),
+                    ('created', now), ('modified', now), ('access_token', access_token),
+                    ('expires_at', expires_at),
+                )
+            ]
+            with connection.cursor() as cursor:
+                cursor.execute(sql, values)
+                if connection.vendor == 'postgresql':
+                    # xmax is only zero for a row which was inserted by the statement
+                    created = cursor.fetchone()[0]
+                else:
+                    # MySQL counts an updated row twice and SQLite does not update on conflict
+                    created = cursor.rowcount == 1
+            if not created and connection.vendor == 'sqlite':
+                self.filter(provider=provider, identifier=identifier).update(
+                    access_token=access_token, expires_at=expires_at, modified=now)
+        else:
+            lookup = self.filter(provider=provider, identifier=identifier)
+            if not lookup.update(access_token=access_token, expires_at=expires_at, modified=now):
+                try:
+                    with transaction.atomic(using=self.db):
+                        self.create(
+                            provider=provider, identifier=identifier,
+                            access_token=access_token, expires_at=expires_at)
+                    created = True
+                except IntegrityError:
+                    # Record was created by a concurrent request
+                    lookup.update(access_token=access_token, expires_at=expires_at, modified=now)
+        access = self.select_related('user').get(provider=provider, identifier=identifier)
+        access.provider = provider
+        # Use the saved token rather than loading it again
+        access.access_token = access_token
+        if sql is not None and created:
+            # Inserted by the statement rather than save() so send the signal here.
+            # Updates only change the token so the cached user is still valid.
+            post_save.send(
+                sender=self.model, instance=access, created=True,
+                update_fields=None, raw=False, using=self.db)
+        return access, created
+
+    def _get_upsert_sql(self, connection):
+        "Native upsert statement for the database or None if not supported."
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        identifier, provider, created, modified, token, expires = [
+            qn(opts.get_field(name).column)
+            for name in ('identifier', 'provider', 'created', 'modified', 'access_token', 'expires_at')
+        ]
+        insert = 'INSERT INTO {0} ({1}, {2}, {3}, {4}, {5}, {6}) VALUES (%s, %s, %s, %s, %s, %s)'.format(
+            table, identifier, provider, created, modified, token, expires)
+        vendor = connection.vendor
+        if vendor == 'sqlite' and connection.Database.sqlite_version_info < (3, 24, 0):
+            vendor = None
+        if vendor == 'postgresql':
+            return (
+                '{0} ON CONFLICT ({1}, {2}) DO UPDATE SET '
+                '{3} = EXCLUDED.{3}, {4} = EXCLUDED.{4}, {5} = EXCLUDED.{5} '
+                'RETURNING (xmax = 0)'
+            ).format(insert, identifier, provider, token, modified, expires)
+        if vendor == 'sqlite':
+            # Database writes are serialized so the update can follow in a second statement
+            return '{0} ON CONFLICT ({1}, {2}) DO NOTHING'.format(insert, identifier, provider)
+        if vendor == 'mysql':
+            return (
+                '{0} ON DUPLICATE KEY UPDATE {1} = VALUES({1}), {2} = VALUES({2}), {3} = VALUES({3})'
+            ).format(insert, token, modified, expires)
+        return None
+
+
+class AccountAccessTokenManager(AccountAccessManager):
+    "Access records which are loaded with their encrypted access tokens."
+
+    # Keeps the migration state the same on Django 1.8 which drops a plain default manager
+    use_in_migrations = True
+
+    def get_queryset(self):
+        return super(AccountAccessTokenManager, self).get_queryset().with_tokens()
+
 
 @python_2_unicode_compatible
 class AccountAccess(models.Model):
@@ -61,10 +202,13 @@ class AccountAccess(models.Model):
     provider = models.ForeignKey(Provider, on_delete=models.CASCADE)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE)
-    created = models.DateTimeField(auto_now_add=True)
-    modified = models.DateTimeField(auto_now=True)
-    access_token = EncryptedField(blank=True, null=True, default=None)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    access_token = EncryptedField(blank=True, null=True, default=None, lazy=True)
+    expires_at = models.DateTimeField(blank=True, null=True, default=None, db_index=True)
 
+    # Default manager used for serialization and related objects which loads the tokens
+    objects_with_tokens = AccountAccessTokenManager()
     objects = AccountAccessManager()
 
     class Meta(object):
@@ -74,13 +218,77 @@ class AccountAccess(models.Model):
         return '{0} {1}'.format(self.provider, self.identifier)
 
     def save(self, *args, **kwargs):
-        self.access_token = self.access_token or None
+        if 'access_token' not in self.get_deferred_fields() and \
+                not isinstance(self.access_token, LazyDecryptedText):
+            self.access_token = self.access_token or None
         super(AccountAccess, self).save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(AccountAccess, cls).from_db(db, field_names, values)
+        # Pair as loaded so only new pairs are recorded for the identity filter
+        instance._loaded_pair = instance.get_loaded_pair()
+        return instance
+
+    def get_loaded_pair(self):
+        "Provider and identifier without loading deferred fields."
+        return (self.__dict__.get('provider_id'), self.__dict__.get('identifier'))
+
     def natural_key(self):
         return (self.identifier, ) + self.provider.natural_key()
     natural_key.dependencies = ['allaccess.provider']
 
     @property
     def api_client(self):
-        return get_client(self.provider, self.access_token or '')
+        token = decrypted_text(self.access_token or '')
+        client = self.__dict__.get('_api_client')
+        if client is None or client.token != token or client.provider is not self.provider:
+            # Reuse the client so the token is only parsed once
+            client = self.__dict__['_api_client'] = get_client(self.provider, token)
+        self.set_token_expiry(client)
+        return client
+
+    @property
+    def async_api_client(self):
+        "asyncio API client for the provider. Requires Python 3.5+ and aiohttp."
+        from .aio import get_async_client
+        client = get_async_client(self.provider, decrypted_text(self.access_token or ''))
+        self.set_token_expiry(client)
+        return client
+
+    def set_token_expiry(self, client):
+        "Use the saved expiry since the expires_in of the stored token is relative to when it was saved."
+        client.get_token().expires_at = self.expires_at
+
+
+def is_sender(sender, model):
+    "Match the model along with its proxies and the deferred classes used by Django 1.8 and 1.9."
+    return sender is not None and sender._meta.concrete_model is model
+
+
+# Records loaded without the token are deferred subclasses on Django 1.8 and 1.9
+# so the receivers are connected for all senders and check the model.
+@receiver(post_save, dispatch_uid='allaccess-identity-cache')
+@receiver(post_delete, dispatch_uid='allaccess-identity-cache')
+def invalidate_identity_cache(sender, instance, **kwargs):
+    "Remove the cached user for the access record."
+    # Deleting a user cascades to its access records which sends post_delete for each
+    if is_sender(sender, AccountAccess):
+        identity_cache.invalidate(instance.provider_id, instance.identifier)
+
+
+@receiver(post_save, dispatch_uid='allaccess-identity-filter')
+def update_identity_filter(sender, instance, created=False, **kwargs):
+    "Record new or changed provider and identifier pairs for the identity filter."
+    if not is_sender(sender, AccountAccess):
+        return
+    pair = instance.get_loaded_pair()
+    if created or pair != getattr(instance, '_loaded_pair', None):
+        identity_filter.add(instance.provider_id, instance.identifier)
+    instance._loaded_pair = pair
+
+
+def invalidate_user_cache(sender, instance, **kwargs):
+    "Remove the cached user. Connected for all senders when the app is ready."
+    if is_sender(sender, get_user_model()):
+        user_cache.invalidate(instance.pk)
@@ -0,0 +1,239 @@
+"OpenID Connect client which verifies the id_token instead of fetching the profile."
+from __future__ import unicode_literals
+
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare, get_random_string
+from django.utils.encoding import force_bytes, force_text
+
+from Crypto.Hash import SHA256, SHA384, SHA512
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Util.number import bytes_to_long
+from requests.exceptions import RequestException
+
+from .clients import OAuth2Client
+from .conf import get_provider_option
+
+
+logger = logging.getLogger('allaccess.clients')
+
+
+RSA_ALGORITHMS = {'RS256': SHA256, 'RS384': SHA384, 'RS512': SHA512}
+HMAC_ALGORITHMS = {'HS256': hashlib.sha256, 'HS384': hashlib.sha384, 'HS512': hashlib.sha512}
+
+
+class InvalidIDToken(ValueError):
+    "The id_token could not be verified."
+
+
+def b64decode(value):
+    "Decode unpadded base64url."
+    value = force_bytes(value)
+    return base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4))
+
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+class OIDCClient(OAuth2Client):
+    """
+    OAuth 2.0 client for OpenID Connect providers.
+
+    The id_token in the token response is verified against the provider's keys
+    and its claims are used as the profile. The discovery document and keys are
+    cached in the process and in a shared Django cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(OIDCClient, self).__init__(*args, **kwargs)
+        self._claims = None
+
+    def get_option(self, name):
+        return get_provider_option(self.provider, 'oidc_{0}'.format(name))
+
+    @property
+    def issuer(self):
+        return self.get_option('issuer')
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'ALLACCESS_OIDC_CACHE', 'default')]
+
+    @property
+    def nonce_key(self):
+        return 'allaccess-{0}-request-nonce'.format(self.provider.name)
+
+    def get_redirect_args(self, request, callback):
+        "Get request parameters for redirect url including the openid scope and nonce."
+        args = super(OIDCClient, self).get_redirect_args(request, callback)
+        args['scope'] = 'openid'
+        nonce = get_random_string(32)
+        args['nonce'] = nonce
+        self.state_store.set(request, self.nonce_key, nonce)
+        return args
+
+    def get_access_token(self, request, callback=None):
+        "Fetch access token from callback request and verify its id_token."
+        raw_token = super(OIDCClient, self).get_access_token(request, callback=callback)
+        if raw_token is None:
+            return None
+        nonce = self.state_store.get(request, self.nonce_key)
+        try:
+            self.get_claims(raw_token, nonce=nonce)
+        except (InvalidIDToken, RequestException) as e:
+            logger.error('Unable to verify id_token: {0}'.format(e))
+            return None
+        return raw_token
+
+    def get_profile_info(self, raw_token, profile_info_params={}):
+        "Return the verified id_token claims or fetch the profile if there is no id_token."
+        try:
+            claims = self.get_claims(raw_token)
+        except (InvalidIDToken, RequestException) as e:
+            logger.error('Unable to verify id_token: {0}'.format(e))
+            return None
+        if claims is None:
+            return super(OIDCClient, self).get_profile_info(raw_token, profile_info_params)
+        profile = dict(claims)
+        # Allow the default provider_id to find the subject
+        profile.setdefault('id', claims['sub'])
+        return profile
+
+    def get_claims(self, raw_token, nonce=None):
+        "Verified claims of the id_token in the raw token response or None if there is no id_token."
+        if self._claims is not None and self._claims[0] == raw_token:
+            return self._claims[1]
+        if raw_token is None:
+            return None
+        id_token = self.get_token_data(raw_token).get('id_token', None)
+        if id_token is None:
+            return None
+        claims = self.verify_id_token(id_token, nonce=nonce)
+        self._claims = (raw_token, claims)
+        return claims
+
+    def verify_id_token(self, id_token, nonce=None):
+        "Check the signature and claims of the id_token and return the claims."
+        try:
+            header, payload, signature = force_bytes(id_token).split(b'.')
+            signing_input = header + b'.' + payload
+            header = json.loads(force_text(b64decode(header)))
+            claims = json.loads(force_text(b64decode(payload)))
+            signature = b64decode(signature)
+        except (TypeError, ValueError, binascii.Error):
+            raise InvalidIDToken('Malformed id_token.')
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise InvalidIDToken('Malformed id_token.')
+        alg = header.get('alg')
+        if alg in HMAC_ALGORITHMS:
+            secret = force_bytes(self.provider.consumer_secret)
+            expected = hmac.new(secret, signing_input, HMAC_ALGORITHMS[alg]).digest()
+            valid = constant_time_compare(expected, signature)
+        elif alg in RSA_ALGORITHMS:
+            valid = any(
+                self.verify_rsa(key, alg, signing_input, signature)
+                for key in self.get_signing_keys(header.get('kid'))
+            )
+        else:
+            raise InvalidIDToken('Unsupported id_token algorithm {0}.'.format(alg))
+        if not valid:
+            raise InvalidIDToken('Invalid id_token signature.')
+        self.check_claims(claims, nonce=nonce)
+        return claims
+
+    def verify_rsa(self, key, alg, signing_input, signature):
+        try:
+            public_key = RSA.construct((bytes_to_long(b64decode(key['n'])), bytes_to_long(b64decode(key['e']))))
+        except (KeyError, TypeError, ValueError, binascii.Error):
+            return False
+        digest = RSA_ALGORITHMS[alg].new(signing_input)
+        try:
+            return bool(PKCS1_v1_5.new(public_key).verify(digest, signature))
+        except ValueError:
+            # Signature from another key can be larger than the modulus
+            return False
+
+    def check_claims(self, claims, nonce=None):
+        "Check the issuer, audience, expiry and nonce claims."
+        if claims.get('iss') != self.issuer:
+            raise InvalidIDToken('Unexpected issuer {0}.'.format(claims.get('iss')))
+        if not claims.get('sub'):
+            raise InvalidIDToken('No subject in the id_token.')
+        client_id = self.provider.consumer_key
+        audience = claims.get('aud')
+        audience = [audience] if not isinstance(audience, list) else audience
+        if client_id not in audience:
+            raise InvalidIDToken('id_token was not issued for this client.')
+        if len(audience) > 1 and claims.get('azp', client_id) != client_id:
+            raise InvalidIDToken('id_token was not issued for this client.')
+        try:
+            expires = float(claims['exp'])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidIDToken('No expiry in the id_token.')
+        if expires + self.get_option('leeway') < time.time():
+            raise InvalidIDToken('id_token has expired.')
+        if nonce is not None and not constant_time_compare(force_text(claims.get('nonce', '')), nonce):
+            raise InvalidIDToken('id_token nonce does not match.')
+
+    def get_configuration(self):
+        "Provider discovery document."
+        return self.get_document('{0}/.well-known/openid-configuration'.format(self.issuer.rstrip('/')))
+
+    def get_signing_keys(self, kid=None):
+        "RSA keys which may have signed the token, refreshing the key set if the key is unknown."
+        jwks_uri = self.get_configuration()['jwks_uri']
+        keys = self.find_keys(self.get_document(jwks_uri), kid)
+        if not keys:
+            # Keys may have been rotated since they were cached
+            keys = self.find_keys(self.get_document(jwks_uri, refresh=True), kid)
+        return keys
+
+    def find_keys(self, key_set, kid=None):
+        return [
+            key for key in key_set.get('keys', [])
+            if key.get('kty') == 'RSA' and key.get('use', 'sig') == 'sig' and
+            (kid is None or key.get('kid') == kid)
+        ]
+
+    def get_document(self, url, refresh=False):
+        """
+        JSON document from the process cache, the shared cache or the provider.
+
+        With refresh the document is fetched again unless it was fetched within
+        the refresh interval. This limits requests from tokens with unknown keys.
+        """
+        now = time.time()
+        timeout = self.get_option('cache_timeout')
+        interval = self.get_option('refresh_interval')
+        key = 'allaccess-oidc-{0}'.format(hashlib.md5(force_bytes(url)).hexdigest())
+
+        def fresh(entry):
+            if entry is None or entry[0] + timeout < now:
+                return False
+            return not refresh or entry[0] + interval > now
+
+        entry = _documents.get(url)
+        if not fresh(entry):
+            entry = self.cache.get(key)
+            if not fresh(entry):
+                response = self.request('get', url, token='')
+                response.raise_for_status()
+                try:
+                    entry = (now, response.json())
+                except ValueError:
+                    raise InvalidIDToken('Invalid JSON document from {0}.'.format(url))
+                self.cache.set(key, entry, timeout)
+            with _documents_lock:
+                _documents[url] = entry
+        return entry[1]
@@ -0,0 +1,8 @@
+"Signals sent by django-all-access."
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+
+# Sent by the deferred task once the profile info for a login is available
+profile_enriched = Signal(providing_args=['access', 'info', 'new'])
@@ -0,0 +1,111 @@
+"Storage for the OAuth flow state between the redirect and the callback."
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils.crypto import get_random_string
+from django.utils.module_loading import import_string
+
+
+def get_state_store():
+    "Return an instance of the configured state store."
+    path = getattr(settings, 'ALLACCESS_STATE_STORE', 'allaccess.state.SessionStateStore')
+    return import_string(path)()
+
+
+class BaseStateStore(object):
+    "Interface for storing values such as the OAuth 2.0 state or OAuth 1.0 request token."
+
+    @property
+    def timeout(self):
+        "Seconds the state is valid for."
+        return getattr(settings, 'ALLACCESS_STATE_TIMEOUT', 600)
+
+    def get(self, request, key):
+        "Return the stored value or None if it is not found."
+        raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
+
+    def set(self, request, key, value):
+        "Store the value for the callback request."
+        raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
+
+    def update_response(self, request, response):
+        "Add any cookies needed to find the stored values to the redirect response."
+        for name, value in getattr(request, '_allaccess_cookies', {}).items():
+            response.set_cookie(
+                name, value, max_age=self.timeout, secure=request.is_secure(), httponly=True)
+        return response
+
+    def set_cookie(self, request, name, value):
+        "Queue a cookie to be added to the redirect response."
+        if not hasattr(request, '_allaccess_cookies'):
+            request._allaccess_cookies = {}
+        request._allaccess_cookies[name] = value
+
+
+class SessionStateStore(BaseStateStore):
+    "Store the state in the user's session."
+
+    def get(self, request, key):
+        return request.session.get(key, None)
+
+    def set(self, request, key, value):
+        request.session[key] = value
+
+
+class CookieStateStore(BaseStateStore):
+    """
+    Store the state in a signed and expiring cookie.
+
+    The value can be read but not changed by the browser.
+    """
+
+    salt = 'allaccess.state.CookieStateStore'
+
+    def get(self, request, key):
+        try:
+            return signing.loads(request.COOKIES[key], salt=self.salt, max_age=self.timeout)
+        except (KeyError, signing.BadSignature):
+            return None
+
+    def set(self, request, key, value):
+        self.set_cookie(request, key, signing.dumps(value, salt=self.salt))
+
+
+class CacheStateStore(BaseStateStore):
+    """
+    Store the state in a Django cache.
+
+    A random flow id is stored in a cookie to tie the state to the browser.
+    """
+
+    cookie_name = 'allaccess-flow'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'ALLACCESS_STATE_CACHE', 'default')]
+
+    def get_flow_id(self, request, create=False):
+        "Return the flow id for the browser, creating a new id if requested."
+        pending = getattr(request, '_allaccess_cookies', {})
+        flow_id = pending.get(self.cookie_name) or request.COOKIES.get(self.cookie_name)
+        if flow_id is not None and not (len(flow_id) == 32 and flow_id.isalnum()):
+            flow_id = None
+        if flow_id is None and create:
+            flow_id = get_random_string(32)
+            self.set_cookie(request, self.cookie_name, flow_id)
+        return flow_id
+
+    def get_cache_key(self, flow_id, key):
+        return 'allaccess-state-{0}-{1}'.format(flow_id, key)
+
+    def get(self, request, key):
+        flow_id = self.get_flow_id(request)
+        if flow_id is None:
+            return None
+        return self.cache.get(self.get_cache_key(flow_id, key))
+
+    def set(self, request, key, value):
+        flow_id = self.get_flow_id(request, create=True)
+        self.cache.set(self.get_cache_key(flow_id, key), value, self.timeout)
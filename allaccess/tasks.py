@@ -0,0 +1,98 @@
+"Executors for work which is deferred until after the user is logged in."
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .fields import decrypted_text
+from .models import AccountAccess
+from .signals import profile_enriched
+
+
+logger = logging.getLogger('allaccess.tasks')
+
+
+def get_executor():
+    "Return an instance of the configured executor."
+    path = getattr(settings, 'ALLACCESS_EXECUTOR', 'allaccess.tasks.ThreadPoolExecutor')
+    return import_string(path)()
+
+
+class BaseExecutor(object):
+    """
+    Interface for running deferred tasks.
+
+    Tasks are given by their dotted path and arguments which can be serialized
+    as JSON so that they can be passed to a task queue.
+    """
+
+    def submit(self, path, *args, **kwargs):
+        "Run the task at the given path with the arguments."
+        raise NotImplementedError('Defined in a sub-class')  # pragma: no cover
+
+
+class ImmediateExecutor(BaseExecutor):
+    "Run tasks right away in the current thread."
+
+    def submit(self, path, *args, **kwargs):
+        import_string(path)(*args, **kwargs)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def run_task(path, args, kwargs):
+    "Run a task in a pool thread and release its database connection."
+    try:
+        import_string(path)(*args, **kwargs)
+    except Exception:
+        logger.exception('Deferred task {0} failed.'.format(path))
+    finally:
+        connection.close()
+
+
+class ThreadPoolExecutor(BaseExecutor):
+    """
+    Run tasks in a thread pool in the current process.
+
+    The pool has ``ALLACCESS_EXECUTOR_THREADS`` threads (4 by default). Tasks
+    which have not run when the process exits are lost.
+    """
+
+    @property
+    def pool(self):
+        key = os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            with _pools_lock:
+                pool = _pools.get(key)
+                if pool is None:
+                    pool = _pools[key] = ThreadPool(getattr(settings, 'ALLACCESS_EXECUTOR_THREADS', 4))
+        return pool
+
+    def submit(self, path, *args, **kwargs):
+        return self.pool.apply_async(run_task, (path, args, kwargs))
+
+
+def enrich_profile(access_id, info=None, profile_info_params=None, new=False):
+    """
+    Fetch the profile info for the access record if needed and send ``profile_enriched``.
+
+    Receivers of the signal run in the executor rather than the callback request.
+    """
+    try:
+        access = AccountAccess.objects.with_tokens().select_related('provider', 'user').get(pk=access_id)
+    except AccountAccess.DoesNotExist:
+        return None
+    if info is None:
+        raw_token = decrypted_text(access.access_token or '')
+        info = access.api_client.get_profile_info(raw_token, profile_info_params or {})
+    profile_enriched.send(sender=AccountAccess, access=access, info=info, new=new)
+    return info
@@ -0,0 +1,68 @@
+"Admin customization tests."
+from __future__ import unicode_literals
+
+from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.test import RequestFactory
+
+from .base import AllAccessTestCase, AccountAccess
+from ..admin import EstimatedCountPaginator, get_estimated_count
+from ..compat import patch
+
+
+class AccountAccessAdminTestCase(AllAccessTestCase):
+    "Account changelist for large tables."
+
+    def setUp(self):
+        super(AccountAccessAdminTestCase, self).setUp()
+        self.model_admin = admin.site._registry[AccountAccess]
+        self.factory = RequestFactory()
+        self.provider = self.create_provider()
+        for _ in range(3):
+            self.create_access(provider=self.provider, user=self.create_user(), access_token='token')
+        self.create_access(user=self.create_user())
+
+    def get_changelist(self, **params):
+        request = self.factory.get('/', params)
+        request.user = None
+        m = self.model_admin
+        return ChangeList(
+            request, AccountAccess, m.list_display, m.list_display_links, m.list_filter,
+            m.date_hierarchy, m.search_fields, m.list_select_related, m.list_per_page,
+            m.list_max_show_all, m.list_editable, m)
+
+    def test_related_rows(self):
+        "Provider and user are loaded with the records and tokens are deferred."
+        changelist = self.get_changelist()
+        with self.assertNumQueries(1):
+            for access in changelist.result_list:
+                '{0} {1} {2}'.format(access, access.provider, access.user)
+                self.assertIn('access_token', access.get_deferred_fields())
+
+    def test_search(self):
+        "Search matches the identifier exactly."
+        access = AccountAccess.objects.all()[0]
+        changelist = self.get_changelist(q=' {0} '.format(access.identifier))
+        self.assertEqual(list(changelist.result_list), [access])
+        changelist = self.get_changelist(q=access.identifier[:-1])
+        self.assertEqual(list(changelist.result_list), [])
+
+    @patch('allaccess.admin.get_estimated_count')
+    def test_estimated_count(self, estimate):
+        "Large unfiltered tables use the estimated count."
+        estimate.return_value = 2000000
+        self.assertEqual(self.get_changelist().result_count, 2000000)
+        self.assertIsNone(self.get_changelist().full_result_count)
+        self.assertEqual(self.get_changelist(provider__id__exact=self.provider.pk).result_count, 3)
+
+    @patch('allaccess.admin.get_estimated_count')
+    def test_small_table(self, estimate):
+        "Small tables or those without an estimate are counted."
+        for value in (None, 10):
+            estimate.return_value = value
+            paginator = EstimatedCountPaginator(AccountAccess.objects.all(), 10)
+            self.assertEqual(paginator.count, 4)
+
+    def test_no_estimate(self):
+        "SQLite has no estimate."
+        self.assertIsNone(get_estimated_count(AccountAccess, 'default'))
@@ -0,0 +1,289 @@
+"asyncio client tests against a local stand-in provider."
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from django.test import override_settings
+from django.test.client import RequestFactory
+
+from requests.exceptions import ConnectionError, HTTPError
+
+from .base import AllAccessTestCase
+from ..compat import parse_qs, patch, urlparse
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    # Python 2.X
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    import asyncio
+    from .. import aio
+    from ..aio import AsyncOAuthClient, AsyncOAuth2Client, close_sessions, get_async_client
+except (ImportError, SyntaxError):  # pragma: no cover
+    # Python 2.X or aiohttp is not installed
+    AsyncOAuth2Client = None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    "Record each request and reply with the next queued response for the path."
+
+    def do_GET(self):
+        self.respond(b'')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.respond(self.rfile.read(length))
+
+    def respond(self, body):
+        path = urlparse(self.path).path
+        self.server.received.append({
+            'method': self.command,
+            'path': path,
+            'query': parse_qs(urlparse(self.path).query),
+            'headers': dict(self.headers.items()),
+            'body': body.decode('utf-8'),
+        })
+        queued = self.server.responses.get(path) or [(404, 'text/plain', 'Not found')]
+        status, content_type, content = queued.pop(0) if len(queued) > 1 else queued[0]
+        content = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInProvider(ThreadingMixIn, HTTPServer):
+    "Local HTTP server which plays the part of the OAuth provider."
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.received = []
+        self.responses = {}
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{0}{1}'.format(self.server_address[1], path)
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.shutdown()
+            self.server_close()
+
+
+@unittest.skipIf(AsyncOAuth2Client is None, 'Requires Python 3.5+ and aiohttp.')
+@override_settings(ALLACCESS_PROVIDER_OPTIONS={'default': {'retry_backoff': 0}})
+class BaseAsyncClientTestCase(AllAccessTestCase):
+    "Common setup for running the clients on an event loop."
+
+    def setUp(self):
+        super(BaseAsyncClientTestCase, self).setUp()
+        self.server = StandInProvider()
+        self.addCleanup(self.server.stop)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(lambda: self.run_async(close_sessions()))
+        self.factory = RequestFactory()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+class AsyncOAuth2ClientTestCase(BaseAsyncClientTestCase):
+    "OAuth 2.0 client on asyncio."
+
+    def setUp(self):
+        super(AsyncOAuth2ClientTestCase, self).setUp()
+        self.provider = self.create_provider(
+            consumer_key='consumer', consumer_secret='secret',
+            authorization_url=self.server.url('/authorize'),
+            access_token_url=self.server.url('/token'),
+            profile_url=self.server.url('/profile'),
+        )
+        self.oauth = AsyncOAuth2Client(self.provider)
+
+    def test_redirect_url(self):
+        "Redirect url includes the state stored for the callback."
+        request = self.factory.get('/login/')
+        request.session = {}
+        url = self.run_async(self.oauth.get_redirect_url(request, callback='/callback/'))
+        query = parse_qs(urlparse(url).query)
+        self.assertEqual(query['client_id'], ['consumer'])
+        self.assertEqual(query['state'], [request.session[self.oauth.session_key]])
+        self.assertEqual(self.server.received, [])
+
+    def test_access_token(self):
+        "Exchange the code for an access token."
+        self.server.responses['/token'] = [(200, 'application/json', '{"access_token": "token"}')]
+        request = self.factory.get('/callback/', {'code': 'code', 'state': 'foo'})
+        request.session = {self.oauth.session_key: 'foo'}
+        raw_token = self.run_async(self.oauth.get_access_token(request))
+        self.assertEqual(raw_token, '{"access_token": "token"}')
+        received = self.server.received[0]
+        self.assertEqual(received['method'], 'POST')
+        body = parse_qs(received['body'])
+        self.assertEqual(body['code'], ['code'])
+        self.assertEqual(body['client_secret'], ['secret'])
+        self.assertEqual(body['grant_type'], ['authorization_code'])
+
+    def test_blocking_calls_in_executor(self):
+        "State store and enabled breaker calls do not run on the event loop thread."
+        self.server.responses['/token'] = [(200, 'application/json', '{"access_token": "token"}')]
+        request = self.factory.get('/callback/', {'code': 'code', 'state': 'foo'})
+        request.session = {self.oauth.session_key: 'foo'}
+        threads = []
+
+        def record(*args):
+            threads.append(threading.current_thread())
+            return True
+
+        options = {'default': {'retry_backoff': 0, 'breaker_enabled': True}}
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS=options):
+            with patch('allaccess.state.SessionStateStore.get', side_effect=lambda *args: record() and 'foo'):
+                with patch('allaccess.breaker.CircuitBreaker.allow_request', side_effect=record):
+                    raw_token = self.run_async(self.oauth.get_access_token(request))
+        self.assertEqual(raw_token, '{"access_token": "token"}')
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_access_token_failure(self):
+        "Error responses from the provider return no token."
+        self.server.responses['/token'] = [(400, 'application/json', '{"error": "invalid_grant"}')]
+        request = self.factory.get('/callback/', {'code': 'code', 'state': 'foo'})
+        request.session = {self.oauth.session_key: 'foo'}
+        self.assertIsNone(self.run_async(self.oauth.get_access_token(request)))
+
+    def test_profile_info(self):
+        "Fetch the profile with the access token."
+        self.server.responses['/profile'] = [(200, 'application/json', '{"id": 100}')]
+        profile = self.run_async(self.oauth.get_profile_info('{"access_token": "token"}'))
+        self.assertEqual(profile, {'id': 100})
+        self.assertEqual(self.server.received[0]['query'], {'access_token': ['token']})
+
+    def test_retry_unavailable(self):
+        "Idempotent requests are retried when the provider is unavailable."
+        self.server.responses['/profile'] = [
+            (503, 'text/plain', 'Unavailable'), (200, 'application/json', '{"id": 100}')]
+        profile = self.run_async(self.oauth.get_profile_info('{"access_token": "token"}'))
+        self.assertEqual(profile, {'id': 100})
+        self.assertEqual(len(self.server.received), 2)
+
+    def test_deadline_total_timeout(self):
+        "The total time of each request is limited by the deadline."
+        self.server.responses['/profile'] = [(200, 'application/json', '{"id": 100}')]
+        self.oauth.deadline = time.time() + 5
+        with patch.object(aio.aiohttp, 'ClientTimeout', wraps=aio.aiohttp.ClientTimeout) as timeout:
+            self.run_async(self.oauth.request('get', self.provider.profile_url))
+        args, kwargs = timeout.call_args
+        self.assertTrue(0 < kwargs['total'] <= 5)
+
+    def test_http_error(self):
+        "Error responses raise the requests exception."
+        response = self.run_async(self.oauth.request('get', self.server.url('/missing')))
+        self.assertEqual(response.status_code, 404)
+        self.assertRaises(HTTPError, response.raise_for_status)
+
+    def test_connection_error(self):
+        "Connection errors are raised as the requests exception."
+        url = self.server.url('/profile')
+        self.server.stop()
+        with self.assertRaises(ConnectionError):
+            self.run_async(self.oauth.request('get', url))
+
+    def test_pooled_session(self):
+        "Clients for the same provider share a session on the event loop."
+        self.server.responses['/profile'] = [(200, 'application/json', '{"id": 100}')]
+        for client in (self.oauth, AsyncOAuth2Client(self.provider)):
+            self.run_async(client.request('get', self.provider.profile_url))
+        keys = [k for k in aio._sessions if k[2] == self.provider.name]
+        self.assertEqual(len(keys), 1)
+
+    def test_api_client(self):
+        "Async client is available from the account access."
+        access = self.create_access(provider=self.provider, access_token='{"access_token": "token"}')
+        api = access.async_api_client
+        self.assertTrue(isinstance(api, AsyncOAuth2Client))
+        self.server.responses['/profile'] = [(200, 'application/json', '{"id": 100}')]
+        response = self.run_async(api.request('get', self.provider.profile_url))
+        self.assertEqual(response.json(), {'id': 100})
+        self.assertEqual(self.server.received[0]['query'], {'access_token': ['token']})
+
+
+class AsyncOAuthClientTestCase(BaseAsyncClientTestCase):
+    "OAuth 1.0 client on asyncio."
+
+    def setUp(self):
+        super(AsyncOAuthClientTestCase, self).setUp()
+        self.provider = self.create_provider(
+            consumer_key='consumer', consumer_secret='secret',
+            request_token_url=self.server.url('/request'),
+            authorization_url=self.server.url('/authorize'),
+            access_token_url=self.server.url('/token'),
+            profile_url=self.server.url('/profile'),
+        )
+        self.oauth = get_async_client(self.provider)
+
+    def get_oauth_params(self, received):
+        "Parse the OAuth parameters from the Authorization header."
+        header = received['headers']['Authorization']
+        self.assertTrue(header.startswith('OAuth '))
+        params = {}
+        for part in header[len('OAuth '):].split(', '):
+            key, value = part.split('=', 1)
+            params[key] = value.strip('"')
+        return params
+
+    def test_client_class(self):
+        "Providers with a request token url use OAuth 1.0."
+        self.assertTrue(isinstance(self.oauth, AsyncOAuthClient))
+
+    def test_redirect_url(self):
+        "Request token is fetched and stored for the callback."
+        self.server.responses['/request'] = [
+            (200, 'text/plain', 'oauth_token=token&oauth_token_secret=secret')]
+        request = self.factory.get('/login/')
+        request.session = {}
+        url = self.run_async(self.oauth.get_redirect_url(request, callback='/callback/'))
+        query = parse_qs(urlparse(url).query)
+        self.assertEqual(query['oauth_token'], ['token'])
+        self.assertEqual(
+            request.session[self.oauth.session_key], 'oauth_token=token&oauth_token_secret=secret')
+        params = self.get_oauth_params(self.server.received[0])
+        self.assertEqual(params['oauth_consumer_key'], 'consumer')
+        self.assertIn('oauth_callback', params)
+
+    def test_access_token(self):
+        "Access token request is signed with the request token and verifier."
+        self.server.responses['/token'] = [
+            (200, 'text/plain', 'oauth_token=access&oauth_token_secret=secret')]
+        request = self.factory.get('/callback/', {'oauth_verifier': 'verifier'})
+        request.session = {self.oauth.session_key: 'oauth_token=token&oauth_token_secret=secret'}
+        raw_token = self.run_async(self.oauth.get_access_token(request))
+        self.assertEqual(raw_token, 'oauth_token=access&oauth_token_secret=secret')
+        params = self.get_oauth_params(self.server.received[0])
+        self.assertEqual(params['oauth_token'], 'token')
+        self.assertEqual(params['oauth_verifier'], 'verifier')
+
+    def test_profile_info(self):
+        "Profile request is signed with the access token."
+        self.server.responses['/profile'] = [(200, 'application/json', '{"id": 100}')]
+        profile = self.run_async(self.oauth.get_profile_info(
+            'oauth_token=access&oauth_token_secret=secret', {'fields': 'id'}))
+        self.assertEqual(profile, {'id': 100})
+        received = self.server.received[0]
+        self.assertEqual(received['query'], {'fields': ['id']})
+        self.assertEqual(self.get_oauth_params(received)['oauth_token'], 'access')
@@ -1,6 +1,12 @@
-from django.contrib.auth import authenticate
+from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.test import override_settings
 
 from .base import AllAccessTestCase
+from ..backends import AuthorizedServiceBackend
+from ..cache import identity_cache, user_cache
+from ..models import Provider
 
 
 class AuthBackendTestCase(AllAccessTestCase):
@@ -43,3 +49,176 @@ class AuthBackendTestCase(AllAccessTestCase):
         "Only one query should be required to get the user."
         with self.assertNumQueries(1):
             authenticate(provider=self.access.provider, identifier=self.access.identifier)
+
+    def test_resolved_access(self):
+        "No queries are needed when the access record is given."
+        with self.assertNumQueries(0):
+            user = authenticate(access=self.access)
+        self.assertEqual(user, self.user, "Correct user was not returned.")
+
+    def test_resolved_access_mismatch(self):
+        "Provider and identifier must match the given access record."
+        provider = self.access.provider
+        identifier = self.access.identifier
+        user = authenticate(provider=provider, identifier=identifier, access=self.access)
+        self.assertEqual(user, self.user)
+        user = authenticate(provider=provider.name, identifier=identifier, access=self.access)
+        self.assertEqual(user, self.user)
+        other = self.create_provider()
+        self.assertIsNone(authenticate(provider=other, identifier=identifier, access=self.access))
+        self.assertIsNone(authenticate(provider=other.name, identifier=identifier, access=self.access))
+        self.assertIsNone(authenticate(provider=provider, identifier='other', access=self.access))
+
+
+@override_settings(ALLACCESS_IDENTITY_CACHE='default')
+class IdentityCacheTestCase(AllAccessTestCase):
+    "Cached user lookups by provider and identifier."
+
+    def setUp(self):
+        cache.clear()
+        identity_cache.reset_stats()
+        self.user = self.create_user()
+        self.access = self.create_access(user=self.user)
+
+    def authenticate(self, provider=None):
+        return authenticate(provider=provider or self.access.provider, identifier=self.access.identifier)
+
+    def test_cached(self):
+        "Repeat lookups fetch the user by primary key."
+        self.assertEqual(self.authenticate(), self.user)
+        self.assertEqual(identity_cache.stats(), {'hits': 0, 'misses': 1})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(), self.user)
+        # Names are resolved with the provider cache
+        Provider.objects.get_cached(self.access.provider.name)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(self.access.provider.name), self.user)
+        self.assertEqual(identity_cache.stats(), {'hits': 2, 'misses': 1})
+
+    def test_disabled(self):
+        "Nothing is cached without the setting."
+        with self.settings(ALLACCESS_IDENTITY_CACHE=None):
+            self.authenticate()
+            self.authenticate()
+        self.assertEqual(identity_cache.stats(), {'hits': 0, 'misses': 0})
+
+    def test_no_user(self):
+        "Access records without a user are not cached."
+        self.access.user = None
+        self.access.save()
+        self.assertIsNone(self.authenticate())
+        self.assertIsNone(self.authenticate())
+        self.assertEqual(identity_cache.stats(), {'hits': 0, 'misses': 2})
+
+    def test_access_saved(self):
+        "Changing the user for the access record removes the cached user."
+        self.authenticate()
+        other = self.create_user()
+        self.access.user = other
+        self.access.save()
+        self.assertEqual(self.authenticate(), other)
+
+    def test_access_deleted(self):
+        "Deleting the access record removes the cached user."
+        self.authenticate()
+        self.access.delete()
+        self.assertIsNone(self.authenticate())
+
+    def test_user_deleted(self):
+        "Deleting the user removes the cached user."
+        self.authenticate()
+        self.user.delete()
+        self.assertIsNone(self.authenticate())
+        self.assertEqual(identity_cache.stats(), {'hits': 0, 'misses': 2})
+
+
+@override_settings(ALLACCESS_USER_CACHE='default')
+class UserCacheTestCase(AllAccessTestCase):
+    "Cached users for sessions authenticated by the backend."
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user()
+        self.backend = AuthorizedServiceBackend()
+
+    def test_cached(self):
+        "Users are only fetched from the database once."
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user, self.user)
+        self.assertEqual(user.get_username(), self.user.get_username())
+
+    def test_disabled(self):
+        "Users are fetched every time without the setting."
+        with self.settings(ALLACCESS_USER_CACHE=None):
+            self.backend.get_user(self.user.pk)
+            with self.assertNumQueries(1):
+                self.backend.get_user(self.user.pk)
+
+    def test_unknown(self):
+        "Missing users are not found."
+        self.assertIsNone(self.backend.get_user(self.user.pk + 1))
+
+    def test_saved(self):
+        "Saving the user removes the cached user."
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertNumQueries(1):
+            user = self.backend.get_user(self.user.pk)
+        if hasattr(ModelBackend, 'user_can_authenticate'):
+            # Inactive users are rejected on Django 1.10+
+            self.assertIsNone(user)
+        else:  # pragma: no cover
+            self.assertFalse(user.is_active)
+
+    def test_cached_saved(self):
+        "Saving a user loaded from the cache removes the cached user."
+        User = get_user_model()
+        with self.settings(ALLACCESS_USER_CACHE_FIELDS=['is_active', User.USERNAME_FIELD]):
+            self.backend.get_user(self.user.pk)
+            user = self.backend.get_user(self.user.pk)
+            user.save()
+            with self.assertNumQueries(1):
+                self.backend.get_user(self.user.pk)
+
+    def test_deleted(self):
+        "Deleting the user removes the cached user."
+        self.backend.get_user(self.user.pk)
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_fields(self):
+        "Only the configured fields are loaded and cached."
+        User = get_user_model()
+        fields = ['is_active', User.USERNAME_FIELD]
+        with self.settings(ALLACCESS_USER_CACHE_FIELDS=fields):
+            self.backend.get_user(self.user.pk)
+            with self.assertNumQueries(0):
+                user = self.backend.get_user(self.user.pk)
+                self.assertEqual(user.pk, self.user.pk)
+                self.assertEqual(user.get_username(), self.user.get_username())
+        self.assertIn('password', user.get_deferred_fields())
+
+    def test_password_not_cached(self):
+        "Only the session hash is cached rather than the password hash."
+        self.backend.get_user(self.user.pk)
+        values = cache.get(user_cache.get_key(self.user.pk))
+        self.assertNotIn('password', values)
+        self.assertNotIn(self.user.password, values.values())
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(user.get_session_auth_hash(), self.user.get_session_auth_hash())
+        user.set_password('changed')
+        self.assertNotEqual(user.get_session_auth_hash(), self.user.get_session_auth_hash())
+
+    @override_settings(ALLACCESS_IDENTITY_CACHE='default')
+    def test_identity_cache(self):
+        "Repeat authentication does not need a query with both caches."
+        access = self.create_access(user=self.user)
+        authenticate(provider=access.provider, identifier=access.identifier)
+        with self.assertNumQueries(0):
+            user = authenticate(provider=access.provider, identifier=access.identifier)
+        self.assertEqual(user, self.user)
@@ -0,0 +1,149 @@
+"Identity filter tests."
+from __future__ import unicode_literals
+
+from django.contrib.auth import authenticate
+from django.core.cache import cache
+from django.test import override_settings
+
+from .base import AllAccessTestCase, AccountAccess
+from ..bloom import BloomFilter, IdentityFilter, identity_filter
+from ..compat import patch
+
+
+class BloomFilterTestCase(AllAccessTestCase):
+    "Fixed size Bloom filter."
+
+    def test_added(self):
+        "Added keys are always found."
+        bloom = BloomFilter(1000, 0.01)
+        keys = [self.get_random_string() for _ in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+
+    def test_error_rate(self):
+        "False positives are near the error rate at capacity."
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('added-{0}'.format(i))
+        false_positives = sum('other-{0}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_bits(self):
+        "Filter can be rebuilt from its bits."
+        bloom = BloomFilter(100, 0.01)
+        bloom.add('key')
+        self.assertIn('key', BloomFilter(100, 0.01, bits=bytes(bloom.bits)))
+
+
+@override_settings(ALLACCESS_IDENTITY_FILTER='default', ALLACCESS_EXECUTOR='allaccess.tasks.ImmediateExecutor')
+@patch('allaccess.bloom.on_commit', side_effect=lambda func: func())
+class IdentityFilterTestCase(AllAccessTestCase):
+    "Skipping lookups for pairs without an access record."
+
+    def setUp(self):
+        super(IdentityFilterTestCase, self).setUp()
+        cache.clear()
+        identity_filter.reset()
+        self.access = self.create_access()
+        self.provider = self.access.provider
+
+    def get_count(self, bloom):
+        epoch = cache.get(bloom.get_cache_key('epoch'))
+        return cache.get(bloom.get_cache_key(epoch, 'count'))
+
+    def test_existing(self, on_commit):
+        "Existing pairs might be found once the filter is built."
+        self.assertTrue(identity_filter.might_contain(self.provider.pk, 'unknown'))
+        self.assertTrue(identity_filter.might_contain(self.provider.pk, self.access.identifier))
+        self.assertFalse(identity_filter.might_contain(self.provider.pk, 'unknown'))
+
+    def test_skip_lookup(self, on_commit):
+        "Authenticating a new pair does not query the database."
+        identity_filter.might_contain(self.provider.pk, 'unknown')
+        with self.assertNumQueries(0):
+            self.assertIsNone(authenticate(provider=self.provider, identifier='unknown'))
+
+    def test_disabled(self, on_commit):
+        "Everything might be found without the setting."
+        with self.settings(ALLACCESS_IDENTITY_FILTER=None):
+            self.assertTrue(identity_filter.might_contain(self.provider.pk, 'unknown'))
+
+    def test_single_builder(self, on_commit):
+        "Only one process builds the filter. The others do not skip lookups until it is shared."
+        other = IdentityFilter()
+        epoch = other.get_epoch(cache)
+        cache.add(other.get_cache_key(epoch, 'building'), True)
+        with self.assertNumQueries(0):
+            self.assertTrue(other.might_contain(self.provider.pk, 'unknown'))
+        cache.delete(other.get_cache_key(epoch, 'building'))
+        other.might_contain(self.provider.pk, 'unknown')
+        with self.assertNumQueries(0):
+            self.assertFalse(IdentityFilter().might_contain(self.provider.pk, 'unknown'))
+
+    def test_shared_additions(self, on_commit):
+        "Pairs added by another process are found."
+        other = IdentityFilter()
+        other.might_contain(self.provider.pk, 'new')
+        self.assertFalse(other.might_contain(self.provider.pk, 'new'))
+        self.create_access(provider=self.provider, identifier='new')
+        with self.assertNumQueries(0):
+            self.assertTrue(other.might_contain(self.provider.pk, 'new'))
+
+    def test_upsert(self, on_commit):
+        "Pairs inserted with an upsert are added."
+        other = IdentityFilter()
+        other.might_contain(self.provider.pk, 'new')
+        AccountAccess.objects.upsert(self.provider, 'new', 'token')
+        self.assertTrue(other.might_contain(self.provider.pk, 'new'))
+
+    def test_only_new_pairs(self, on_commit):
+        "Updating existing records does not add to the log."
+        identity_filter.might_contain(self.provider.pk, 'unknown')
+        count = self.get_count(identity_filter)
+        AccountAccess.objects.upsert(self.provider, self.access.identifier, 'token')
+        access = AccountAccess.objects.get(pk=self.access.pk)
+        access.save()
+        self.assertEqual(self.get_count(identity_filter), count)
+        access.identifier = 'changed'
+        access.save()
+        self.assertEqual(self.get_count(identity_filter), count + 1)
+        self.assertTrue(IdentityFilter().might_contain(self.provider.pk, 'changed'))
+
+    def test_snapshot(self, on_commit):
+        "Other processes load the shared filter instead of the database."
+        identity_filter.might_contain(self.provider.pk, 'unknown')
+        with self.assertNumQueries(0):
+            self.assertTrue(IdentityFilter().might_contain(self.provider.pk, self.access.identifier))
+
+    def test_lost_entries(self, on_commit):
+        "Filter is built again if log entries were evicted."
+        other = IdentityFilter()
+        other.might_contain(self.provider.pk, 'new')
+        self.create_access(provider=self.provider, identifier='new')
+        epoch = cache.get(other.get_cache_key('epoch'))
+        cache.delete(other.get_cache_key(epoch, 'log', 1))
+        self.assertTrue(other.might_contain(self.provider.pk, 'new'))
+        self.assertTrue(IdentityFilter().might_contain(self.provider.pk, 'new'))
+
+    def test_lost_count(self, on_commit):
+        "Filter is built again if the counter was evicted but the snapshot was not."
+        identity_filter.might_contain(self.provider.pk, 'new')
+        self.create_access(provider=self.provider, identifier='new')
+        epoch = cache.get(identity_filter.get_cache_key('epoch'))
+        cache.delete(identity_filter.get_cache_key(epoch, 'count'))
+        other = IdentityFilter()
+        self.assertTrue(other.might_contain(self.provider.pk, 'new'))
+        self.assertTrue(other.might_contain(self.provider.pk, 'new'))
+        self.assertTrue(identity_filter.might_contain(self.provider.pk, 'new'))
+
+    def test_reset(self, on_commit):
+        "Resetting builds the filter again in every process."
+        other = IdentityFilter()
+        other.might_contain(self.provider.pk, 'new')
+        # Added without signals
+        AccountAccess.objects.bulk_create([AccountAccess(provider=self.provider, identifier='new')])
+        self.assertFalse(other.might_contain(self.provider.pk, 'new'))
+        identity_filter.reset()
+        self.assertTrue(other.might_contain(self.provider.pk, 'new'))
+        self.assertTrue(other.might_contain(self.provider.pk, 'new'))
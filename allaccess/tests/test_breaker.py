@@ -0,0 +1,197 @@
+"Provider circuit breaker tests."
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import override_settings
+from django.test.client import RequestFactory
+
+from requests.exceptions import ConnectionError
+
+from .base import AllAccessTestCase
+from ..breaker import CircuitBreaker, CircuitOpen
+from ..clients import OAuth2Client
+from ..compat import patch, Mock
+from ..context_processors import available_providers
+
+
+BREAKER_OPTIONS = {
+    'default': {
+        'breaker_enabled': True,
+        'breaker_min_requests': 4,
+        'breaker_failure_ratio': 0.5,
+        'breaker_reset_timeout': 30,
+        'retries': 0,
+    },
+}
+
+
+@override_settings(ALLACCESS_PROVIDER_OPTIONS=BREAKER_OPTIONS)
+class CircuitBreakerTestCase(AllAccessTestCase):
+    "Track provider failures and block requests while the provider is down."
+
+    def setUp(self):
+        self.provider = self.create_provider()
+        self.breaker = CircuitBreaker(self.provider)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_closed(self):
+        "Requests are allowed by default."
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_min_requests(self):
+        "Breaker does not open until there are enough requests."
+        for i in range(3):
+            self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_failure_ratio(self):
+        "Breaker opens once the failure ratio is passed."
+        for i in range(4):
+            self.breaker.record_success(0.1)
+        for i in range(3):
+            self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open())
+
+    def test_slow_calls(self):
+        "Slow responses count as failures."
+        for i in range(4):
+            self.breaker.record_success(60)
+        self.assertTrue(self.breaker.is_open())
+
+    def test_half_open_probe(self):
+        "Single probe is allowed after the reset timeout."
+        self.breaker.open()
+        with patch('allaccess.breaker.time.time', return_value=cache.get(self.breaker.get_key('opened')) + 31):
+            self.assertFalse(self.breaker.is_open())
+            self.assertTrue(self.breaker.allow_request())
+            self.assertFalse(self.breaker.allow_request())
+
+    def probe(self):
+        "Take the half-open probe once the reset timeout has passed."
+        with patch('allaccess.breaker.time.time', return_value=self.breaker.get_opened() + 31):
+            self.assertTrue(self.breaker.allow_request())
+
+    def test_probe_success(self):
+        "Successful probe closes the breaker."
+        self.breaker.open()
+        self.probe()
+        self.breaker.record_success(0.1)
+        self.assertIsNone(self.breaker.get_opened())
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_in_flight_results(self):
+        "Results of requests sent before the breaker opened do not close or open it."
+        in_flight = CircuitBreaker(self.provider)
+        self.assertTrue(in_flight.allow_request())
+        self.breaker.open()
+        opened = self.breaker.get_opened()
+        in_flight.record_success(0.1)
+        self.assertTrue(self.breaker.is_open())
+        with patch('allaccess.breaker.time.time', return_value=opened + 1):
+            in_flight.record_failure()
+        self.assertEqual(self.breaker.get_opened(), opened)
+
+    def test_closed_new_window(self):
+        "Failures from before the breaker opened are not counted once it closes."
+        for i in range(4):
+            self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open())
+        self.probe()
+        self.breaker.record_success(0.1)
+        self.assertFalse(self.breaker.is_open())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open())
+
+    def test_probe_failure(self):
+        "Failed probe opens the breaker again."
+        self.breaker.open()
+        opened = self.breaker.get_opened()
+        with patch('allaccess.breaker.time.time', return_value=opened + 31):
+            self.assertTrue(self.breaker.allow_request())
+            self.breaker.record_failure()
+            self.assertTrue(self.breaker.is_open())
+
+    def test_disabled(self):
+        "Breaker can be disabled per provider."
+        options = {self.provider.name: {'breaker_enabled': False}}
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS=options):
+            self.breaker.open()
+            self.assertFalse(self.breaker.is_open())
+            self.assertTrue(self.breaker.allow_request())
+
+    def test_disabled_by_default(self):
+        "Breaker does not use the cache unless it is enabled."
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS={}):
+            with patch.object(CircuitBreaker, 'cache') as shared:
+                self.assertTrue(self.breaker.allow_request())
+                self.breaker.record_failure()
+                self.breaker.record_success(0.1)
+            self.assertFalse(shared.method_calls)
+
+    @patch('allaccess.clients.Session.request')
+    def test_client_requests(self, requests):
+        "Client records failures and stops sending requests once open."
+        requests.side_effect = ConnectionError('Down')
+        client = OAuth2Client(self.provider)
+        for i in range(4):
+            self.assertIsNone(client.get_profile_info('access_token=token'))
+        self.assertEqual(requests.call_count, 4)
+        with self.assertRaises(CircuitOpen):
+            client.request('get', 'http://example.com/')
+        self.assertEqual(requests.call_count, 4)
+
+    @patch('allaccess.clients.Session.request')
+    def test_client_server_errors(self, requests):
+        "Server error responses count as failures."
+        requests.return_value = Mock(status_code=500)
+        client = OAuth2Client(self.provider)
+        for i in range(4):
+            client.request('post', 'http://example.com/')
+        self.assertTrue(self.breaker.is_open())
+
+
+@override_settings(
+    ROOT_URLCONF='allaccess.tests.urls', LOGIN_URL='/login/', ALLACCESS_PROVIDER_OPTIONS=BREAKER_OPTIONS)
+class BreakerViewTestCase(AllAccessTestCase):
+    "Views fail fast when the breaker is open."
+
+    def setUp(self):
+        self.provider = self.create_provider(
+            consumer_key=self.get_random_string(), consumer_secret=self.get_random_string())
+        CircuitBreaker(self.provider).open()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_redirect(self):
+        "Redirect returns to the login page."
+        url = reverse('allaccess-login', kwargs={'provider': self.provider.name})
+        response = self.client.get(url)
+        self.assertRedirects(response, settings.LOGIN_URL)
+
+    @patch('allaccess.views.get_client')
+    def test_callback(self, get_client):
+        "Callback fails without calling the provider."
+        url = reverse('allaccess-callback', kwargs={'provider': self.provider.name})
+        response = self.client.get(url)
+        self.assertRedirects(response, settings.LOGIN_URL)
+        self.assertFalse(get_client.called)
+
+    def test_hide_provider(self):
+        "Unavailable providers can be hidden from the context."
+        request = RequestFactory().get('/')
+        context = available_providers(request)
+        self.assertIn(self.provider, context['allaccess_providers'])
+        with self.settings(ALLACCESS_HIDE_UNAVAILABLE_PROVIDERS=True):
+            context = available_providers(request)
+            self.assertNotIn(self.provider, context['allaccess_providers'])
@@ -1,12 +1,20 @@
 "OAuth 1.0 and 2.0 client tests."
 from __future__ import unicode_literals
 
+import json
+import time
+from datetime import timedelta
+
+from django.test import override_settings
 from django.test.client import RequestFactory
+from django.utils import timezone
 
-from requests.exceptions import RequestException
+from requests import Request
+from requests.cookies import extract_cookies_to_jar
+from requests.exceptions import ConnectionError, RequestException, Timeout
 
 from .base import AllAccessTestCase
-from ..clients import OAuthClient, OAuth2Client
+from ..clients import OAuthClient, OAuth2Client, get_session, close_sessions
 from ..compat import urlparse, parse_qs, patch, Mock
 
 
@@ -48,7 +56,7 @@ class BaseClientTestCase(object):
 
 
 @patch('allaccess.clients.OAuth1')
-@patch('allaccess.clients.request')
+@patch('allaccess.clients.Session.request')
 class OAuthClientTestCase(BaseClientTestCase, AllAccessTestCase):
     "OAuth 1.0 client handling to match http://oauth.net/core/1.0/"
 
@@ -144,6 +152,15 @@ class OAuthClientTestCase(BaseClientTestCase, AllAccessTestCase):
         self.assertFalse(requests.called)
         self.assertFalse(auth.called)
 
+    def test_callback_key(self, requests, auth):
+        "Duplicate callbacks are identified by the request token and verifier."
+        request = self.factory.get('/callback/', {'oauth_verifier': 'verifier'})
+        request.session = {self.oauth.session_key: 'oauth_token=token&oauth_token_secret=secret'}
+        self.assertEqual(
+            self.oauth.get_callback_key(request), ('oauth_token=token&oauth_token_secret=secret', 'verifier'))
+        request.session = {}
+        self.assertIsNone(self.oauth.get_callback_key(request))
+
     def test_access_token_bad_request_token(self, requests, auth):
         "Handle bad request token found in the session."
         request = self.factory.get('/callback/', {'oauth_verifier': 'verifier'})
@@ -214,6 +231,43 @@ class OAuthClientTestCase(BaseClientTestCase, AllAccessTestCase):
         response = self.oauth.get_profile_info(raw_token)
         self.assertEqual(response, None)
 
+    def test_signer_reused(self, requests, auth):
+        "The signer is built once for repeated requests with the same token."
+        self.oauth.token = 'oauth_token=token&oauth_token_secret=secret'
+        for _ in range(3):
+            self.oauth.request('get', 'http://example.com/')
+        self.assertEqual(auth.call_count, 1)
+        args, kwargs = requests.call_args
+        self.assertEqual(kwargs['auth'], auth.return_value)
+        self.oauth.request('get', 'http://example.com/', token='oauth_token=other&oauth_token_secret=secret')
+        self.assertEqual(auth.call_count, 2)
+        args, kwargs = auth.call_args
+        self.assertEqual(kwargs['resource_owner_key'], 'other')
+
+    def test_signer_not_reused_for_flow(self, requests, auth):
+        "Requests with a callback or verifier always build a new signer."
+        request = self.factory.get('/login/')
+        self.oauth.get_request_token(request, callback='/callback/')
+        self.oauth.get_request_token(request, callback='/callback/')
+        self.assertEqual(auth.call_count, 2)
+        self.assertIsNone(self.oauth._signer)
+
+    def test_token_profile(self, requests, auth):
+        "Identifier can be read from the access token response."
+        raw_token = 'oauth_token=token&oauth_token_secret=secret&user_id=100&screen_name=user'
+        self.assertIsNone(self.oauth.get_token_profile(raw_token))
+        options = {self.provider.name: {'token_identifier': 'user_id'}}
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS=options):
+            profile = self.oauth.get_token_profile(raw_token)
+        self.assertEqual(profile, {'id': '100', 'user_id': '100', 'screen_name': 'user'})
+
+    def test_parse_token(self, requests, auth):
+        "Parse the token and secret into a Token."
+        token = self.oauth.parse_token('oauth_token=token&oauth_token_secret=secret')
+        self.assertEqual(token.access_token, 'token')
+        self.assertEqual(token.secret, 'secret')
+        self.assertIsNone(token.expires_at)
+
     def test_request_with_user_token(self, requests, auth):
         "Use token for request auth."
         token = 'oauth_token=token&oauth_token_secret=secret'
@@ -227,7 +281,7 @@ class OAuthClientTestCase(BaseClientTestCase, AllAccessTestCase):
         self.assertEqual(kwargs['resource_owner_secret'], 'secret')
 
 
-@patch('allaccess.clients.request')
+@patch('allaccess.clients.Session.request')
 class OAuth2ClientTestCase(BaseClientTestCase, AllAccessTestCase):
     "OAuth 2.0 client handling."
 
@@ -351,6 +405,110 @@ class OAuth2ClientTestCase(BaseClientTestCase, AllAccessTestCase):
         self.assertEqual(token, None)
         self.assertEqual(secret, None)
 
+    def test_parse_token_details(self, requests):
+        "Parse the refresh token, expiry and scopes from the token response."
+        raw_token = json.dumps({
+            'access_token': 'USER_ACCESS_TOKEN', 'refresh_token': 'REFRESH',
+            'expires_in': 3600, 'scope': 'email profile',
+        })
+        token = self.oauth.parse_token(raw_token)
+        self.assertEqual(token.raw, raw_token)
+        self.assertEqual(token.access_token, 'USER_ACCESS_TOKEN')
+        self.assertEqual(token.refresh_token, 'REFRESH')
+        self.assertEqual(token.scopes, ('email', 'profile'))
+        expected = timezone.now() + timedelta(seconds=3600)
+        self.assertTrue(abs(token.expires_at - expected) < timedelta(seconds=5))
+        self.assertFalse(token.is_expired)
+
+    def test_parse_token_details_query(self, requests):
+        "Parse the expiry and scopes from a url encoded token response."
+        token = self.oauth.parse_token('access_token=USER_ACCESS_TOKEN&expires=0&scope=a,b')
+        self.assertEqual(token.scopes, ('a', 'b'))
+        self.assertTrue(token.is_expired)
+        self.assertIsNone(token.refresh_token)
+
+    def test_parse_token_without_expiry(self, requests):
+        "Tokens without an expiry never expire."
+        token = self.oauth.parse_token('{"access_token": "USER_ACCESS_TOKEN", "expires_in": "never"}')
+        self.assertIsNone(token.expires_at)
+        self.assertFalse(token.is_expired)
+        self.assertEqual(token.scopes, ())
+
+    def test_token_profile(self, requests):
+        "Identifier can be read from a nested value in the token response."
+        raw_token = json.dumps({
+            'access_token': 'token', 'team': {'id': 'T1'}, 'authed_user': {'id': 'U1'}})
+        options = {self.provider.name: {'token_identifier': 'authed_user.id'}}
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS=options):
+            profile = self.oauth.get_token_profile(raw_token)
+            self.assertEqual(profile, {'id': 'U1', 'team': {'id': 'T1'}, 'authed_user': {'id': 'U1'}})
+            self.assertIsNone(self.oauth.get_token_profile('{"access_token": "token"}'))
+            self.assertIsNone(self.oauth.get_token_profile('{"authed_user": "U1"}'))
+        self.assertFalse(requests.called)
+
+    def test_refresh_access_token(self, requests):
+        "Fetch a new access token with the refresh token grant."
+        response = Mock()
+        response.text = '{"access_token": "NEW", "refresh_token": "NEW_REFRESH", "expires_in": 60}'
+        requests.return_value = response
+        self.oauth.token = '{"access_token": "OLD", "refresh_token": "REFRESH"}'
+        refreshed = self.oauth.refresh_access_token()
+        self.assertEqual(refreshed, response.text)
+        self.assertEqual(self.oauth.token, refreshed)
+        args, kwargs = requests.call_args
+        self.assertEqual(args, ('post', self.provider.access_token_url))
+        self.assertEqual(kwargs['data']['grant_type'], 'refresh_token')
+        self.assertEqual(kwargs['data']['refresh_token'], 'REFRESH')
+        self.assertEqual(kwargs['data']['client_secret'], self.consumer_secret)
+        self.assertNotIn('access_token', kwargs.get('params', {}))
+        self.assertEqual(self.oauth.get_token().access_token, 'NEW')
+
+    def test_refresh_keeps_refresh_token(self, requests):
+        "Refresh token is kept when the provider does not return a new one."
+        response = Mock()
+        response.text = 'access_token=NEW&expires_in=60'
+        requests.return_value = response
+        refreshed = self.oauth.refresh_access_token('access_token=OLD&refresh_token=REFRESH')
+        token = self.oauth.get_token(refreshed)
+        self.assertEqual(token.access_token, 'NEW')
+        self.assertEqual(token.refresh_token, 'REFRESH')
+        self.assertIsNotNone(token.expires_at)
+
+    def test_refresh_without_refresh_token(self, requests):
+        "Tokens without a refresh token cannot be refreshed."
+        self.assertIsNone(self.oauth.refresh_access_token('{"access_token": "OLD"}'))
+        self.assertFalse(requests.called)
+
+    def test_refresh_failure(self, requests):
+        "Handle upstream server errors when refreshing the token."
+        requests.side_effect = RequestException('Server Down')
+        self.assertIsNone(self.oauth.refresh_access_token('{"refresh_token": "REFRESH"}'))
+
+    def test_token_parsed_once(self, requests):
+        "The client token is parsed once for repeated requests."
+        self.oauth.token = '{"access_token": "USER_ACCESS_TOKEN"}'
+        with patch.object(self.oauth, 'parse_raw_token', wraps=self.oauth.parse_raw_token) as parse:
+            for _ in range(3):
+                self.oauth.request('get', self.provider.profile_url)
+            self.assertEqual(parse.call_count, 1)
+        args, kwargs = requests.call_args
+        self.assertEqual(kwargs['params']['access_token'], 'USER_ACCESS_TOKEN')
+
+    def test_token_changed(self, requests):
+        "A new token is parsed when it changes."
+        first = self.oauth.get_token('access_token=first')
+        self.assertIs(self.oauth.get_token('access_token=first'), first)
+        self.assertEqual(self.oauth.get_token('access_token=second').access_token, 'second')
+
+    def test_callback_key(self, requests):
+        "Duplicate callbacks are identified by the state and code."
+        request = self.factory.get('/callback/', {'code': 'code', 'state': 'foo'})
+        request.session = {self.oauth.session_key: 'foo'}
+        self.assertEqual(self.oauth.get_callback_key(request), ('foo', 'foo', 'code'))
+        request.session = {}
+        self.assertIsNone(self.oauth.get_callback_key(request))
+        self.assertFalse(requests.called)
+
     def test_access_token_no_state_session(self, requests):
         "Handle no state found in the session."
         request = self.factory.get('/callback/', {'code': 'code', 'state': 'foo'})
@@ -383,3 +541,139 @@ class OAuth2ClientTestCase(BaseClientTestCase, AllAccessTestCase):
         self.assertTrue(requests.called)
         args, kwargs = requests.call_args
         self.assertEqual(kwargs['params']['access_token'], 'USER_ACCESS_TOKEN')
+
+
+class SessionRegistryTestCase(AllAccessTestCase):
+    "Pooled HTTP sessions shared by the clients of a provider."
+
+    def setUp(self):
+        self.provider = self.create_provider()
+
+    def tearDown(self):
+        close_sessions()
+
+    def test_reuse_session(self):
+        "Clients for the same provider share a single session."
+        first = OAuth2Client(self.provider)
+        second = OAuth2Client(self.provider, token='token')
+        self.assertIs(first.http_session, second.http_session)
+
+    def test_session_per_provider(self):
+        "Each provider gets its own session."
+        other = self.create_provider()
+        self.assertIsNot(get_session(self.provider), get_session(other))
+
+    def test_close_sessions(self):
+        "Closed sessions are replaced on the next lookup."
+        session = get_session(self.provider)
+        close_sessions()
+        self.assertIsNot(get_session(self.provider), session)
+
+    @override_settings(ALLACCESS_PROVIDER_OPTIONS={'default': {'pool_maxsize': 25}})
+    def test_pool_size(self):
+        "Connection pool size is configurable."
+        adapter = get_session(self.provider).get_adapter('https://example.com/')
+        self.assertEqual(adapter._pool_maxsize, 25)
+
+    def test_keep_alive_disabled(self):
+        "Connections can be closed after each request per provider."
+        options = {self.provider.name: {'keep_alive': False}}
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS=options):
+            session = get_session(self.provider)
+        self.assertEqual(session.headers['Connection'], 'close')
+
+    def test_cookies_not_stored(self):
+        "Cookies set by the provider are not kept on the shared session."
+        session = get_session(self.provider)
+        request = Request('GET', 'https://example.com/').prepare()
+        headers = Mock()
+        headers.get_all.return_value = ['sessionid=abc; Path=/']
+        headers.getheaders.return_value = ['sessionid=abc; Path=/']
+        response = Mock(_original_response=Mock(msg=headers))
+        extract_cookies_to_jar(session.cookies, request, response)
+        self.assertEqual(len(session.cookies), 0)
+
+
+@patch('allaccess.clients.time.sleep')
+@patch('allaccess.clients.Session.request')
+class TimeoutRetryTestCase(AllAccessTestCase):
+    "Timeouts, retries and deadlines for provider requests."
+
+    def setUp(self):
+        self.provider = self.create_provider()
+        self.oauth = OAuth2Client(self.provider)
+
+    def test_default_timeout(self, requests, sleep):
+        "Requests are sent with the configured connect and read timeouts."
+        self.oauth.request('get', 'http://example.com/')
+        args, kwargs = requests.call_args
+        self.assertEqual(kwargs['timeout'], (5, 10))
+
+    def test_provider_timeout(self, requests, sleep):
+        "Timeouts can be configured per provider."
+        options = {self.provider.name: {'connect_timeout': 1, 'read_timeout': 2}}
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS=options):
+            self.oauth.request('get', 'http://example.com/')
+        args, kwargs = requests.call_args
+        self.assertEqual(kwargs['timeout'], (1, 2))
+
+    def test_deadline_limits_timeout(self, requests, sleep):
+        "Timeouts are shortened to the time left before the deadline."
+        self.oauth.deadline = time.time() + 1
+        self.oauth.request('get', 'http://example.com/')
+        args, kwargs = requests.call_args
+        connect, read = kwargs['timeout']
+        self.assertTrue(0 < connect <= 1)
+        self.assertTrue(0 < read <= 1)
+
+    def test_deadline_exceeded(self, requests, sleep):
+        "No request is made once the deadline has passed."
+        self.oauth.deadline = time.time() - 1
+        self.assertIsNone(self.oauth.get_profile_info('access_token=token'))
+        self.assertFalse(requests.called)
+
+    def test_retry_get(self, requests, sleep):
+        "Idempotent requests are retried on connection errors."
+        response = Mock(status_code=200)
+        requests.side_effect = [ConnectionError('Reset'), Timeout('Slow'), response]
+        self.assertEqual(self.oauth.request('get', 'http://example.com/'), response)
+        self.assertEqual(requests.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_retry_limit(self, requests, sleep):
+        "Errors are raised once the retries are used up."
+        requests.side_effect = ConnectionError('Down')
+        with self.assertRaises(ConnectionError):
+            self.oauth.request('get', 'http://example.com/')
+        self.assertEqual(requests.call_count, 3)
+
+    def test_retry_status(self, requests, sleep):
+        "Idempotent requests are retried on gateway errors."
+        unavailable = Mock(status_code=503)
+        requests.side_effect = [unavailable, Mock(status_code=200)]
+        response = self.oauth.request('get', 'http://example.com/')
+        self.assertEqual(response.status_code, 200)
+        # Retried response is closed to release its pooled connection
+        self.assertTrue(unavailable.close.called)
+        self.assertFalse(response.close.called)
+
+    def test_no_retry_post(self, requests, sleep):
+        "Non-idempotent requests are not retried."
+        requests.side_effect = ConnectionError('Down')
+        with self.assertRaises(ConnectionError):
+            self.oauth.request('post', 'http://example.com/')
+        self.assertEqual(requests.call_count, 1)
+
+    def test_no_retry_past_deadline(self, requests, sleep):
+        "Retries are not attempted if the backoff would pass the deadline."
+        requests.side_effect = ConnectionError('Down')
+        # Fixed clock so the deadline has not passed before the first request
+        now = time.time()
+        self.oauth.deadline = now + 0.001
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS={'default': {'retry_backoff': 10}}):
+            with self.assertRaises(ConnectionError):
+                with patch('allaccess.clients.random.uniform', return_value=5):
+                    with patch('allaccess.clients.time.time', return_value=now):
+                        self.oauth.request('get', 'http://example.com/')
+        self.assertEqual(requests.call_count, 1)
+        self.assertFalse(sleep.called)
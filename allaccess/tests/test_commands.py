@@ -0,0 +1,450 @@
+"Management command tests."
+from __future__ import unicode_literals
+
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from requests.exceptions import RequestException
+
+from .base import AllAccessTestCase, Provider, AccountAccess
+from ..fields import decrypted_text
+from ..transfer import Importer, read_allauth
+from ..compat import patch, Mock
+
+
+class ReencryptFieldsTestCase(AllAccessTestCase):
+    "Re-encrypt stored values after rotating the secret key."
+
+    def setUp(self):
+        with override_settings(ALLACCESS_SECRET_KEYS=['old']):
+            self.provider = self.create_provider(consumer_key='key', consumer_secret='secret')
+            self.access = self.create_access(provider=self.provider, access_token='token')
+
+    def get_raw(self):
+        provider = Provider.objects.extra(select={'raw_key': 'consumer_key'}).get(pk=self.provider.pk)
+        access = AccountAccess.objects.extra(select={'raw_token': 'access_token'}).get(pk=self.access.pk)
+        return provider.raw_key, access.raw_token
+
+    def call_command(self, **kwargs):
+        output = StringIO()
+        call_command('reencrypt_fields', stdout=output, **kwargs)
+        return output.getvalue()
+
+    @override_settings(ALLACCESS_SECRET_KEYS=['new', 'old'])
+    def test_read_previous_key(self):
+        "Values saved with a previous key in the keyring can be read."
+        provider = Provider.objects.get(pk=self.provider.pk)
+        self.assertEqual(provider.consumer_key, 'key')
+        self.assertEqual(AccountAccess.objects.get(pk=self.access.pk).access_token, 'token')
+
+    @override_settings(ALLACCESS_SECRET_KEYS=['new', 'old'])
+    def test_reencrypt(self):
+        "Values are re-encrypted with the current key."
+        before = self.get_raw()
+        output = self.call_command()
+        after = self.get_raw()
+        self.assertNotEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+        self.assertIn('allaccess.Provider: re-encrypted 1 rows.', output)
+        with override_settings(ALLACCESS_SECRET_KEYS=['new']):
+            provider = Provider.objects.get(pk=self.provider.pk)
+            self.assertEqual(provider.consumer_key, 'key')
+            self.assertEqual(provider.consumer_secret, 'secret')
+            self.assertEqual(AccountAccess.objects.get(pk=self.access.pk).access_token, 'token')
+
+    @override_settings(ALLACCESS_SECRET_KEYS=['new', 'old'])
+    def test_skip_current(self):
+        "Values already using the current key are not changed."
+        self.call_command()
+        before = self.get_raw()
+        output = self.call_command()
+        self.assertEqual(before, self.get_raw())
+        self.assertIn('allaccess.Provider: re-encrypted 0 rows.', output)
+
+    @override_settings(ALLACCESS_SECRET_KEYS=['new', 'old'])
+    def test_resume(self):
+        "Completed chunks recorded in the state file are skipped."
+        handle, state_file = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, state_file)
+        with open(state_file, 'w') as f:
+            json.dump({'allaccess.AccountAccess': self.access.pk + 1}, f)
+        before = self.get_raw()
+        self.call_command(state_file=state_file, chunk_size=10)
+        after = self.get_raw()
+        self.assertNotEqual(before[0], after[0])
+        self.assertEqual(before[1], after[1])
+        with open(state_file) as f:
+            state = json.load(f)
+        self.assertEqual(state['allaccess.Provider'], self.provider.pk + 10)
+
+
+@patch('allaccess.clients.Session.request')
+class RefreshTokensTestCase(AllAccessTestCase):
+    "Refresh access tokens which are about to expire."
+
+    def setUp(self):
+        self.provider = self.create_provider(consumer_key='key', consumer_secret='secret')
+        self.expiring = self.create_access(
+            provider=self.provider, access_token='{"access_token": "old", "refresh_token": "refresh"}',
+            expires_at=timezone.now() + timedelta(seconds=60))
+        self.later = self.create_access(
+            provider=self.provider, access_token='{"access_token": "later", "refresh_token": "refresh"}',
+            expires_at=timezone.now() + timedelta(days=1))
+        self.never = self.create_access(provider=self.provider, access_token='{"access_token": "never"}')
+
+    def call_command(self, **kwargs):
+        output = StringIO()
+        call_command('refresh_tokens', stdout=output, **kwargs)
+        return output.getvalue()
+
+    def get_response(self, *args, **kwargs):
+        response = Mock()
+        response.status_code = 200
+        response.text = '{"access_token": "new", "expires_in": 3600}'
+        return response
+
+    def test_refresh_expiring(self, requests):
+        "Only tokens expiring within the window are refreshed."
+        requests.side_effect = self.get_response
+        output = self.call_command(window=300)
+        self.assertIn('Refreshed 1 tokens, 0 failed.', output)
+        access = AccountAccess.objects.get(pk=self.expiring.pk)
+        token = access.api_client.get_token()
+        self.assertEqual(token.access_token, 'new')
+        self.assertEqual(token.refresh_token, 'refresh')
+        self.assertTrue(access.expires_at > timezone.now() + timedelta(seconds=3500))
+        later = AccountAccess.objects.get(pk=self.later.pk)
+        self.assertEqual(later.access_token, self.later.access_token)
+        self.assertEqual(requests.call_count, 1)
+
+    def test_refresh_failure(self, requests):
+        "Failed refreshes leave the token unchanged."
+        requests.return_value = Mock(status_code=400, text='{"error": "invalid_grant"}')
+        requests.return_value.raise_for_status.side_effect = RequestException('Bad Request')
+        output = self.call_command(window=300)
+        self.assertIn('Refreshed 0 tokens, 1 failed.', output)
+        access = AccountAccess.objects.get(pk=self.expiring.pk)
+        self.assertEqual(access.access_token, self.expiring.access_token)
+
+    def test_skip_long_expired(self, requests):
+        "Tokens which expired before the lower bound are no longer retried."
+        AccountAccess.objects.filter(pk=self.expiring.pk).update(
+            expires_at=timezone.now() - timedelta(hours=2))
+        requests.return_value = Mock(status_code=400, text='{"error": "invalid_grant"}')
+        requests.return_value.raise_for_status.side_effect = RequestException('Bad Request')
+        output = self.call_command(window=300)
+        self.assertIn('Refreshed 0 tokens, 0 failed.', output)
+        output = self.call_command(window=300, max_expired=3 * 3600)
+        self.assertIn('Refreshed 0 tokens, 1 failed.', output)
+
+    def test_chunks(self, requests):
+        "Tokens are read in chunks."
+        requests.side_effect = self.get_response
+        self.create_access(
+            provider=self.provider, access_token='{"refresh_token": "refresh"}', expires_at=timezone.now())
+        output = self.call_command(window=300, chunk_size=1)
+        self.assertIn('Refreshed 2 tokens, 0 failed.', output)
+
+    def test_changed_while_refreshing(self, requests):
+        "A token saved by a login during the refresh is not overwritten."
+
+        def login(*args, **kwargs):
+            AccountAccess.objects.upsert(self.provider, self.expiring.identifier, '{"access_token": "login"}')
+            return self.get_response()
+
+        requests.side_effect = login
+        # Run the requests in this thread so the login uses the test transaction
+        with patch('allaccess.management.commands.refresh_tokens.ThreadPool') as pool:
+            pool.return_value.imap_unordered.side_effect = map
+            output = self.call_command(window=300)
+        self.assertIn('Refreshed 0 tokens, 0 failed.', output)
+        self.assertIn('Skipped 1 tokens which were changed while refreshing.', output)
+        access = AccountAccess.objects.with_tokens().get(pk=self.expiring.pk)
+        self.assertEqual(access.api_client.get_token().access_token, 'login')
+
+    def test_skip_oauth1(self, requests):
+        "OAuth 1.0 providers are not refreshed."
+        self.provider.request_token_url = self.get_random_url()
+        self.provider.save()
+        output = self.call_command(window=300)
+        self.assertIn('Refreshed 0 tokens, 0 failed.', output)
+        self.assertFalse(requests.called)
+
+    def test_provider_filter(self, requests):
+        "Tokens can be refreshed for selected providers."
+        output = self.call_command(window=300, providers=['other'])
+        self.assertIn('Refreshed 0 tokens, 0 failed.', output)
+        self.assertFalse(requests.called)
+
+    def test_concurrency(self, requests):
+        "Refresh requests for a provider are limited by the concurrency."
+        # Second provider so the pool has more threads than the provider limit
+        self.create_provider(consumer_key='key', consumer_secret='secret')
+        for _ in range(5):
+            self.create_access(
+                provider=self.provider, access_token='{"refresh_token": "refresh"}',
+                expires_at=timezone.now())
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def slow_response(*args, **kwargs):
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.pop()
+            return self.get_response()
+
+        requests.side_effect = slow_response
+        output = self.call_command(window=300, concurrency=2)
+        self.assertIn('Refreshed 6 tokens, 0 failed.', output)
+        self.assertTrue(max(peak) <= 2)
+
+
+class TransferAccountsTestCase(AllAccessTestCase):
+    "Stream access records to and from files and other libraries."
+
+    def setUp(self):
+        self.provider = self.create_provider(consumer_key='key', consumer_secret='secret')
+        self.user = self.create_user()
+        self.access = self.create_access(
+            provider=self.provider, user=self.user, access_token='token',
+            expires_at=timezone.now() + timedelta(hours=1))
+        handle, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def call_command(self, name, *args, **kwargs):
+        output = StringIO()
+        call_command(name, *args, stdout=output, **kwargs)
+        return output.getvalue()
+
+    def read_export(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def write_import(self, *records):
+        with open(self.path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def get_access(self, identifier=None):
+        return AccountAccess.objects.with_tokens().get(
+            provider=self.provider, identifier=identifier or self.access.identifier)
+
+    def test_export(self):
+        "Records are written with the provider name and stored token."
+        output = self.call_command('export_accounts', self.path)
+        self.assertIn('Exported 1 records.', output)
+        record, = self.read_export()
+        self.assertEqual(record['provider'], self.provider.name)
+        self.assertEqual(record['identifier'], self.access.identifier)
+        self.assertEqual(record['user'], self.user.pk)
+        self.assertNotEqual(record['access_token'], 'token')
+
+    def test_export_decrypt(self):
+        "Tokens can be exported as plain text."
+        self.call_command('export_accounts', self.path, decrypt=True)
+        record, = self.read_export()
+        self.assertEqual(record['access_token'], 'token')
+
+    def test_export_stdout(self):
+        "Records are written to standard output without a path."
+        self.create_access(provider=self.provider)
+        output = self.call_command('export_accounts', format='csv', chunk_size=1)
+        lines = output.splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], 'provider,identifier,user,created,modified,expires_at,access_token')
+
+    def test_export_providers(self):
+        "Records can be limited to the named providers."
+        other = self.create_access()
+        self.call_command('export_accounts', self.path, providers=[other.provider.name])
+        record, = self.read_export()
+        self.assertEqual(record['identifier'], other.identifier)
+
+    def test_round_trip(self):
+        "Exported records are restored with their tokens and timestamps."
+        for path in (self.path, self.path[:-len('jsonl')] + 'csv'):
+            self.call_command('export_accounts', path)
+            AccountAccess.objects.all().delete()
+            output = self.call_command('import_accounts', path)
+            self.assertIn('Created 1 records, updated 0, skipped 0.', output)
+            access = self.get_access()
+            self.assertEqual(access.user, self.user)
+            self.assertEqual(access.access_token, 'token')
+            self.assertEqual(access.created, self.access.created)
+            self.assertEqual(access.expires_at, self.access.expires_at)
+            if path != self.path:
+                os.remove(path)
+
+    def test_skip_existing(self):
+        "Existing records are not changed unless updating."
+        self.write_import({'provider': self.provider.name, 'identifier': self.access.identifier,
+                           'access_token': 'new'})
+        output = self.call_command('import_accounts', self.path)
+        self.assertIn('Created 0 records, updated 0, skipped 1.', output)
+        self.assertEqual(self.get_access().access_token, 'token')
+        output = self.call_command('import_accounts', self.path, update=True)
+        self.assertIn('Created 0 records, updated 1, skipped 0.', output)
+        access = self.get_access()
+        self.assertEqual(access.access_token, 'new')
+        self.assertEqual(access.user, self.user)
+
+    def test_update_given_values(self):
+        "Only the values in the record are updated."
+        expires_at = timezone.now() + timedelta(days=2)
+        self.write_import({'provider': self.provider.name, 'identifier': self.access.identifier,
+                           'expires_at': expires_at.isoformat()})
+        output = self.call_command('import_accounts', self.path, update=True)
+        self.assertIn('Created 0 records, updated 1, skipped 0.', output)
+        access = self.get_access()
+        self.assertEqual(access.access_token, 'token')
+        self.assertEqual(access.expires_at, expires_at)
+        self.assertEqual(access.user, self.user)
+
+    def test_created_concurrently(self):
+        "Pairs created after they were checked are kept rather than failing the import."
+        records = [
+            {'provider': self.provider.name, 'identifier': self.access.identifier, 'access_token': 'new'},
+            {'provider': self.provider.name, 'identifier': '123', 'access_token': 'new'},
+        ]
+        with patch.object(Importer, 'get_existing', return_value={}):
+            stats = Importer().run(records)
+        self.assertEqual(stats, {'created': 1, 'updated': 0, 'skipped': 1})
+        self.assertEqual(self.get_access().access_token, 'token')
+        self.assertEqual(self.get_access('123').access_token, 'new')
+
+    def test_retry_chunk(self):
+        "Chunks which fail with an IntegrityError are loaded again."
+        self.write_import({'provider': self.provider.name, 'identifier': '123'})
+        with patch.object(Importer, 'insert', side_effect=[IntegrityError, 1]):
+            output = self.call_command('import_accounts', self.path)
+        self.assertIn('Created 1 records, updated 0, skipped 0.', output)
+
+    def test_unknown_provider(self):
+        "Records for unknown providers are skipped unless mapped to a provider."
+        self.write_import({'provider': 'unknown', 'identifier': '123'})
+        output = self.call_command('import_accounts', self.path)
+        self.assertIn('Created 0 records, updated 0, skipped 1.', output)
+        output = self.call_command(
+            'import_accounts', self.path, provider_map=['unknown={0}'.format(self.provider.name)])
+        self.assertIn('Created 1 records, updated 0, skipped 0.', output)
+        self.assertIsNone(self.get_access('123').user)
+
+    def test_users(self):
+        "Users are matched by username and can be created."
+        self.call_command('export_accounts', self.path, users=True)
+        record, = self.read_export()
+        self.assertEqual(record['user'], self.user.get_username())
+        AccountAccess.objects.all().delete()
+        self.call_command('import_accounts', self.path, users=True)
+        self.assertEqual(self.get_access().user, self.user)
+        username = '{0}@example.com'.format(self.get_random_string())
+        self.write_import({'provider': self.provider.name, 'identifier': '123', 'user': username})
+        self.call_command('import_accounts', self.path, create_users=True)
+        user = self.get_access('123').user
+        self.assertEqual(user.get_username(), username)
+        self.assertFalse(user.has_usable_password())
+
+    def test_chunk_queries(self):
+        "The number of queries for a chunk does not depend on its size."
+        records = [
+            {'provider': self.provider.name, 'identifier': str(i), 'access_token': 'token'}
+            for i in range(50)]
+
+        def count(records):
+            importer = Importer(chunk_size=100)
+            with CaptureQueriesContext(connection) as queries:
+                importer.run(records)
+            return len(queries)
+
+        self.assertEqual(count(records[:5]), count(records[5:]))
+        self.assertEqual(AccountAccess.objects.filter(provider=self.provider).count(), 51)
+        self.assertEqual(self.get_access('10').access_token, 'token')
+
+    @patch('allaccess.transfer.identity_filter')
+    def test_identity_filter(self, identity_filter):
+        "The identity filter is rebuilt after new records are created."
+        self.write_import({'provider': self.provider.name, 'identifier': '123'})
+        self.call_command('import_accounts', self.path)
+        identity_filter.reset.assert_called_once_with()
+
+    def create_table(self, sql, rows):
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            for row in rows:
+                placeholders = ', '.join(['%s'] * len(row[1]))
+                cursor.execute('INSERT INTO {0} VALUES ({1})'.format(row[0], placeholders), row[1])
+
+    def test_social_auth(self):
+        "Records are read from the python-social-auth table."
+        oauth1 = self.create_provider(request_token_url=self.get_random_url())
+        extra = [
+            {'access_token': 'abc', 'refresh_token': 'def', 'auth_time': 1500000000, 'expires': 3600},
+            {'access_token': {'oauth_token': 'ghi', 'oauth_token_secret': 'jkl'}},
+        ]
+        self.create_table(
+            'CREATE TABLE social_auth_usersocialauth (id integer PRIMARY KEY, provider varchar(32), '
+            'uid varchar(255), user_id integer, extra_data text)', [
+                ('social_auth_usersocialauth', (1, self.provider.name, '123', self.user.pk, json.dumps(extra[0]))),
+                ('social_auth_usersocialauth', (2, oauth1.name, '456', self.user.pk, json.dumps(extra[1]))),
+            ])
+        output = self.call_command('import_accounts', source='social_auth', chunk_size=1)
+        self.assertIn('Created 2 records, updated 0, skipped 0.', output)
+        access = self.get_access('123')
+        self.assertEqual(access.user, self.user)
+        self.assertEqual(json.loads(decrypted_text(access.access_token)), {'access_token': 'abc', 'refresh_token': 'def'})
+        self.assertEqual(access.expires_at, timezone.datetime(2017, 7, 14, 3, 40, tzinfo=timezone.utc))
+        access = AccountAccess.objects.with_tokens().get(provider=oauth1, identifier='456')
+        self.assertEqual(access.api_client.get_token().secret, 'jkl')
+
+    def test_allauth(self):
+        "Records are read from the django-allauth tables."
+        self.create_table(
+            'CREATE TABLE socialaccount_socialaccount (id integer PRIMARY KEY, provider varchar(30), '
+            'uid varchar(191), user_id integer)', [
+                ('socialaccount_socialaccount', (1, self.provider.name, '123', self.user.pk)),
+                ('socialaccount_socialaccount', (2, self.provider.name, '456', None)),
+            ])
+        self.create_table(
+            'CREATE TABLE socialaccount_socialtoken (id integer PRIMARY KEY, account_id integer, '
+            'token text, token_secret text, expires_at datetime)', [
+                ('socialaccount_socialtoken', (1, 1, 'abc', '', None)),
+            ])
+        output = self.call_command('import_accounts', source='allauth')
+        self.assertIn('Created 2 records, updated 0, skipped 0.', output)
+        self.assertEqual(json.loads(decrypted_text(self.get_access('123').access_token)), {'access_token': 'abc'})
+        self.assertIsNone(self.get_access('456').access_token)
+
+    def test_allauth_chunks(self):
+        "Every token of an account is read when the chunk is full."
+        self.create_table(
+            'CREATE TABLE socialaccount_socialaccount (id integer PRIMARY KEY, provider varchar(30), '
+            'uid varchar(191), user_id integer)', [
+                ('socialaccount_socialaccount', (1, self.provider.name, '123', None)),
+                ('socialaccount_socialaccount', (2, self.provider.name, '456', None)),
+            ])
+        self.create_table(
+            'CREATE TABLE socialaccount_socialtoken (id integer PRIMARY KEY, account_id integer, '
+            'token text, token_secret text, expires_at datetime)', [
+                ('socialaccount_socialtoken', (1, 1, 'abc', '', None)),
+                ('socialaccount_socialtoken', (2, 1, 'def', '', None)),
+                ('socialaccount_socialtoken', (3, 2, 'ghi', '', None)),
+            ])
+        records = list(read_allauth(chunk_size=1))
+        self.assertEqual([r['access_token']['token'] for r in records], ['abc', 'def', 'ghi'])
@@ -0,0 +1,98 @@
+"Coalescing of duplicate callbacks."
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.core.cache import cache
+from django.test import override_settings
+
+from .base import AllAccessTestCase
+from ..compat import Mock, patch
+from ..flight import SingleFlight
+
+
+class SingleFlightTestCase(AllAccessTestCase):
+    "Run the token exchange once for duplicate callbacks."
+
+    def setUp(self):
+        super(SingleFlightTestCase, self).setUp()
+        cache.clear()
+        self.provider = self.create_provider()
+
+    def test_reuse_result(self):
+        "Duplicate calls reuse the stored result."
+        func = Mock(return_value='token')
+        self.assertEqual(SingleFlight(self.provider, 'state', 'code').run(func), 'token')
+        self.assertEqual(SingleFlight(self.provider, 'state', 'code').run(func), 'token')
+        self.assertEqual(func.call_count, 1)
+
+    def test_other_key(self):
+        "Calls with different keys are not coalesced."
+        func = Mock(return_value='token')
+        SingleFlight(self.provider, 'state', 'code').run(func)
+        SingleFlight(self.provider, 'state', 'other').run(func)
+        SingleFlight(self.create_provider(), 'state', 'code').run(func)
+        self.assertEqual(func.call_count, 3)
+
+    def test_failed_result(self):
+        "Failed exchanges are shared since the code cannot be used again."
+        func = Mock(return_value=None)
+        self.assertIsNone(SingleFlight(self.provider, 'code').run(func))
+        self.assertIsNone(SingleFlight(self.provider, 'code').run(func))
+        self.assertEqual(func.call_count, 1)
+
+    def test_error(self):
+        "Errors release the lock for the next request."
+        func = Mock(side_effect=[ValueError, 'token'])
+        with self.assertRaises(ValueError):
+            SingleFlight(self.provider, 'code').run(func)
+        self.assertEqual(SingleFlight(self.provider, 'code').run(func), 'token')
+
+    def test_encrypted(self):
+        "Results are not stored in the cache as plain text."
+        flight = SingleFlight(self.provider, 'code')
+        flight.run(lambda: 'access_token=secret')
+        self.assertNotIn('secret', repr(cache.get(flight.key + '-result')))
+        self.assertNotIn('code', flight.key)
+
+    def test_wait_timeout(self):
+        "Requests run the call themselves if the first request does not finish."
+        flight = SingleFlight(self.provider, 'code')
+        cache.add(flight.key + '-lock', 1)
+        options = {self.provider.name: {'single_flight_timeout': 0}}
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS=options):
+            self.assertEqual(flight.run(lambda: 'token'), 'token')
+
+    def test_wait_deadline(self):
+        "Requests do not wait for the first request past the deadline."
+        flight = SingleFlight(self.provider, 'code')
+        cache.add(flight.key + '-lock', 1)
+        with patch('allaccess.flight.time.sleep') as sleep:
+            self.assertEqual(flight.run(lambda: 'token', deadline=time.time() - 1), 'token')
+        self.assertFalse(sleep.called)
+
+    def test_concurrent(self):
+        "Duplicate requests wait for the running exchange."
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def exchange():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'token'
+
+        def callback():
+            results.append(SingleFlight(self.provider, 'code').run(exchange))
+
+        first = threading.Thread(target=callback)
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=callback)
+        second.start()
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(results, ['token', 'token'])
+        self.assertEqual(len(calls), 1)
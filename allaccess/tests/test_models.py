@@ -1,7 +1,32 @@
 "Models and field encryption tests."
 from __future__ import unicode_literals
 
+import time
+import unittest
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+
 from .base import AllAccessTestCase, Provider, AccountAccess
+from ..cache import provider_cache
+from ..compat import patch, Mock
+from ..fields import (
+    AESGCM, AESGCMEncryption, EncryptedField, LazyDecryptedText, SignatureException, SignedAESEncryption,
+    decrypted_text,
+)
+
+
+# Prefix for the format used to save new values
+PREFIX = EncryptedField().cipher.prefix.decode('ascii') + '$'
+TOKEN_PREFIX = AccountAccess._meta.get_field('access_token').cipher.prefix.decode('ascii') + '$'
+CIPHER_CLASS = type(EncryptedField().cipher)
 
 
 class ProviderTestCase(AllAccessTestCase):
@@ -41,9 +66,9 @@ class ProviderTestCase(AllAccessTestCase):
             select={'raw_key': 'consumer_key', 'raw_secret': 'consumer_secret'}
         ).get(pk=self.provider.pk)
         self.assertNotEqual(provider.raw_key, key)
-        self.assertTrue(provider.raw_key.startswith('$AES$'))
+        self.assertTrue(provider.raw_key.startswith(PREFIX))
         self.assertNotEqual(provider.raw_secret, secret)
-        self.assertTrue(provider.raw_secret.startswith('$AES$'))
+        self.assertTrue(provider.raw_secret.startswith(PREFIX))
 
     def test_encrypted_fetch(self):
         "Decrypt key/secret on save."
@@ -57,6 +82,82 @@ class ProviderTestCase(AllAccessTestCase):
         self.assertEqual(provider.consumer_secret, secret, "Could not decrypt secret.")
 
 
+class ProviderCacheTestCase(AllAccessTestCase):
+    "Two-tier cache for provider lookups by name."
+
+    def setUp(self):
+        self.provider = self.create_provider(
+            consumer_key=self.get_random_string(), consumer_secret=self.get_random_string())
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_cached_lookup(self):
+        "Repeated lookups do not query the database."
+        Provider.objects.get_cached(self.provider.name)
+        with self.assertNumQueries(0):
+            provider = Provider.objects.get_cached(self.provider.name)
+        self.assertEqual(provider, self.provider)
+        self.assertEqual(provider.consumer_key, self.provider.consumer_key)
+
+    def test_unknown_provider(self):
+        "Unknown names raise DoesNotExist."
+        with self.assertRaises(Provider.DoesNotExist):
+            Provider.objects.get_cached('unknown')
+
+    @override_settings(ALLACCESS_PROVIDER_CACHE='default')
+    def test_unknown_not_cached(self):
+        "Unknown names are not stored in either cache."
+        with patch.object(cache, 'set') as shared_set:
+            for i in range(3):
+                with self.assertRaises(Provider.DoesNotExist):
+                    Provider.objects.get_cached(self.get_random_string())
+        self.assertFalse(shared_set.called)
+        self.assertEqual(list(provider_cache._local), [])
+
+    def test_expired_evicted(self):
+        "Expired entries are removed when another provider is loaded."
+        Provider.objects.get_cached(self.provider.name)
+        other = self.create_provider()
+        with patch('allaccess.cache.time.time', return_value=time.time() + 120):
+            Provider.objects.get_cached(other.name)
+        self.assertEqual(list(provider_cache._local), [other.name])
+
+    def test_invalidate_on_save(self):
+        "Saving a provider expires the cached value."
+        Provider.objects.get_cached(self.provider.name)
+        self.provider.consumer_key = None
+        self.provider.save()
+        provider = Provider.objects.get_cached(self.provider.name)
+        self.assertIsNone(provider.consumer_key)
+
+    def test_invalidate_on_delete(self):
+        "Deleting a provider expires the cached value."
+        Provider.objects.get_cached(self.provider.name)
+        self.provider.delete()
+        with self.assertRaises(Provider.DoesNotExist):
+            Provider.objects.get_cached(self.provider.name)
+
+    @override_settings(ALLACCESS_PROVIDER_CACHE='default')
+    def test_shared_cache(self):
+        "Providers are loaded from the shared cache when the process cache is empty."
+        Provider.objects.get_cached(self.provider.name)
+        provider_cache._local.clear()
+        with self.assertNumQueries(0):
+            provider = Provider.objects.get_cached(self.provider.name)
+        self.assertEqual(provider.pk, self.provider.pk)
+        self.assertEqual(provider.consumer_key, self.provider.consumer_key)
+        self.assertEqual(provider.consumer_secret, self.provider.consumer_secret)
+
+    @override_settings(ALLACCESS_PROVIDER_CACHE='default')
+    def test_shared_version(self):
+        "Changes from another process are seen through the shared version."
+        Provider.objects.get_cached(self.provider.name)
+        cache.incr(provider_cache.version_key)
+        with self.assertNumQueries(1):
+            Provider.objects.get_cached(self.provider.name)
+
+
 class AccountAccessTestCase(AllAccessTestCase):
     "Custom AccountAccess methods and access token encryption."
 
@@ -82,7 +183,7 @@ class AccountAccessTestCase(AllAccessTestCase):
             select={'raw_token': 'access_token'}
         ).get(pk=self.access.pk)
         self.assertNotEqual(access.raw_token, access_token)
-        self.assertTrue(access.raw_token.startswith('$AES$'))
+        self.assertTrue(access.raw_token.startswith(TOKEN_PREFIX))
         self.assertEqual(access.access_token, access_token, "Token should be unencrypted on fetch.")
 
     def test_encrypted_update(self):
@@ -93,9 +194,86 @@ class AccountAccessTestCase(AllAccessTestCase):
             select={'raw_token': 'access_token'}
         ).get(pk=self.access.pk)
         self.assertNotEqual(access.raw_token, access_token)
-        self.assertTrue(access.raw_token.startswith('$AES$'))
+        self.assertTrue(access.raw_token.startswith(TOKEN_PREFIX))
         self.assertEqual(access.access_token, access_token, "Token should be unencrypted on fetch.")
 
+    def test_lazy_decryption(self):
+        "Access token is not decrypted until it is used."
+        self.access.access_token = 'token'
+        self.access.save()
+        with patch.object(CIPHER_CLASS, 'decrypt', return_value=b'token') as decrypt:
+            access = AccountAccess.objects.get(pk=self.access.pk)
+            self.assertFalse(decrypt.called)
+            self.assertEqual(access.access_token, 'token')
+            self.assertEqual('{0}'.format(access.access_token), 'token')
+            self.assertEqual(decrypt.call_count, 1)
+
+    def test_lazy_decrypted_text(self):
+        "Lazy values are converted to plain text."
+        self.access.access_token = 'token'
+        self.access.save()
+        access = AccountAccess.objects.with_tokens().get(pk=self.access.pk)
+        self.assertIsInstance(access.access_token, LazyDecryptedText)
+        value = decrypted_text(access.access_token)
+        self.assertEqual(value, 'token')
+        self.assertIs(type(value), type(''))
+
+    def test_lazy_save(self):
+        "Unread access token is saved without encrypting it again."
+        self.access.access_token = 'token'
+        self.access.save()
+        access = AccountAccess.objects.get(pk=self.access.pk)
+        with patch.object(CIPHER_CLASS, 'encrypt') as encrypt:
+            access.save()
+            self.assertFalse(encrypt.called)
+        self.assertEqual(AccountAccess.objects.get(pk=self.access.pk).access_token, 'token')
+
+    def test_deferred_token(self):
+        "Access token is only loaded by querysets which ask for it."
+        self.access.access_token = 'token'
+        self.access.save()
+        access = AccountAccess.objects.get(pk=self.access.pk)
+        self.assertIn('access_token', access.get_deferred_fields())
+        with self.assertNumQueries(1):
+            access = AccountAccess.objects.with_tokens().get(pk=self.access.pk)
+            self.assertEqual(access.access_token, 'token')
+        access = AccountAccess.objects.only('identifier').with_tokens().get(pk=self.access.pk)
+        self.assertEqual(access.get_deferred_fields(), {'provider_id', 'user_id', 'created', 'modified', 'expires_at'})
+
+    def test_related_tokens(self):
+        "Related records and serialization load the tokens."
+        self.access.access_token = 'token'
+        self.access.save()
+        user = self.create_user()
+        self.access.user = user
+        self.access.save()
+        with self.assertNumQueries(1):
+            access = user.accountaccess_set.get()
+            self.assertEqual(access.access_token, 'token')
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command('dumpdata', 'allaccess.accountaccess', stdout=out)
+        self.assertIn('"access_token"', out.getvalue())
+
+    def test_deferred_save(self):
+        "Saving a record without its token keeps the token."
+        self.access.access_token = 'token'
+        self.access.save()
+        access = AccountAccess.objects.get(pk=self.access.pk)
+        with self.assertNumQueries(1):
+            access.save()
+        self.assertEqual(AccountAccess.objects.with_tokens().get(pk=self.access.pk).access_token, 'token')
+
+    def test_deferred_signals(self):
+        "Records loaded without the token remove the cached user when saved or deleted."
+        access = AccountAccess.objects.get(pk=self.access.pk)
+        with patch('allaccess.models.identity_cache') as identity_cache:
+            access.save()
+            identity_cache.invalidate.assert_called_once_with(self.access.provider_id, self.access.identifier)
+            identity_cache.reset_mock()
+            access.delete()
+            identity_cache.invalidate.assert_called_once_with(self.access.provider_id, self.access.identifier)
+
     def test_fetch_api_client(self):
         "Get API client with the provider and user token set."
         access_token = self.get_random_string()
@@ -104,3 +282,233 @@ class AccountAccessTestCase(AllAccessTestCase):
         api = self.access.api_client
         self.assertEqual(api.provider, self.access.provider)
         self.assertEqual(api.token, self.access.access_token)
+
+    def test_api_client_expiry(self):
+        "Token expiry comes from the record rather than the time the token is parsed."
+        self.access.access_token = '{"access_token": "token", "expires_in": 3600}'
+        self.access.expires_at = timezone.now() - timedelta(minutes=5)
+        self.access.save()
+        access = AccountAccess.objects.with_tokens().get(pk=self.access.pk)
+        token = access.api_client.get_token()
+        self.assertEqual(token.expires_at, self.access.expires_at)
+        self.assertTrue(token.is_expired)
+        access.expires_at = None
+        self.assertIsNone(access.api_client.get_token().expires_at)
+
+    def test_api_client_reused(self):
+        "API client is reused until the token changes."
+        self.access.access_token = 'first'
+        api = self.access.api_client
+        self.assertIs(self.access.api_client, api)
+        self.access.access_token = 'second'
+        self.assertIsNot(self.access.api_client, api)
+        self.assertEqual(self.access.api_client.token, 'second')
+
+
+class AccountAccessUpsertTestCase(AllAccessTestCase):
+    "Create or update access records from the callback."
+
+    def setUp(self):
+        self.provider = self.create_provider()
+
+    def test_create(self):
+        "Create a new access record for an unknown identifier."
+        access, created = AccountAccess.objects.upsert(self.provider, '100', 'token')
+        self.assertTrue(created)
+        self.assertTrue(access.pk)
+        self.assertEqual(access.identifier, '100')
+        self.assertEqual(access.access_token, 'token')
+        self.assertIsNone(access.user)
+
+    def test_update(self):
+        "Update the token for an existing record."
+        user = self.create_user()
+        existing = self.create_access(provider=self.provider, user=user, access_token='old')
+        access, created = AccountAccess.objects.upsert(self.provider, existing.identifier, 'new')
+        self.assertFalse(created)
+        self.assertEqual(access.pk, existing.pk)
+        self.assertEqual(access.user, user)
+        self.assertEqual(AccountAccess.objects.get(pk=existing.pk).access_token, 'new')
+
+    def test_post_save(self):
+        "post_save is only sent for new records."
+        existing = self.create_access(provider=self.provider)
+        handler = Mock()
+        post_save.connect(handler, sender=AccountAccess)
+        self.addCleanup(post_save.disconnect, handler, sender=AccountAccess)
+        AccountAccess.objects.upsert(self.provider, existing.identifier, 'token')
+        self.assertFalse(handler.called)
+        access, _ = AccountAccess.objects.upsert(self.provider, '100', 'token')
+        self.assertEqual(handler.call_count, 1)
+        args, kwargs = handler.call_args
+        self.assertEqual(kwargs['instance'], access)
+        self.assertTrue(kwargs['created'])
+
+    def test_identity_cache(self):
+        "New records remove any cached user for the pair."
+        with patch('allaccess.models.identity_cache') as identity_cache:
+            access, _ = AccountAccess.objects.upsert(self.provider, '100', 'token')
+            identity_cache.invalidate.assert_called_with(self.provider.pk, '100')
+
+    def test_expiry(self):
+        "Token expiry is saved with the token."
+        expires_at = timezone.now() + timedelta(hours=1)
+        existing = self.create_access(provider=self.provider)
+        access, _ = AccountAccess.objects.upsert(self.provider, existing.identifier, 'token', expires_at)
+        self.assertEqual(access.expires_at, expires_at)
+        access, _ = AccountAccess.objects.upsert(self.provider, existing.identifier, 'token')
+        self.assertIsNone(access.expires_at)
+
+    def test_encrypted(self):
+        "Token is encrypted by the upsert statement."
+        access, _ = AccountAccess.objects.upsert(self.provider, '100', 'token')
+        access = AccountAccess.objects.extra(
+            select={'raw_token': 'access_token'}
+        ).get(pk=access.pk)
+        self.assertTrue(access.raw_token.startswith(TOKEN_PREFIX))
+
+    def test_performance(self):
+        "Native upsert uses one statement plus the select of the user."
+        if AccountAccess.objects._get_upsert_sql(connection) is None:
+            self.skipTest('Database does not support native upsert.')
+        existing = self.create_access(provider=self.provider, user=self.create_user())
+        # SQLite updates an existing record with a second statement
+        with self.assertNumQueries(3 if connection.vendor == 'sqlite' else 2):
+            access, _ = AccountAccess.objects.upsert(self.provider, existing.identifier, 'token')
+            access.user
+
+    def test_fallback(self):
+        "Databases without native upsert update then create."
+        existing = self.create_access(provider=self.provider)
+        with patch.object(AccountAccess.objects, '_get_upsert_sql', return_value=None):
+            access, created = AccountAccess.objects.upsert(self.provider, existing.identifier, 'token')
+            self.assertFalse(created)
+            self.assertEqual(access.pk, existing.pk)
+            self.assertEqual(access.access_token, 'token')
+            access, created = AccountAccess.objects.upsert(self.provider, '100', 'token', timezone.now())
+            self.assertTrue(created)
+            self.assertEqual(access.identifier, '100')
+            self.assertIsNotNone(access.expires_at)
+
+
+@unittest.skipIf(AESGCM is None, 'cryptography is not installed')
+class AESGCMEncryptionTestCase(AllAccessTestCase):
+    "Authenticated encryption format and upgrade from the legacy format."
+
+    def setUp(self):
+        self.field = EncryptedField()
+        self.legacy = SignedAESEncryption()
+
+    def test_round_trip(self):
+        "Encrypted values can be decrypted."
+        cipher = AESGCMEncryption()
+        value = cipher.encrypt(b'secret')
+        self.assertTrue(value.startswith(b'$GCM$'))
+        self.assertEqual(cipher.decrypt(value), b'secret')
+
+    def test_tampered(self):
+        "Modified values fail authentication."
+        cipher = AESGCMEncryption()
+        value = bytearray(cipher.encrypt(b'secret'))
+        value[-1] = ord('0') if value[-1] != ord('0') else ord('1')
+        with self.assertRaises(SignatureException):
+            cipher.decrypt(bytes(value))
+
+    def test_read_legacy(self):
+        "Values saved in the AES format can still be read."
+        value = self.legacy.encrypt(b'secret').decode('ascii')
+        self.assertEqual(self.field.from_db_value(value, None, None, {}), 'secret')
+
+    @override_settings(ALLACCESS_ENCRYPTION_FORMAT='gcm')
+    def test_upgrade_on_save(self):
+        "Legacy values are saved in the AES-GCM format when it is selected."
+        access = self.create_access()
+        raw = self.legacy.encrypt(b'token').decode('ascii')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE allaccess_accountaccess SET access_token = %s WHERE id = %s', [raw, access.pk])
+        access = AccountAccess.objects.with_tokens().get(pk=access.pk)
+        access.save()
+        access = AccountAccess.objects.extra(
+            select={'raw_token': 'access_token'}
+        ).get(pk=access.pk)
+        self.assertTrue(access.raw_token.startswith('$GCM$'))
+        self.assertEqual(access.access_token, 'token')
+
+
+class EncryptionFormatTestCase(AllAccessTestCase):
+    "Explicit selection of the format used to save values."
+
+    def test_default(self):
+        "Values are saved in the AES format by default."
+        self.assertIsInstance(EncryptedField().cipher, SignedAESEncryption)
+
+    @unittest.skipIf(AESGCM is None, 'cryptography is not installed')
+    def test_gcm(self):
+        "AES-GCM is used when selected."
+        with self.settings(ALLACCESS_ENCRYPTION_FORMAT='gcm'):
+            self.assertIsInstance(EncryptedField().cipher, AESGCMEncryption)
+
+    def test_unknown(self):
+        "Unknown formats are rejected."
+        with patch('allaccess.fields.settings', ALLACCESS_ENCRYPTION_FORMAT='des'):
+            with self.assertRaises(ImproperlyConfigured):
+                EncryptedField().encryption_class
+
+    def test_gcm_unavailable(self):
+        "AES-GCM cannot be selected without cryptography."
+        with patch.object(AESGCMEncryption, 'available', False):
+            with patch('allaccess.fields.settings', ALLACCESS_ENCRYPTION_FORMAT='gcm'):
+                with self.assertRaises(ImproperlyConfigured):
+                    EncryptedField().encryption_class
+
+    def test_read_gcm_unavailable(self):
+        "AES-GCM values are recognized but not decrypted or encrypted again without cryptography."
+        value = '$GCM64$abcd1234$bm9uY2V2YWx1ZQ'
+        with patch.object(AESGCMEncryption, 'available', False):
+            field = EncryptedField()
+            with self.assertRaises(ImproperlyConfigured):
+                field.from_db_value(value, None, None, {})
+            self.assertEqual(field.get_db_prep_value(value), value)
+
+
+class CompactEncodingTestCase(AllAccessTestCase):
+    "Base64 encoded cypher text for smaller columns."
+
+    def test_round_trip(self):
+        "Values saved with the base64 encoding can be read."
+        field = EncryptedField(encoding='base64')
+        value = field.get_db_prep_value('secret')
+        self.assertTrue(value.startswith(PREFIX[:-1] + '64$'))
+        self.assertEqual(field.from_db_value(value, None, None, {}), 'secret')
+
+    def test_smaller(self):
+        "Base64 values are shorter than hex values."
+        clear_text = self.get_random_string(100)
+        compact = EncryptedField(encoding='base64').get_db_prep_value(clear_text)
+        legacy = EncryptedField().get_db_prep_value(clear_text)
+        self.assertLess(len(compact), len(legacy))
+
+    def test_read_hex(self):
+        "Fields using base64 can read hex encoded values."
+        value = EncryptedField().get_db_prep_value('secret')
+        field = EncryptedField(encoding='base64')
+        self.assertEqual(field.from_db_value(value, None, None, {}), 'secret')
+
+    def test_encoding_setting(self):
+        "Fields without an encoding use ALLACCESS_ENCRYPTION_ENCODING."
+        field = AccountAccess._meta.get_field('access_token')
+        self.assertTrue(field.get_db_prep_value('secret').startswith(PREFIX))
+        with self.settings(ALLACCESS_ENCRYPTION_ENCODING='base64'):
+            value = field.get_db_prep_value('secret')
+            self.assertTrue(value.startswith(PREFIX[:-1] + '64$'))
+            self.assertNotIn('encoding', field.deconstruct()[3])
+        self.assertEqual(field.from_db_value(value, None, None, {}), 'secret')
+        self.assertEqual(EncryptedField(encoding='hex').deconstruct()[3]['encoding'], 'hex')
+
+    def test_signed_aes(self):
+        "Legacy AES format also supports the base64 encoding."
+        cipher = SignedAESEncryption(encoding='base64')
+        value = cipher.encrypt(b'secret')
+        self.assertTrue(value.startswith(b'$AES64$'))
+        self.assertEqual(cipher.decrypt(value), b'secret')
@@ -0,0 +1,210 @@
+"OpenID Connect client tests."
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+from django.core.cache import cache
+from django.test import override_settings
+from django.test.client import RequestFactory
+from django.utils.encoding import force_bytes, force_text
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Util.number import long_to_bytes
+
+from .base import AllAccessTestCase
+from ..clients import get_client
+from ..compat import patch, Mock
+from ..oidc import OIDCClient, _documents
+
+
+ISSUER = 'https://accounts.example.com'
+DISCOVERY_URL = ISSUER + '/.well-known/openid-configuration'
+JWKS_URL = ISSUER + '/keys'
+
+
+def b64encode(value):
+    return force_text(base64.urlsafe_b64encode(force_bytes(value)).rstrip(b'='))
+
+
+def get_jwk(key, kid):
+    return {
+        'kty': 'RSA', 'use': 'sig', 'kid': kid,
+        'n': b64encode(long_to_bytes(key.n)), 'e': b64encode(long_to_bytes(key.e)),
+    }
+
+
+class OIDCClientTestCase(AllAccessTestCase):
+    "Local verification of the id_token."
+
+    @classmethod
+    def setUpClass(cls):
+        super(OIDCClientTestCase, cls).setUpClass()
+        cls.key = RSA.generate(1024)
+        cls.other_key = RSA.generate(1024)
+
+    def setUp(self):
+        super(OIDCClientTestCase, self).setUp()
+        cache.clear()
+        _documents.clear()
+        self.provider = self.create_provider(consumer_key='client', consumer_secret='secret')
+        options = {self.provider.name: {'oidc_issuer': ISSUER}}
+        patched_options = override_settings(ALLACCESS_PROVIDER_OPTIONS=options)
+        patched_options.enable()
+        self.addCleanup(patched_options.disable)
+        patched_request = patch('allaccess.clients.Session.request')
+        self.requests = patched_request.start()
+        self.addCleanup(patched_request.stop)
+        self.requests.side_effect = self.get_response
+        self.documents = {
+            DISCOVERY_URL: {'issuer': ISSUER, 'jwks_uri': JWKS_URL},
+            JWKS_URL: {'keys': [get_jwk(self.key, 'current')]},
+        }
+        self.oauth = get_client(self.provider)
+        self.factory = RequestFactory()
+
+    def get_response(self, method, url, **kwargs):
+        response = Mock()
+        response.status_code = 200
+        if url == self.provider.access_token_url:
+            response.text = self.token_response
+        elif url in self.documents:
+            response.json.return_value = self.documents[url]
+        else:
+            response.status_code = 404
+            response.raise_for_status.side_effect = ValueError
+        return response
+
+    def get_fetched(self, url):
+        return [c for c in self.requests.call_args_list if c[0][1] == url]
+
+    def get_claims(self, **kwargs):
+        claims = {
+            'iss': ISSUER, 'sub': '100', 'aud': 'client',
+            'iat': int(time.time()), 'exp': int(time.time()) + 300,
+        }
+        claims.update(kwargs)
+        return claims
+
+    def sign(self, claims, key=None, kid='current', alg='RS256'):
+        header = {'alg': alg, 'typ': 'JWT'}
+        if kid is not None:
+            header['kid'] = kid
+        signing_input = '{0}.{1}'.format(
+            b64encode(json.dumps(header)), b64encode(json.dumps(claims)))
+        if alg == 'HS256':
+            signature = hmac.new(b'secret', force_bytes(signing_input), hashlib.sha256).digest()
+        else:
+            signature = PKCS1_v1_5.new(key or self.key).sign(SHA256.new(force_bytes(signing_input)))
+        return '{0}.{1}'.format(signing_input, b64encode(signature))
+
+    def get_raw_token(self, id_token):
+        return json.dumps({'access_token': 'token', 'id_token': id_token})
+
+    def test_client_class(self):
+        "Providers with an issuer use the OpenID Connect client."
+        self.assertTrue(isinstance(self.oauth, OIDCClient))
+
+    def test_profile_from_claims(self):
+        "Claims are returned as the profile without a profile request."
+        raw_token = self.get_raw_token(self.sign(self.get_claims(email='user@example.com')))
+        profile = self.oauth.get_profile_info(raw_token)
+        self.assertEqual(profile['id'], '100')
+        self.assertEqual(profile['email'], 'user@example.com')
+        self.assertFalse(self.get_fetched(self.provider.profile_url))
+
+    def test_no_id_token(self):
+        "Profile is requested if there is no id_token."
+        self.documents[self.provider.profile_url] = {'id': 100}
+        profile = self.oauth.get_profile_info('{"access_token": "token"}')
+        self.assertEqual(profile, {'id': 100})
+
+    def test_invalid_signature(self):
+        "Tokens signed by another key are rejected."
+        raw_token = self.get_raw_token(self.sign(self.get_claims(), key=self.other_key))
+        self.assertIsNone(self.oauth.get_profile_info(raw_token))
+
+    def test_invalid_claims(self):
+        "Tokens for another issuer, audience or which have expired are rejected."
+        for claims in (
+                self.get_claims(iss='https://other.example.com'),
+                self.get_claims(aud='other'),
+                self.get_claims(aud=['client', 'other'], azp='other'),
+                self.get_claims(exp=int(time.time()) - 3600),
+                self.get_claims(sub=None)):
+            oauth = get_client(self.provider)
+            self.assertIsNone(oauth.get_profile_info(self.get_raw_token(self.sign(claims))))
+
+    def test_malformed(self):
+        "Garbage tokens are rejected."
+        for id_token in ('garbage', 'a.b.c', self.sign(self.get_claims(), alg='none')):
+            oauth = get_client(self.provider)
+            self.assertIsNone(oauth.get_profile_info(self.get_raw_token(id_token)))
+
+    def test_hmac(self):
+        "Tokens can be signed with the client secret."
+        raw_token = self.get_raw_token(self.sign(self.get_claims(), alg='HS256', kid=None))
+        self.assertEqual(self.oauth.get_profile_info(raw_token)['sub'], '100')
+        self.assertFalse(self.requests.called)
+
+    def test_documents_cached(self):
+        "Discovery and keys are fetched once and shared between clients."
+        for _ in range(2):
+            oauth = get_client(self.provider)
+            raw_token = self.get_raw_token(self.sign(self.get_claims()))
+            self.assertIsNotNone(oauth.get_profile_info(raw_token))
+        self.assertEqual(len(self.get_fetched(DISCOVERY_URL)), 1)
+        self.assertEqual(len(self.get_fetched(JWKS_URL)), 1)
+        # Another process with an empty local cache uses the shared cache
+        _documents.clear()
+        self.assertIsNotNone(get_client(self.provider).get_profile_info(
+            self.get_raw_token(self.sign(self.get_claims()))))
+        self.assertEqual(len(self.get_fetched(JWKS_URL)), 1)
+
+    @patch('allaccess.oidc.time')
+    def test_key_rotation(self, mock_time):
+        "Unknown keys refresh the key set no more than once per interval."
+        now = mock_time.time
+        now.return_value = time.time()
+        raw_token = self.get_raw_token(self.sign(self.get_claims()))
+        self.assertIsNotNone(self.oauth.get_profile_info(raw_token))
+        self.documents[JWKS_URL] = {'keys': [get_jwk(self.other_key, 'next')]}
+        rotated = self.get_raw_token(self.sign(self.get_claims(), key=self.other_key, kid='next'))
+        # Fetched within the refresh interval
+        self.assertIsNone(get_client(self.provider).get_profile_info(rotated))
+        self.assertEqual(len(self.get_fetched(JWKS_URL)), 1)
+        now.return_value += 120
+        self.assertIsNotNone(get_client(self.provider).get_profile_info(rotated))
+        self.assertEqual(len(self.get_fetched(JWKS_URL)), 2)
+
+    def test_redirect_nonce(self):
+        "Redirect requests the openid scope and stores a nonce."
+        request = self.factory.get('/login/')
+        request.session = {}
+        args = self.oauth.get_redirect_args(request, '/callback/')
+        self.assertEqual(args['scope'], 'openid')
+        self.assertEqual(args['nonce'], request.session[self.oauth.nonce_key])
+
+    def get_callback_request(self, nonce):
+        request = self.factory.get('/callback/', {'code': 'code', 'state': 'foo'})
+        request.session = {self.oauth.session_key: 'foo', self.oauth.nonce_key: nonce}
+        return request
+
+    def test_access_token_verified(self):
+        "The id_token is verified with the nonce when the token is fetched."
+        raw_token = self.get_raw_token(self.sign(self.get_claims(nonce='nonce')))
+        self.token_response = raw_token
+        token = self.oauth.get_access_token(self.get_callback_request('nonce'))
+        self.assertEqual(token, raw_token)
+        self.assertEqual(self.oauth.get_profile_info(raw_token)['sub'], '100')
+
+    def test_access_token_wrong_nonce(self):
+        "Tokens for another nonce are rejected."
+        raw_token = self.get_raw_token(self.sign(self.get_claims(nonce='other')))
+        self.token_response = raw_token
+        self.assertIsNone(self.oauth.get_access_token(self.get_callback_request('nonce')))
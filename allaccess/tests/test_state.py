@@ -0,0 +1,125 @@
+"Flow state storage tests."
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.test import override_settings
+from django.test.client import RequestFactory
+
+from .base import AllAccessTestCase
+from ..compat import urlparse, parse_qs
+from ..state import get_state_store, CacheStateStore, CookieStateStore, SessionStateStore
+
+
+class BaseStateStoreTestCase(object):
+    "Common state store functionality."
+
+    store_class = None
+
+    def setUp(self):
+        self.store = self.store_class()
+        self.factory = RequestFactory()
+
+    def round_trip(self, key, value):
+        "Store a value on the redirect and read it back on the callback."
+        request = self.factory.get('/login/')
+        request.session = {}
+        self.store.set(request, key, value)
+        response = self.store.update_response(request, HttpResponse())
+        callback = self.factory.get('/callback/')
+        callback.session = request.session
+        for name, morsel in response.cookies.items():
+            callback.COOKIES[name] = morsel.value
+        return callback
+
+    def test_round_trip(self):
+        "Stored values can be read on the callback."
+        request = self.round_trip('state', 'foo')
+        self.assertEqual(self.store.get(request, 'state'), 'foo')
+
+    def test_missing(self):
+        "Missing values return None."
+        request = self.factory.get('/callback/')
+        request.session = {}
+        self.assertIsNone(self.store.get(request, 'state'))
+
+
+class SessionStateStoreTestCase(BaseStateStoreTestCase, AllAccessTestCase):
+    "Store the state in the session."
+
+    store_class = SessionStateStore
+
+    def test_no_cookies(self):
+        "Session store does not set any cookies."
+        request = self.factory.get('/login/')
+        request.session = {}
+        self.store.set(request, 'state', 'foo')
+        response = self.store.update_response(request, HttpResponse())
+        self.assertEqual(len(response.cookies), 0)
+        self.assertEqual(request.session['state'], 'foo')
+
+
+class CookieStateStoreTestCase(BaseStateStoreTestCase, AllAccessTestCase):
+    "Store the state in a signed cookie."
+
+    store_class = CookieStateStore
+
+    def test_tampered(self):
+        "Modified cookies are ignored."
+        request = self.round_trip('state', 'foo')
+        value = request.COOKIES['state']
+        request.COOKIES['state'] = value[:-1] + ('A' if value[-1] != 'A' else 'B')
+        self.assertIsNone(self.store.get(request, 'state'))
+
+    def test_expired(self):
+        "Cookies older than the timeout are ignored."
+        request = self.round_trip('state', 'foo')
+        with override_settings(ALLACCESS_STATE_TIMEOUT=-1):
+            self.assertIsNone(self.store.get(request, 'state'))
+
+
+class CacheStateStoreTestCase(BaseStateStoreTestCase, AllAccessTestCase):
+    "Store the state in the cache tied to a flow cookie."
+
+    store_class = CacheStateStore
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_other_browser(self):
+        "State cannot be read without the flow cookie."
+        request = self.round_trip('state', 'foo')
+        request.COOKIES[CacheStateStore.cookie_name] = 'x' * 32
+        self.assertIsNone(self.store.get(request, 'state'))
+
+    def test_invalid_flow_id(self):
+        "Malformed flow ids are ignored."
+        request = self.factory.get('/callback/')
+        request.COOKIES[CacheStateStore.cookie_name] = 'bad key with spaces'
+        self.assertIsNone(self.store.get(request, 'state'))
+
+
+@override_settings(
+    ROOT_URLCONF='allaccess.tests.urls', ALLACCESS_STATE_STORE='allaccess.state.CookieStateStore')
+class StatelessRedirectTestCase(AllAccessTestCase):
+    "Redirect without writing to the session."
+
+    def setUp(self):
+        self.provider = self.create_provider(
+            consumer_key=self.get_random_string(), consumer_secret=self.get_random_string())
+
+    def test_configured_store(self):
+        "Store is configured by the ALLACCESS_STATE_STORE setting."
+        self.assertIsInstance(get_state_store(), CookieStateStore)
+
+    def test_state_cookie(self):
+        "OAuth 2.0 state is set in a cookie rather than the session."
+        url = reverse('allaccess-login', kwargs={'provider': self.provider.name})
+        response = self.client.get(url)
+        query = parse_qs(urlparse(response['Location']).query)
+        key = 'allaccess-{0}-request-state'.format(self.provider.name)
+        self.assertNotIn(key, self.client.session)
+        request = RequestFactory().get('/callback/')
+        request.COOKIES[key] = response.cookies[key].value
+        self.assertEqual(get_state_store().get(request, key), query['state'][0])
@@ -0,0 +1,97 @@
+"Deferred task executor tests."
+from __future__ import unicode_literals
+
+import threading
+
+from django.test import override_settings
+
+from .base import AllAccessTestCase
+from ..compat import patch, Mock
+from ..signals import profile_enriched
+from ..tasks import get_executor, enrich_profile, ImmediateExecutor, ThreadPoolExecutor
+
+
+calls = []
+
+
+def record(*args, **kwargs):
+    calls.append((threading.current_thread().name, args, kwargs))
+
+
+def fail():
+    raise ValueError('Task failed.')
+
+
+class ExecutorTestCase(AllAccessTestCase):
+    "Running deferred tasks."
+
+    def setUp(self):
+        super(ExecutorTestCase, self).setUp()
+        del calls[:]
+
+    def test_default_executor(self):
+        "Tasks run in a thread pool by default."
+        self.assertTrue(isinstance(get_executor(), ThreadPoolExecutor))
+
+    @override_settings(ALLACCESS_EXECUTOR='allaccess.tasks.ImmediateExecutor')
+    def test_configured_executor(self):
+        "Executor can be changed with a setting."
+        self.assertTrue(isinstance(get_executor(), ImmediateExecutor))
+
+    def test_immediate(self):
+        "Tasks run in the current thread."
+        ImmediateExecutor().submit('allaccess.tests.test_tasks.record', 1, foo='bar')
+        self.assertEqual(calls, [(threading.current_thread().name, (1, ), {'foo': 'bar'})])
+
+    def test_thread_pool(self):
+        "Tasks run in another thread."
+        executor = ThreadPoolExecutor()
+        executor.submit('allaccess.tests.test_tasks.record', 1, foo='bar').wait(5)
+        self.assertEqual(len(calls), 1)
+        name, args, kwargs = calls[0]
+        self.assertNotEqual(name, threading.current_thread().name)
+        self.assertEqual((args, kwargs), ((1, ), {'foo': 'bar'}))
+        self.assertIs(executor.pool, ThreadPoolExecutor().pool)
+
+    @patch('allaccess.tasks.logger')
+    def test_thread_pool_error(self, logger):
+        "Errors in tasks are logged."
+        ThreadPoolExecutor().submit('allaccess.tests.test_tasks.fail').wait(5)
+        self.assertTrue(logger.exception.called)
+
+
+class EnrichProfileTestCase(AllAccessTestCase):
+    "Deferred profile fetch after login."
+
+    def setUp(self):
+        super(EnrichProfileTestCase, self).setUp()
+        self.access = self.create_access(access_token='token')
+        self.receiver = Mock()
+        profile_enriched.connect(self.receiver)
+        self.addCleanup(profile_enriched.disconnect, self.receiver)
+
+    @patch('allaccess.clients.OAuth2Client.get_profile_info')
+    def test_fetch_profile(self, get_profile_info):
+        "Profile is fetched with the saved token and sent with the signal."
+        get_profile_info.return_value = {'id': self.access.identifier, 'name': 'User'}
+        info = enrich_profile(self.access.pk, profile_info_params={'fields': 'name'}, new=True)
+        self.assertEqual(info['name'], 'User')
+        get_profile_info.assert_called_with('token', {'fields': 'name'})
+        kwargs = self.receiver.call_args[1]
+        self.assertEqual(kwargs['access'], self.access)
+        self.assertEqual(kwargs['info'], info)
+        self.assertTrue(kwargs['new'])
+
+    @patch('allaccess.clients.OAuth2Client.get_profile_info')
+    def test_fetched_profile(self, get_profile_info):
+        "Profile is not fetched again if it was given."
+        info = {'id': self.access.identifier}
+        self.assertEqual(enrich_profile(self.access.pk, info=info), info)
+        self.assertFalse(get_profile_info.called)
+        self.assertEqual(self.receiver.call_args[1]['info'], info)
+
+    def test_missing_access(self):
+        "No signal is sent if the access record was removed."
+        self.access.delete()
+        self.assertIsNone(enrich_profile(self.access.pk))
+        self.assertFalse(self.receiver.called)
@@ -1,11 +1,16 @@
 "Redirect and callback view tests."
 from __future__ import unicode_literals
 
+import time
+from datetime import timedelta
+
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.test import override_settings, RequestFactory
+from django.utils import timezone
 
 from .base import AllAccessTestCase, AccountAccess, get_user_model, skipIfCustomUser
+from ..clients import Token
 from ..compat import urlparse, parse_qs, patch, Mock
 from ..views import OAuthRedirect, OAuthCallback
 
@@ -120,6 +125,9 @@ class OAuthCallbackTestCase(BaseViewTestCase):
         self.patched_get_client = patch('allaccess.views.get_client')
         self.get_client = self.patched_get_client.start()
         self.mock_client = Mock()
+        self.mock_client.get_token.return_value = Token('token', 'token')
+        self.mock_client.get_token_profile.return_value = None
+        self.mock_client.get_callback_key.return_value = None
         self.get_client.return_value = self.mock_client
 
     def tearDown(self):
@@ -182,6 +190,16 @@ class OAuthCallbackTestCase(BaseViewTestCase):
         "Create a new user and associate them with the provider."
         self._test_create_new_user()
 
+    @skipIfCustomUser
+    def test_new_user_identity_cache(self):
+        "Assigning the new user removes any cached user for the pair."
+        self.mock_client.get_access_token.return_value = 'token'
+        self.mock_client.get_profile_info.return_value = {'id': 100}
+        with patch('allaccess.views.identity_cache') as identity_cache:
+            self.client.get(self.url)
+        access = AccountAccess.objects.get(provider=self.provider, identifier=100)
+        identity_cache.invalidate.assert_called_with(self.provider.pk, access.identifier)
+
     def _test_existing_user(self):
         "Base test case for both swapped and non-swapped user."
         User = get_user_model()
@@ -203,6 +221,70 @@ class OAuthCallbackTestCase(BaseViewTestCase):
         "Authenticate existing user and update their access token."
         self._test_existing_user()
 
+    def test_token_profile(self):
+        "Profile request is skipped when the token response includes the user."
+        user = self.create_user()
+        self.create_access(user=user, provider=self.provider, identifier='U100')
+        self.mock_client.get_access_token.return_value = 'token'
+        self.mock_client.get_token_profile.return_value = {'id': 'U100'}
+        response = self.client.get(self.url)
+        self.assertRedirects(response, settings.LOGIN_REDIRECT_URL, fetch_redirect_response=False)
+        self.assertFalse(self.mock_client.get_profile_info.called)
+
+    @override_settings(ALLACCESS_PROVIDER_OPTIONS={'default': {'single_flight': True}})
+    def test_duplicate_callback(self):
+        "Duplicate callbacks reuse the token from the first exchange."
+        user = self.create_user()
+        self.create_access(user=user, provider=self.provider, identifier='100')
+        self.mock_client.get_callback_key.return_value = ('state', 'state', 'code')
+        self.mock_client.get_access_token.return_value = 'token'
+        self.mock_client.get_profile_info.return_value = {'id': '100'}
+        for _ in range(2):
+            response = self.client.get(self.url)
+            self.assertRedirects(response, settings.LOGIN_REDIRECT_URL, fetch_redirect_response=False)
+        self.assertEqual(self.mock_client.get_access_token.call_count, 1)
+        self.assertEqual(self.mock_client.get_profile_info.call_count, 2)
+
+    @override_settings(ALLACCESS_PROVIDER_OPTIONS={'default': {'defer_profile': True}})
+    @patch('allaccess.views.on_commit', side_effect=lambda func: func())
+    @patch('allaccess.views.get_executor')
+    def test_deferred_profile(self, get_executor, on_commit):
+        "User is logged in before the profile is fetched by the executor."
+        user = self.create_user()
+        access = self.create_access(user=user, provider=self.provider, identifier='U100')
+        self.mock_client.get_access_token.return_value = 'token'
+        self.mock_client.get_token_profile.return_value = {'id': 'U100'}
+        response = self.client.get(self.url)
+        self.assertRedirects(response, settings.LOGIN_REDIRECT_URL, fetch_redirect_response=False)
+        self.assertFalse(self.mock_client.get_profile_info.called)
+        get_executor.return_value.submit.assert_called_with(
+            'allaccess.tasks.enrich_profile', access.pk, info=None, profile_info_params={}, new=False)
+
+    @skipIfCustomUser
+    @override_settings(ALLACCESS_PROVIDER_OPTIONS={'default': {'defer_profile': True}})
+    @patch('allaccess.views.on_commit', side_effect=lambda func: func())
+    @patch('allaccess.views.get_executor')
+    def test_deferred_fetched_profile(self, get_executor, on_commit):
+        "A profile which was already fetched is passed to the executor."
+        self.mock_client.get_access_token.return_value = 'token'
+        self.mock_client.get_profile_info.return_value = {'id': 100}
+        self.client.get(self.url)
+        access = AccountAccess.objects.get(provider=self.provider, identifier=100)
+        get_executor.return_value.submit.assert_called_with(
+            'allaccess.tasks.enrich_profile', access.pk, info={'id': 100}, profile_info_params={}, new=True)
+
+    @skipIfCustomUser
+    def test_token_expiry(self):
+        "Expiry of the access token is saved with the token."
+        expires_at = timezone.now() + timedelta(hours=1)
+        self.mock_client.get_access_token.return_value = 'token'
+        self.mock_client.get_token.return_value = Token('token', 'token', expires_at=expires_at)
+        self.mock_client.get_profile_info.return_value = {'id': 100}
+        self.client.get(self.url)
+        access = AccountAccess.objects.get(provider=self.provider, identifier=100)
+        self.assertEqual(access.expires_at, expires_at)
+        self.mock_client.get_token.assert_called_with('token')
+
     def _test_authentication_redirect(self):
         "Base test case for both swapped and non-swapped user."
         self.mock_client.get_access_token.return_value = 'token'
@@ -230,3 +312,11 @@ class OAuthCallbackTestCase(BaseViewTestCase):
         self.assertEqual(result, '123')
         result = view.get_user_id(self.provider, {'id': '123'})
         self.assertIsNone(result)
+
+    def test_callback_deadline(self):
+        "Deadline for the provider requests is set on the client."
+        self.mock_client.get_access_token.return_value = None
+        with override_settings(ALLACCESS_PROVIDER_OPTIONS={'default': {'callback_deadline': 5}}):
+            self.client.get(self.url)
+        self.assertTrue(self.mock_client.deadline > time.time())
+        self.assertTrue(self.mock_client.deadline <= time.time() + 5)
@@ -0,0 +1,408 @@
+"Stream access records to and from files and the tables of other authentication libraries."
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+import os
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, router, transaction
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text
+from django.utils.six.moves.urllib.parse import urlencode
+
+from .bloom import identity_filter
+from .cache import identity_cache
+from .fields import decrypted_text
+from .models import AccountAccess, Provider
+
+
+FIELDS = ('provider', 'identifier', 'user', 'created', 'modified', 'expires_at', 'access_token')
+
+# Columns written for each new access record
+COLUMNS = ('identifier', 'provider', 'user', 'created', 'modified', 'access_token', 'expires_at')
+
+
+def iter_chunks(iterable, size):
+    "Split the iterable into lists of at most size items."
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_file(path, mode='r'):
+    "Open a file for the csv module in text mode on Python 3 and binary mode on Python 2."
+    if six.PY2:
+        return open(path, mode + 'b')
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def get_format(path, default='jsonl'):
+    "File format from the extension of the path."
+    extension = os.path.splitext(path or '')[1].lstrip('.').lower()
+    return extension if extension in ('csv', 'jsonl') else default
+
+
+def to_text(value):
+    "Convert a record value for the csv module."
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    value = force_text(value)
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def to_datetime(value):
+    "Parse ISO 8601 values from a file. Naive values are treated as UTC."
+    if value is None or isinstance(value, datetime):
+        return value
+    value = parse_datetime(force_text(value))
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def export_records(providers=None, users=False, decrypt=False, chunk_size=1000, using=None):
+    """
+    Yield access records as dictionaries in primary key order.
+
+    Rows are fetched in chunks of primary keys so neither the table nor a server-side
+    cursor is held open. Tokens are exported as stored unless decrypt is given so
+    they can be loaded into a database which shares the secret keys.
+    """
+    using = using or router.db_for_read(AccountAccess)
+    names = dict(Provider.objects.using(using).values_list('pk', 'name'))
+    queryset = AccountAccess._base_manager.using(using).order_by('pk')
+    if providers is not None:
+        queryset = queryset.filter(provider__in=[pk for pk, name in names.items() if name in providers])
+    user = 'user__{0}'.format(get_user_model().USERNAME_FIELD) if users else 'user'
+    token = 'access_token'
+    if not decrypt:
+        opts = AccountAccess._meta
+        qn = connections[using].ops.quote_name
+        token = 'raw_token'
+        queryset = queryset.extra(select={
+            token: '{0}.{1}'.format(qn(opts.db_table), qn(opts.get_field('access_token').column)),
+        })
+    queryset = queryset.values_list(
+        'pk', 'provider', 'identifier', user, 'created', 'modified', 'expires_at', token)
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            return
+        for row in rows:
+            record = dict(zip(FIELDS, row[1:]))
+            record['provider'] = names[record['provider']]
+            if record['access_token'] is not None:
+                record['access_token'] = decrypted_text(record['access_token'])
+            yield record
+        last = rows[-1][0]
+
+
+def write_jsonl(stream, records):
+    "Write one JSON document per record. Returns the number of records."
+    count = 0
+    for record in records:
+        record = dict(
+            (name, value.isoformat() if isinstance(value, datetime) else value)
+            for name, value in record.items()
+        )
+        stream.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(stream, records):
+    "Write the records with a header row. Returns the number of records."
+    writer = csv.writer(stream)
+    writer.writerow([to_text(name) for name in FIELDS])
+    count = 0
+    for record in records:
+        writer.writerow([to_text(record.get(name)) for name in FIELDS])
+        count += 1
+    return count
+
+
+def read_jsonl(stream):
+    for line in stream:
+        line = force_text(line).strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(stream):
+    reader = csv.reader(stream)
+    header = [force_text(name) for name in next(reader, [])]
+    for row in reader:
+        # Empty values are read as None
+        yield dict((name, force_text(value) or None) for name, value in zip(header, row))
+
+
+def read_table(sql, chunk_size=1000, using=None):
+    """
+    Yield rows for the query in chunks. The query must take the last key and the
+    chunk size as parameters, filter and order by the key in its first column.
+    """
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    last = -1
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [last, chunk_size])
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][0]
+
+
+def read_social_auth(chunk_size=1000, using=None, table='social_auth_usersocialauth'):
+    """
+    Yield records from the UserSocialAuth table of python-social-auth.
+
+    Tokens are read from the extra data. The expiry is only known when the
+    authentication time was stored along with the token lifetime.
+    """
+    qn = connections[using or DEFAULT_DB_ALIAS].ops.quote_name
+    sql = (
+        'SELECT id, provider, uid, user_id, extra_data FROM {0} WHERE id > %s ORDER BY id LIMIT %s'
+    ).format(qn(table))
+    for _, provider, uid, user, extra in read_table(sql, chunk_size, using):
+        if not isinstance(extra, dict):
+            # Stored as text unless the database has a native JSON type
+            extra = json.loads(extra or '{}') or {}
+        token = extra.get('access_token')
+        if isinstance(token, dict):
+            # OAuth 1.0 token response
+            token = {'token': token.get('oauth_token'), 'secret': token.get('oauth_token_secret')}
+        elif token:
+            token = {'token': token, 'secret': extra.get('refresh_token')}
+        expires_at = None
+        try:
+            expires_at = datetime.fromtimestamp(
+                int(extra['auth_time']), timezone.utc) + timedelta(seconds=int(extra['expires']))
+        except (KeyError, TypeError, ValueError):
+            pass
+        if not settings.USE_TZ and expires_at is not None:
+            expires_at = timezone.make_naive(expires_at, timezone.utc)
+        yield {
+            'provider': provider, 'identifier': uid, 'user': user,
+            'access_token': token, 'expires_at': expires_at,
+        }
+
+
+def read_allauth(chunk_size=1000, using=None):
+    """
+    Yield records from the social account tables of django-allauth.
+
+    Accounts with tokens for more than one application are read once for each token.
+    Chunks are limited by account so all of the tokens for an account are in one chunk.
+    """
+    sql = (
+        'SELECT a.id, a.provider, a.uid, a.user_id, t.token, t.token_secret, t.expires_at '
+        'FROM (SELECT id, provider, uid, user_id FROM socialaccount_socialaccount '
+        'WHERE id > %s ORDER BY id LIMIT %s) a '
+        'LEFT OUTER JOIN socialaccount_socialtoken t ON t.account_id = a.id '
+        'ORDER BY a.id, t.id'
+    )
+    for _, provider, uid, user, token, secret, expires_at in read_table(sql, chunk_size, using):
+        yield {
+            'provider': provider, 'identifier': uid, 'user': user,
+            'access_token': {'token': token, 'secret': secret} if token else None,
+            'expires_at': expires_at,
+        }
+
+
+def format_token(provider, token):
+    "Convert a token and secret read from another library to the raw token response stored for the provider."
+    if not isinstance(token, dict):
+        return token
+    key, secret = token.get('token'), token.get('secret')
+    if not key:
+        return None
+    if provider.request_token_url:
+        return urlencode([('oauth_token', key), ('oauth_token_secret', secret or '')])
+    data = {'access_token': key}
+    if secret:
+        # The secret of an OAuth 2.0 token is the refresh token
+        data['refresh_token'] = secret
+    return json.dumps(data)
+
+
+class Importer(object):
+    """
+    Load access records into the database in chunks.
+
+    Providers are resolved once. Each chunk needs one query for each provider to find
+    the existing pairs, one to match users by username and a single statement to
+    insert the new records. The access records are written without signals.
+    Chunks which fail with an IntegrityError are checked and loaded again.
+    """
+
+    #: times each chunk is loaded before giving up
+    attempts = 3
+
+    def __init__(self, chunk_size=1000, update=False, users=False, create_users=False,
+                 provider_map=None, using=None):
+        self.chunk_size = chunk_size
+        self.update = update
+        self.users = users
+        self.create_users = create_users
+        self.provider_map = provider_map or {}
+        self.using = using or router.db_for_write(AccountAccess)
+        self.connection = connections[self.using]
+        providers = Provider.objects.using(self.using).only('pk', 'name', 'request_token_url')
+        self.providers = dict((provider.name, provider) for provider in providers)
+        self.stats = {'created': 0, 'updated': 0, 'skipped': 0}
+
+    def run(self, records):
+        "Load all of the records. Returns the number created, updated and skipped."
+        for chunk in iter_chunks(records, self.chunk_size):
+            for attempt in range(self.attempts):
+                stats = dict(self.stats)
+                try:
+                    with transaction.atomic(using=self.using):
+                        self.load(chunk)
+                except IntegrityError:
+                    # Users or records were created concurrently so check the chunk again
+                    self.stats = stats
+                    if attempt == self.attempts - 1:
+                        raise
+                else:
+                    break
+        if self.stats['created']:
+            # New pairs were not seen by the post_save receiver
+            identity_filter.reset()
+        return self.stats
+
+    def load(self, records):
+        "Insert or update a chunk of records."
+        rows = OrderedDict()
+        for record in records:
+            name = record.get('provider')
+            provider = self.providers.get(self.provider_map.get(name, name))
+            identifier = record.get('identifier')
+            if provider is None or not identifier:
+                self.stats['skipped'] += 1
+                continue
+            key = (provider.pk, force_text(identifier))
+            if key in rows:
+                # Only the last record for the pair in the chunk is used
+                self.stats['skipped'] += 1
+            rows[key] = (provider, record)
+        users = self.get_users([record.get('user') for _, record in rows.values()])
+        existing = self.get_existing(rows.keys())
+        now = timezone.now()
+        opts = AccountAccess._meta
+        fields = [opts.get_field(name) for name in COLUMNS]
+        inserts = []
+        for key, (provider, record) in rows.items():
+            user = record.get('user')
+            user = users.get(user) if self.users else user
+            token = format_token(provider, record.get('access_token'))
+            expires_at = to_datetime(record.get('expires_at'))
+            if key in existing:
+                if not self.update:
+                    self.stats['skipped'] += 1
+                    continue
+                # Only the values given in the record are changed
+                values = {'modified': now}
+                for name, value in (('access_token', token), ('expires_at', expires_at), ('user', user)):
+                    if value is not None:
+                        values[name] = value
+                AccountAccess._base_manager.using(self.using).filter(pk=existing[key]).update(**values)
+                identity_cache.invalidate(*key)
+                self.stats['updated'] += 1
+                continue
+            values = (
+                key[1], key[0], user, to_datetime(record.get('created')) or now,
+                to_datetime(record.get('modified')) or now, token, expires_at,
+            )
+            # Tokens which are already encrypted are stored as they are
+            inserts.append([
+                field.get_db_prep_value(value, self.connection) for field, value in zip(fields, values)
+            ])
+        if inserts:
+            created = self.insert(inserts)
+            # Pairs created by a login since they were checked are kept
+            self.stats['created'] += created
+            self.stats['skipped'] += len(inserts) - created
+
+    def get_users(self, names):
+        "Map usernames to user ids, creating the missing users if enabled."
+        names = set(force_text(name) for name in names if name)
+        if not self.users or not names:
+            return {}
+        User = get_user_model()
+        manager = User._default_manager.db_manager(self.using)
+        lookup = '{0}__in'.format(User.USERNAME_FIELD)
+        users = dict(manager.filter(**{lookup: names}).values_list(User.USERNAME_FIELD, 'pk'))
+        missing = names - set(users)
+        if missing and self.create_users:
+            created = []
+            for name in missing:
+                user = User(**{User.USERNAME_FIELD: name})
+                user.set_unusable_password()
+                created.append(user)
+            manager.bulk_create(created)
+            # Primary keys are not set by bulk_create on every database
+            users.update(manager.filter(**{lookup: missing}).values_list(User.USERNAME_FIELD, 'pk'))
+        return users
+
+    def get_existing(self, keys):
+        "Map the provider and identifier pairs which are already stored to their primary keys."
+        identifiers = defaultdict(list)
+        for provider_id, identifier in keys:
+            identifiers[provider_id].append(identifier)
+        existing = {}
+        for provider_id, values in identifiers.items():
+            pairs = AccountAccess._base_manager.using(self.using).filter(
+                provider=provider_id, identifier__in=values).values_list('identifier', 'pk')
+            existing.update(((provider_id, identifier), pk) for identifier, pk in pairs)
+        return existing
+
+    def insert(self, rows):
+        """
+        Insert prepared rows which do not conflict with existing pairs. Returns the number inserted.
+
+        PostgreSQL copies the rows into a temporary table and inserts them from there.
+        Other databases use a batched INSERT which ignores conflicts where supported.
+        """
+        opts = AccountAccess._meta
+        vendor = self.connection.vendor
+        qn = self.connection.ops.quote_name
+        table = qn(opts.db_table)
+        columns = ', '.join(qn(opts.get_field(name).column) for name in COLUMNS)
+        with self.connection.cursor() as cursor:
+            if vendor == 'postgresql':
+                temp = qn('allaccess_import')
+                cursor.execute('CREATE TEMPORARY TABLE {0} AS SELECT {1} FROM {2} WITH NO DATA'.format(
+                    temp, columns, table))
+                stream = six.StringIO()
+                # Empty values are unquoted and read as NULL
+                csv.writer(stream).writerows([[to_text(value) for value in row] for row in rows])
+                stream.seek(0)
+                cursor.cursor.copy_expert(
+                    'COPY {0} ({1}) FROM STDIN WITH CSV'.format(temp, columns), stream)
+                cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON CONFLICT DO NOTHING'.format(
+                    table, columns, temp))
+                inserted = cursor.rowcount
+                cursor.execute('DROP TABLE {0}'.format(temp))
+                return inserted
+            insert = {'sqlite': 'INSERT OR IGNORE', 'mysql': 'INSERT IGNORE'}.get(vendor, 'INSERT')
+            sql = '{0} INTO {1} ({2}) VALUES ({3})'.format(
+                insert, table, columns, ', '.join(['%s'] * len(COLUMNS)))
+            cursor.executemany(sql, rows)
+            return cursor.rowcount
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 import base64
 import hashlib
 import logging
+import time
 
 from django.conf import settings
 from django.contrib import messages
@@ -13,8 +14,15 @@ from django.shortcuts import redirect
 from django.utils.encoding import smart_bytes, force_text
 from django.views.generic import RedirectView, View
 
+from .breaker import CircuitBreaker
+from .cache import identity_cache
 from .clients import get_client
+from .compat import on_commit
+from .conf import get_provider_option
+from .flight import SingleFlight
 from .models import Provider, AccountAccess
+from .state import get_state_store
+from .tasks import get_executor
 
 
 logger = logging.getLogger('allaccess.views')
@@ -38,6 +46,11 @@ class OAuthRedirect(OAuthClientMixin, RedirectView):
     permanent = False
     params = None
 
+    def get(self, request, *args, **kwargs):
+        response = super(OAuthRedirect, self).get(request, *args, **kwargs)
+        # Cookie based state stores need to set the cookie on the redirect
+        return get_state_store().update_response(request, response)
+
     def get_additional_parameters(self, provider):
         "Return additional redirect parameters for this provider."
         return self.params or {}
@@ -50,12 +63,16 @@ class OAuthRedirect(OAuthClientMixin, RedirectView):
         "Build redirect url for a given provider."
         name = kwargs.get('provider', '')
         try:
-            provider = Provider.objects.get(name=name)
+            provider = Provider.objects.get_cached(name)
         except Provider.DoesNotExist:
             raise Http404('Unknown OAuth provider.')
         else:
             if not provider.enabled():
                 raise Http404('Provider %s is not enabled.' % name)
+            if CircuitBreaker(provider).is_open():
+                logger.error('Provider {0} is unavailable.'.format(name))
+                messages.error(self.request, 'Authenication Failed.')
+                return settings.LOGIN_URL
             client = self.get_client(provider)
             callback = self.get_callback_url(provider)
             params = self.get_additional_parameters(provider)
@@ -71,47 +88,76 @@ class OAuthCallback(OAuthClientMixin, View):
     def get(self, request, *args, **kwargs):
         name = kwargs.get('provider', '')
         try:
-            provider = Provider.objects.get(name=name)
+            provider = Provider.objects.get_cached(name)
         except Provider.DoesNotExist:
             raise Http404('Unknown OAuth provider.')
         else:
             if not provider.enabled():
                 raise Http404('Provider %s is not enabled.' % name)
+            if CircuitBreaker(provider).is_open():
+                return self.handle_login_failure(provider, "Provider is unavailable.")
             client = self.get_client(provider)
+            client.deadline = self.get_deadline(provider)
             callback = self.get_callback_url(provider)
             # Fetch access token
-            raw_token = client.get_access_token(self.request, callback=callback)
+            raw_token = self.get_access_token(provider, client, callback)
             if raw_token is None:
                 return self.handle_login_failure(provider, "Could not retrieve token.")
+            deferred = get_provider_option(provider, 'defer_profile')
             # Fetch profile info params
             profile_info_params = self.get_profile_info_params()
-            # Fetch profile info
-            info = client.get_profile_info(raw_token, profile_info_params)
+            # Use the profile from the token response when the provider includes the user
+            info = client.get_token_profile(raw_token)
+            fetched = info is None
+            if fetched:
+                # Fetch profile info
+                info = client.get_profile_info(raw_token, profile_info_params)
             if info is None:
                 return self.handle_login_failure(provider, "Could not retrieve profile.")
             identifier = self.get_user_id(provider, info)
             if identifier is None:
                 return self.handle_login_failure(provider, "Could not determine id.")
-            # Get or create access record
-            defaults = {
-                'access_token': raw_token,
-            }
-            access, created = AccountAccess.objects.get_or_create(
-                provider=provider, identifier=identifier, defaults=defaults
-            )
-            if not created:
-                access.access_token = raw_token
-                AccountAccess.objects.filter(pk=access.pk).update(**defaults)
-            user = authenticate(provider=provider, identifier=identifier)
+            # Create or update access record
+            expires_at = client.get_token(raw_token).expires_at
+            access, _ = AccountAccess.objects.upsert(provider, identifier, raw_token, expires_at)
+            user = authenticate(provider=provider, identifier=identifier, access=access)
             if user is None:
-                return self.handle_new_user(provider, access, info)
+                response = self.handle_new_user(provider, access, info)
             else:
-                return self.handle_existing_user(provider, user, access, info)
+                response = self.handle_existing_user(provider, user, access, info)
+            if deferred:
+                self.enrich_profile(
+                    provider, access, info if fetched else None, profile_info_params, new=user is None)
+            return response
+
+    def get_access_token(self, provider, client, callback):
+        "Fetch the access token once for duplicate callbacks with the same authorization."
+        key = client.get_callback_key(self.request)
+        if key is None or not get_provider_option(provider, 'single_flight'):
+            return client.get_access_token(self.request, callback=callback)
+        flight = SingleFlight(provider, *key)
+        return flight.run(
+            lambda: client.get_access_token(self.request, callback=callback), deadline=client.deadline)
 
     def get_callback_url(self, provider):
         "Return callback url if different than the current url."
         return None
 
+    def enrich_profile(self, provider, access, info, profile_info_params, new=False):
+        "Submit the profile enrichment task to the executor once the access record is saved."
+        def submit():
+            get_executor().submit(
+                'allaccess.tasks.enrich_profile', access.pk, info=info,
+                profile_info_params=profile_info_params, new=new)
+        on_commit(submit)
+
+    def get_deadline(self, provider):
+        "Return the time by which all requests to the provider must complete."
+        seconds = get_provider_option(provider, 'callback_deadline')
+        if seconds is None:
+            return None
+        return time.time() + seconds
+
     def get_error_redirect(self, provider, reason):
         "Return url to redirect on login failure."
         return settings.LOGIN_URL
@@ -165,6 +211,8 @@ class OAuthCallback(OAuthClientMixin, View):
         user = self.get_or_create_user(provider, access, info)
         access.user = user
         AccountAccess.objects.filter(pk=access.pk).update(user=user)
-        user = authenticate(provider=access.provider, identifier=access.identifier)
+        # Updated without post_save so remove the cached user here
+        identity_cache.invalidate(access.provider_id, access.identifier)
+        user = authenticate(provider=access.provider, identifier=access.identifier, access=access)
         login(self.request, user)
         return redirect(self.get_login_redirect(provider, user, access, True))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Compare OAuth 1.0 signing throughput with and without the cached signer.
+
+Usage: python benchmarks/oauth1_signer.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY='benchmark', USE_TZ=True)
+
+from requests import Request
+from requests_oauthlib import OAuth1
+
+from allaccess.clients import OAuthClient
+
+
+class Provider(object):
+    name = 'benchmark'
+    consumer_key = 'consumer-key'
+    consumer_secret = 'consumer-secret'
+    request_token_url = 'https://example.com/request'
+
+
+TOKEN = 'oauth_token=user-token&oauth_token_secret=user-secret'
+URL = 'https://api.example.com/1.1/statuses/home_timeline.json?count=20'
+
+
+def sign_uncached(client, request):
+    "Signing as done before the signer was cached: parse the token and build OAuth1 per request."
+    token, secret = client.parse_raw_token(TOKEN)
+    oauth = OAuth1(
+        resource_owner_key=token,
+        resource_owner_secret=secret,
+        client_key=client.provider.consumer_key,
+        client_secret=client.provider.consumer_secret,
+    )
+    return oauth(request.copy())
+
+
+def sign_cached(client, request):
+    "Signing with the parsed token and signer cached on the client."
+    return client.get_signer(client.get_token(TOKEN))(request.copy())
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    client = OAuthClient(Provider(), TOKEN)
+    request = Request('GET', URL).prepare()
+    results = {}
+    for name, func in (('uncached', sign_uncached), ('cached', sign_cached)):
+        seconds = min(timeit.repeat(lambda: func(client, request), number=iterations, repeat=3))
+        results[name] = iterations / seconds
+        print('{0:>9}: {1:10.0f} signatures/s'.format(name, results[name]))
+    print('  speedup: {0:10.2f}x'.format(results['cached'] / results['uncached']))
+
+
+if __name__ == '__main__':
+    main()
@@ -48,6 +48,10 @@ setup(
         'requests_oauthlib>=0.4.2',
         'oauthlib>=0.6.2',
     ),
+    extras_require={
+        'gcm': ('cryptography>=2.0', ),
+        'aiohttp': ('aiohttp>=3.3', ),
+    },
     tests_require=('mock>=0.8', ),
     test_suite="runtests.runtests",
     zip_safe=False,